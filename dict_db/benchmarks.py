@@ -0,0 +1,407 @@
+"""
+Benchmark suite for the dict_db data-structures.
+Measures throughput, latency percentiles and round trips per operation, against a local
+redis-server / ElasticSearch node, or against in-process fakes:
+
+    python -m dict_db.benchmarks --fake -n 1000
+    python -m dict_db.benchmarks --only RedisHashDict,RedisList
+
+The Redis fake needs fakeredis (1.0 or later). Fakes without stream commands (fakeredis 1.0.x)
+skip the StreamMessageQueue benchmark. Round trips per operation catch N+1 access
+patterns - e.g. iterating a RedisList should cost about len/chunk_size round trips, not len.
+"""
+__author__ = 'OrW'
+
+import logging
+import optparse
+import threading
+from timeit import default_timer
+
+from elasticsearch import Elasticsearch, Transport
+from redis import ConnectionPool, ResponseError
+
+from redis_ds.redis_pipe import RedisPipe, BatchingRedisPipe
+from redis_ds.redis_hash_dict import JSONRedisHashDict, ExpirableJSONRedisHashDict
+from redis_ds.redis_list import JSONRedisList
+from redis_ds.redis_set import JSONRedisSet
+from redis_ds.redis_path_dict import RedisPathDict
+from redis_ds.message_queue import JSONMessageQueue, JSONStreamMessageQueue
+from elastic_ds.doc_dict import ElasticDocDict
+from elastic_ds.fake_elastic import FakeElasticConnection, FakeElasticServer
+import instrumentation
+
+
+class CountingRedisPipe(RedisPipe):
+    """
+    A RedisPipe counting round trips - a command outside of a transaction, or a whole pipeline.
+    Pub/sub traffic goes over its own connection and is not counted.
+    """
+
+    def __init__(self, **kwargs):
+        super(CountingRedisPipe, self).__init__(**kwargs)
+        self.round_trips = 0
+        self._count_lock = threading.Lock()
+
+    def _count(self):
+        with self._count_lock:
+            self.round_trips += 1
+
+    def execute_command(self, *args, **options):
+        if self.current_pipe is None:
+            self._count()
+        return super(CountingRedisPipe, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(CountingRedisPipe, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            if pipe.command_stack:
+                self._count()
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+
+class CountingBatchingRedisPipe(BatchingRedisPipe, CountingRedisPipe):
+    """
+    A BatchingRedisPipe counting round trips - a batch, or a command that isn't batched.
+    """
+
+
+class CountingTransport(Transport):
+    """
+    An elasticsearch Transport counting round trips (HTTP requests).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingTransport, self).__init__(*args, **kwargs)
+        self.round_trips = 0
+        self._count_lock = threading.Lock()
+
+    def perform_request(self, *args, **kwargs):
+        with self._count_lock:
+            self.round_trips += 1
+        return super(CountingTransport, self).perform_request(*args, **kwargs)
+
+
+def redis_client(fake=False, url=None):
+    """
+    :param fake: use an in-memory fakeredis server instead of a local redis-server
+    :param url: the redis-server to connect to, e.g. unix:///tmp/redis.sock, None for localhost:6379
+    :return a CountingRedisPipe:
+    """
+    if not fake:
+        return CountingRedisPipe.from_url(url) if url else CountingRedisPipe()
+    import fakeredis
+    pool = ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+    return CountingRedisPipe(connection_pool=pool)
+
+
+def elastic_client(fake=False):
+    """
+    :param fake: use an in-process FakeElasticServer instead of a local ElasticSearch node
+    :return an Elasticsearch client with a CountingTransport:
+    """
+    if not fake:
+        return Elasticsearch(transport_class=CountingTransport)
+    return Elasticsearch(transport_class=CountingTransport, connection_class=FakeElasticConnection,
+                         server=FakeElasticServer())
+
+
+class Result(object):
+    """
+    The measurements of a single benchmarked operation.
+    """
+
+    def __init__(self, structure, operation, latencies, round_trips, elapsed=None):
+        """
+        :param elapsed: wall-clock seconds of concurrent calls, None when the calls were made one after another
+        """
+        self.structure = structure
+        self.operation = operation
+        self.calls = len(latencies)
+        self.total = sum(latencies) if elapsed is None else elapsed
+        self.round_trips = round_trips
+        self._latencies = sorted(latencies)
+
+    def percentile(self, percent):
+        if not self._latencies:
+            return 0.0
+        index = min(int(len(self._latencies) * percent / 100.0), len(self._latencies) - 1)
+        return self._latencies[index]
+
+    @property
+    def ops_per_second(self):
+        return self.calls / self.total if self.total else 0.0
+
+    @property
+    def round_trips_per_call(self):
+        return float(self.round_trips) / self.calls if self.calls else 0.0
+
+    def as_dict(self):
+        return {"structure": self.structure, "operation": self.operation, "calls": self.calls,
+                "ops_per_second": self.ops_per_second, "p50": self.percentile(50),
+                "p90": self.percentile(90), "p99": self.percentile(99),
+                "round_trips_per_call": self.round_trips_per_call}
+
+
+def measure(structure, operation, client, func, calls):
+    """
+    Time func(i) for every i in range(calls)
+    :param client: the CountingRedisPipe / Elasticsearch client whose round trips are counted
+    :return a Result:
+    """
+    counter = client.transport if isinstance(client, Elasticsearch) else client
+    latencies = []
+    round_trips = counter.round_trips
+    for i in xrange(calls):
+        start = default_timer()
+        func(i)
+        latencies.append(default_timer() - start)
+    return Result(structure, operation, latencies, counter.round_trips - round_trips)
+
+
+def measure_concurrent(structure, operation, client, func, calls, threads):
+    """
+    Time func(i) for every i in range(calls), split between concurrent threads
+    :param client: the CountingRedisPipe whose round trips are counted
+    :return a Result, its throughput by the wall-clock time of all the calls:
+    """
+    latencies = []
+    round_trips = client.round_trips
+
+    def work(thread):
+        for i in xrange(thread, calls, threads):
+            start = default_timer()
+            func(i)
+            latencies.append(default_timer() - start)
+    workers = [threading.Thread(target=work, args=(thread,)) for thread in xrange(threads)]
+    start = default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return Result(structure, operation, latencies, client.round_trips - round_trips,
+                  elapsed=default_timer() - start)
+
+
+# Scenarios - each takes (client, size) and returns a list of Results
+
+ITERATION_PASSES = 3
+
+
+def bench_redis_hash_dict(client, size, ds_class=JSONRedisHashDict, name="RedisHashDict"):
+    ds = ds_class("bench_dict_db.hash_dict", redis_client=client)
+    ds.delete_all()
+    results = [
+        measure(name, "set", client, lambda i: ds.__setitem__(str(i), {"i": i}), size),
+        measure(name, "get", client, lambda i: ds[str(i)], size),
+        measure(name, "contains", client, lambda i: str(i) in ds, size),
+        measure(name, "len", client, lambda i: len(ds), size),
+        measure(name, "iterate", client, lambda i: list(ds.iteritems()), ITERATION_PASSES),
+        measure(name, "delete", client, lambda i: ds.__delitem__(str(i)), size),
+    ]
+    ds.delete_all()
+    return results
+
+
+def bench_concurrent_redis_hash_dict(client, size, threads=16):
+    """
+    Concurrent threads sharing a client, with and without batching their commands
+    """
+    results = []
+    batching_client = CountingBatchingRedisPipe(connection_pool=client.connection_pool)
+    for name, ds_client in (("RedisHashDict x%d" % threads, client),
+                            ("RedisHashDict x%d batching" % threads, batching_client)):
+        ds = JSONRedisHashDict("bench_dict_db.concurrent_hash_dict", redis_client=ds_client)
+        ds.delete_all()
+        results += [
+            measure_concurrent(name, "set", ds_client, lambda i: ds.__setitem__(str(i), {"i": i}), size, threads),
+            measure_concurrent(name, "get", ds_client, lambda i: ds[str(i)], size, threads),
+        ]
+        ds.delete_all()
+    return results
+
+
+def bench_expirable_redis_hash_dict(client, size):
+    ds = ExpirableJSONRedisHashDict("bench_dict_db.expirable_hash_dict", redis_client=client)
+    ds.set_default_expiration(3600)
+    ds.delete_all()
+    name = "ExpirableRedisHashDict"
+    results = [
+        measure(name, "set", client, lambda i: ds.__setitem__(str(i), {"i": i}), size),
+        measure(name, "get", client, lambda i: ds[str(i)], size),
+        measure(name, "contains", client, lambda i: str(i) in ds, size),
+        measure(name, "len", client, lambda i: len(ds), size),
+        measure(name, "iterate", client, lambda i: list(ds.iter_fresh_items()), ITERATION_PASSES),
+        measure(name, "delete", client, lambda i: ds.__delitem__(str(i)), size),
+    ]
+    ds.delete_all()
+    return results
+
+
+def bench_redis_list(client, size):
+    ds = JSONRedisList("bench_dict_db.list", redis_client=client)
+    ds.delete()
+    name = "RedisList"
+    results = [
+        measure(name, "append", client, lambda i: ds.append({"i": i}), size),
+        measure(name, "get", client, lambda i: ds[i], size),
+        measure(name, "len", client, lambda i: len(ds), size),
+        measure(name, "iterate", client, lambda i: list(ds), ITERATION_PASSES),
+        measure(name, "pop", client, lambda i: ds.pop(), size),
+    ]
+    ds.delete()
+    return results
+
+
+def bench_redis_set(client, size):
+    ds = JSONRedisSet("bench_dict_db.set", redis_client=client)
+    ds.delete_all()
+    name = "RedisSet"
+    results = [
+        measure(name, "add", client, lambda i: ds.add(i), size),
+        measure(name, "contains", client, lambda i: i in ds, size),
+        measure(name, "len", client, lambda i: len(ds), size),
+        measure(name, "iterate", client, lambda i: list(ds), ITERATION_PASSES),
+        measure(name, "remove", client, lambda i: ds.remove(i), size),
+    ]
+    ds.delete_all()
+    return results
+
+
+def bench_redis_path_dict(client, size):
+    ds = RedisPathDict("bench_dict_db.path_dict", redis_client=client)
+    ds.delete_all()
+    name = "RedisPathDict"
+    results = [
+        measure(name, "set", client, lambda i: ds.__setitem__(str(i), i), size),
+        measure(name, "get", client, lambda i: ds[str(i)], size),
+        measure(name, "contains", client, lambda i: str(i) in ds, size),
+        measure(name, "len", client, lambda i: len(ds), size),
+        measure(name, "iterate", client, lambda i: list(ds.iteritems()), ITERATION_PASSES),
+        measure(name, "delete", client, lambda i: ds.__delitem__(str(i)), size),
+    ]
+    ds.delete_all()
+    return results
+
+
+def bench_message_queue(client, size):
+    name = "MessageQueue"
+    writer = JSONMessageQueue(["bench_dict_db.queue"], redis_client=client)
+    results = [measure(name, "write", client, lambda i: writer.write({"i": i}, wait_for_readers=False), size)]
+    fan_out = JSONMessageQueue(["bench_dict_db.queue.%d" % i for i in xrange(20)], redis_client=client)
+    results.append(measure(name, "write_many", client,
+                           lambda i: fan_out.write_many([{"i": i}] * 10, wait_for_readers=False), size))
+    reader = JSONMessageQueue(["bench_dict_db.queue"], redis_client=client)
+    with reader:
+        def write_read(i):
+            writer.write({"i": i})
+            reader.read()
+        results.append(measure(name, "write_read", client, write_read, size))
+    return results
+
+
+def bench_stream_message_queue(client, size):
+    name = "StreamMessageQueue"
+    try:
+        client.execute_command("XINFO", "HELP")
+    except ResponseError:
+        logging.warning("Skipping %s- the server has no stream commands" % name)
+        return []
+    writer = JSONStreamMessageQueue(["bench_dict_db.stream"], redis_client=client)
+    writer.delete()
+    with JSONStreamMessageQueue(["bench_dict_db.stream"], redis_client=client) as reader:
+        results = [measure(name, "write", client, lambda i: writer.write({"i": i}), size),
+                   measure(name, "read", client, lambda i: reader.read(), size)]
+    writer.delete()
+    return results
+
+
+def bench_elastic_doc_dict(es, size, keys_mode=ElasticDocDict.KEYS_MODE_DOCUMENT):
+    name = "ElasticDocDict(%s)" % keys_mode
+    ds = ElasticDocDict("bench_dict_db", "ElasticDocDict", es=es, keys_mode=keys_mode)
+    ds.delete_all()
+    results = [measure(name, "set", es, lambda i: ds.__setitem__(str(i), {"i": i}), size)]
+    es.indices.refresh(index="bench_dict_db")
+    results += [
+        measure(name, "get", es, lambda i: ds[str(i)], size),
+        measure(name, "contains", es, lambda i: ds.has_key(str(i)), size),
+        measure(name, "len", es, lambda i: len(ds), size),
+        measure(name, "iterate", es, lambda i: list(ds.iteritems()), ITERATION_PASSES),
+        measure(name, "delete", es, lambda i: ds.__delitem__(str(i)), size),
+    ]
+
+    def bulk_load(i):
+        with ds:
+            for j in xrange(size):
+                ds[str(j)] = {"i": j}
+    # A whole write-behind load of `size` documents per call
+    results.append(measure(name, "bulk_load", es, bulk_load, ITERATION_PASSES))
+    ds.delete_all()
+    return results
+
+
+REDIS_BENCHMARKS = {
+    "RedisHashDict": bench_redis_hash_dict,
+    "ConcurrentRedisHashDict": bench_concurrent_redis_hash_dict,
+    "ExpirableRedisHashDict": bench_expirable_redis_hash_dict,
+    "RedisList": bench_redis_list,
+    "RedisSet": bench_redis_set,
+    "RedisPathDict": bench_redis_path_dict,
+    "MessageQueue": bench_message_queue,
+    "StreamMessageQueue": bench_stream_message_queue,
+}
+
+ELASTIC_BENCHMARKS = {
+    "ElasticDocDict": bench_elastic_doc_dict,
+    "ElasticDocDictIndexKeys": lambda es, size: bench_elastic_doc_dict(es, size, ElasticDocDict.KEYS_MODE_INDEX),
+}
+
+
+def run(fake=False, size=1000, only=None, redis_url=None, instrument=False):
+    """
+    Run the benchmarks
+    :param fake: use in-process fakes instead of local servers
+    :param redis_url: the redis-server to benchmark, None for localhost:6379
+    :param instrument: run with the instrumentation enabled, to measure its overhead
+    :param size: number of calls per operation (and the size of the benchmarked structures)
+    :param only: names of the benchmarks to run (keys of REDIS_BENCHMARKS / ELASTIC_BENCHMARKS), None for all
+    :return a list of Results:
+    """
+    results = []
+    if instrument:
+        instrumentation.enable()
+    for benchmarks, create_client in ((REDIS_BENCHMARKS, lambda fake: redis_client(fake, redis_url)),
+                                      (ELASTIC_BENCHMARKS, elastic_client)):
+        selected = [name for name in sorted(benchmarks) if only is None or name in only]
+        if selected:
+            client = create_client(fake=fake)
+            for name in selected:
+                results += benchmarks[name](client, size)
+    if instrument:
+        instrumentation.disable()
+    return results
+
+
+def print_results(results):
+    print "%-32s %-12s %8s %12s %10s %10s %10s %8s" % ("structure", "operation", "calls", "ops/sec",
+                                                         "p50 usec", "p90 usec", "p99 usec", "rt/call")
+    for result in results:
+        print "%-32s %-12s %8d %12.1f %10.1f %10.1f %10.1f %8.2f" % (
+            result.structure, result.operation, result.calls, result.ops_per_second,
+            result.percentile(50) * 1e6, result.percentile(90) * 1e6, result.percentile(99) * 1e6,
+            result.round_trips_per_call)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--fake", action="store_true", default=False, help="use in-process fake backends")
+    parser.add_option("-n", "--size", type="int", default=1000, help="calls per operation")
+    parser.add_option("--only", default=None, help="comma separated benchmark names")
+    parser.add_option("--redis-url", default=None, help="redis-server URL, e.g. unix:///tmp/redis.sock")
+    parser.add_option("--instrument", action="store_true", default=False, help="enable the instrumentation")
+    options, _ = parser.parse_args()
+    print_results(run(fake=options.fake, size=options.size, only=options.only.split(",") if options.only else None,
+                      redis_url=options.redis_url, instrument=options.instrument))
@@ -1,6 +1,6 @@
-from redis_ds.redis_hash_dict import JSONRedisHashDict
-from redis_ds.redis_list import JSONRedisList
-from elastic_ds.doc_dict import ElasticDocDict
+import threading
+
+from redis_ds.serialization import Codec
 
 
 # DB Types
@@ -12,13 +12,98 @@ class Consts(object):
     DS_LIST = 'list'
 
     SER_JSON = 'json'
+    SER_PICKLE = 'pickle'
+    SER_MSGPACK = 'msgpack'
+
+    COMPRESS_ZLIB = 'zlib'
+    COMPRESS_LZ4 = 'lz4'
 
 
 class DictDbFactory(object):
 
-    def __init__(self, db_type, default_ds_type=Consts.DS_DICT):
+    def __init__(self, db_type, default_ds_type=Consts.DS_DICT, serialization=Consts.SER_JSON, compression=None,
+                 compression_threshold=1024, redis_nodes=None, hash_shards=None, redis_options=None,
+                 elastic_hosts=None, elastic_options=None):
+        """
+        :param serialization: the Consts.SER_* format of Redis values
+        :param compression: a Consts.COMPRESS_* compression for Redis values, None to never compress
+        :param compression_threshold: Redis values shorter than this (in bytes) are not compressed
+        :param redis_nodes: Redis clients or URLs (redis://host:port/db) to spread the keys over by consistent hashing,
+            None to keep every key on redis_config.CLIENT
+        :param hash_shards: split every Redis dict into this many sub-hashes spread over the nodes, None to keep each
+            dict in a single hash-map
+        :param redis_options: connection and pool options of the Redis clients (the redis_nodes URLs select
+            their servers themselves, and take the other options)-
+            host, port, db, unix_socket_path, max_connections, socket_timeout, socket_connect_timeout,
+            socket_keepalive, socket_keepalive_options, retry_on_timeout... None to use redis_config.CLIENT.
+            auto_batch=True coalesces the commands of concurrent threads into pipelines (@see BatchingRedisPipe)
+        :param elastic_hosts: the ElasticSearch nodes, e.g. ["es1:9200", "es2:9200"]
+        :param elastic_options: options of the Elasticsearch client and its HTTP connection pools-
+            maxsize (connections per node), timeout, retry_on_timeout, max_retries, sniff_on_start...
+        Every data-structure the factory creates shares the factory's clients, and through them their connection pools.
+        The backends are imported, and the clients created, when the first data-structure is created.
+        """
         self._db_type = db_type
+        self._redis_options = redis_options
+        self._redis_nodes = redis_nodes
+        self._elastic_hosts = elastic_hosts
+        self._elastic_options = elastic_options
+        self._clients_lock = threading.Lock()
+        self._redis_client = None
+        self._ring = None
+        self._elastic_client = None
+        self._hash_shards = hash_shards
         self._default_ds_type = default_ds_type
+        if serialization == Consts.SER_JSON and compression is None:
+            # Plain JSON, readable by the JSON data-structures
+            self._codec = None
+        else:
+            self._codec = Codec(serialization, compression=compression,
+                                compression_threshold=compression_threshold)
+
+    @property
+    def redis_client(self):
+        """
+        :return the Redis client of the created data-structures (when not sharded over redis_nodes):
+        """
+        from redis_ds import redis_config
+        with self._clients_lock:
+            if self._redis_client is None:
+                if self._redis_options:
+                    self._redis_client = redis_config.LazyClient(**self._redis_options)
+                else:
+                    self._redis_client = redis_config.CLIENT
+            return self._redis_client
+
+    @property
+    def ring(self):
+        """
+        :return the HashRing of the redis_nodes, None when not sharded over nodes:
+        """
+        from redis_ds import redis_config
+        from redis_ds.redis_shard import HashRing
+        with self._clients_lock:
+            if self._ring is None and self._redis_nodes:
+                # The URLs select the nodes' servers, the rest of the options apply to their connections
+                node_options = {name: value for name, value in (self._redis_options or {}).iteritems()
+                                if name not in redis_config.TARGET_OPTIONS}
+                self._ring = HashRing([redis_config.LazyClient(node, **node_options)
+                                       if isinstance(node, basestring) else node for node in self._redis_nodes])
+            return self._ring
+
+    @property
+    def elastic_client(self):
+        """
+        :return the Elasticsearch client of the created data-structures:
+        """
+        from elastic_ds.doc_dict import default_client
+        if not (self._elastic_hosts or self._elastic_options):
+            return default_client()
+        with self._clients_lock:
+            if self._elastic_client is None:
+                from elasticsearch import Elasticsearch
+                self._elastic_client = Elasticsearch(self._elastic_hosts, **(self._elastic_options or {}))
+            return self._elastic_client
 
     def create(self, path, name, ds_type=None):
         if ds_type is None:
@@ -28,14 +113,49 @@ class DictDbFactory(object):
                 key = "%s_%s" % (path, name)
             else:
                 key = path
-            if ds_type == Consts.DS_DICT:
-                return JSONRedisHashDict(key)
-            elif ds_type == Consts.DS_LIST:
-                return JSONRedisList(key)
+            if ds_type == Consts.DS_DICT and self._hash_shards:
+                return self._create_sharded_dict(key)
+            from redis_ds.redis_hash_dict import JSONRedisHashDict, CodecRedisHashDict
+            from redis_ds.redis_list import JSONRedisList, CodecRedisList
+            ring = self.ring
+            client = ring.get_node(key) if ring is not None else self.redis_client
+            if self._codec is None:
+                if ds_type == Consts.DS_DICT:
+                    return JSONRedisHashDict(key, redis_client=client)
+                elif ds_type == Consts.DS_LIST:
+                    return JSONRedisList(key, redis_client=client)
+                else:
+                    raise ValueError("Unsupported ds_type %r" % (ds_type,))
+            else:
+                if ds_type == Consts.DS_DICT:
+                    ds = CodecRedisHashDict(key, redis_client=client)
+                elif ds_type == Consts.DS_LIST:
+                    ds = CodecRedisList(key, redis_client=client)
+                else:
+                    raise ValueError("Unsupported ds_type %r" % (ds_type,))
+                ds.codec = self._codec
+                return ds
 
         elif self._db_type == Consts.DB_ELASTIC:
+            if self._codec is not None:
+                raise NotImplementedError("ElasticSearch stores values as JSON documents only...")
             if ds_type == Consts.DS_DICT:
-                return ElasticDocDict(path, name)
+                from elastic_ds.doc_dict import ElasticDocDict
+                return ElasticDocDict(path, name, es=self.elastic_client)
             elif ds_type == Consts.DS_LIST:
                 raise NotImplementedError("ElasticSearch list not available yet...")
+            else:
+                raise ValueError("Unsupported ds_type %r" % (ds_type,))
 
+    def _create_sharded_dict(self, key):
+        from redis_ds.redis_hash_dict import CodecRedisHashDict
+        from redis_ds.redis_shard import HashRing, ShardedRedisHashDict
+        ring = self.ring
+        if ring is None:
+            ring = HashRing([self.redis_client])
+        if self._codec is None:
+            return ShardedRedisHashDict(key, ring, shards=self._hash_shards)
+        ds = ShardedRedisHashDict(key, ring, shards=self._hash_shards, hash_dict_class=CodecRedisHashDict)
+        for shard in ds.shards:
+            shard.codec = self._codec
+        return ds
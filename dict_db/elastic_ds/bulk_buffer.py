@@ -0,0 +1,241 @@
+"""
+A write-behind buffer of ElasticSearch bulk actions.
+Actions are coalesced per document while buffered, and flushed by size and age
+on background workers, so writers don't wait for ElasticSearch.
+"""
+__author__ = 'OrW'
+
+import collections
+import logging
+import Queue
+import threading
+import time
+
+from elasticsearch import TransportError
+
+
+class BulkBuffer(object):
+    """
+    Buffers bulk actions (in the format of elasticsearch.helpers.bulk) and sends them in bulk requests
+    once max_bytes or max_actions are buffered, or the oldest buffered action is max_age seconds old.
+
+    Repeated writes of a document are coalesced into a single action- a later index or delete replaces
+    the buffered action, and partial updates (doc) are merged into the buffered index or update.
+    Bulk requests are sent by `workers` threads. The actions of a document always go to the same worker,
+    so they are applied in the order they were added. Adding blocks while every worker is `queue_size` requests behind.
+
+    Items that fail are collected, along with the status and error ElasticSearch returned, and are returned by close.
+    """
+
+    DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+    DEFAULT_MAX_ACTIONS = 10000
+    DEFAULT_MAX_AGE = 1.0
+
+    def __init__(self, es, max_bytes=DEFAULT_MAX_BYTES, max_actions=DEFAULT_MAX_ACTIONS, max_age=DEFAULT_MAX_AGE,
+                 workers=2, queue_size=2, on_failure=None):
+        """
+        :param es: the Elasticsearch client
+        :param max_bytes: approximate size of the buffered bodies that triggers a flush
+        :param max_actions: number of buffered actions that triggers a flush
+        :param max_age: seconds an action may stay buffered, None to flush by size only
+        :param workers: number of threads sending bulk requests
+        :param queue_size: number of bulk requests a worker may fall behind before adding blocks
+        :param on_failure: called with every failed item, in addition to collecting it
+        """
+        self._es = es
+        self._serializer = es.transport.serializer
+        self._max_bytes = max_bytes
+        self._max_actions = max_actions
+        self._max_age = max_age
+        self._on_failure = on_failure
+        # Guards the buffer, and is held while handing batches to the workers to keep them in order
+        self._lock = threading.RLock()
+        # Guards the failures and counters, which the workers update
+        self._stats_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._pending_bytes = 0
+        self._oldest = None
+        self._failures = []
+        self._stats = collections.Counter()
+        self._queues = [Queue.Queue(maxsize=queue_size) for i in xrange(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(queue,), name="BulkBuffer-%d" % i)
+                         for i, queue in enumerate(self._queues)]
+        self._closed = threading.Event()
+        if max_age is not None:
+            self._threads.append(threading.Thread(target=self._tick, name="BulkBuffer-ticker"))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    # Buffering
+
+    def add(self, action):
+        """
+        Buffer a bulk action, flushing if the buffer is full
+        :param action: a dict with _op_type, _index, _type, _id, and _source (index) or doc (update)
+        """
+        action = dict(action)
+        action.setdefault("_op_type", "index")
+        # Buffered bodies are copied, so later writes can be merged into them in place
+        for field in ("_source", "doc"):
+            if isinstance(action.get(field), dict):
+                action[field] = dict(action[field])
+        key = (action["_index"], action["_type"], action["_id"])
+        size = self._size(action)
+        with self._lock:
+            self._count("added")
+            previous = self._pending.get(key)
+            if previous is not None:
+                coalesced = self._coalesce(previous, action)
+                if coalesced is None:
+                    # Can't be combined- send the buffered action first to keep the document's actions in order
+                    self.flush(wait=False)
+                else:
+                    action = coalesced
+                    self._count("coalesced")
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._pending[key] = action
+            self._pending_bytes += size
+            if self._pending_bytes >= self._max_bytes or len(self._pending) >= self._max_actions:
+                self.flush(wait=False)
+
+    def _count(self, counter, value=1):
+        with self._stats_lock:
+            self._stats[counter] += value
+
+    def _size(self, action):
+        return len(self._serializer.dumps(action.get("_source", action.get("doc"))))
+
+    @classmethod
+    def _merge_doc(cls, target, doc):
+        """
+        Merge a partial update into a document, recursively, as ElasticSearch does
+        """
+        for field, value in doc.iteritems():
+            if isinstance(value, dict) and isinstance(target.get(field), dict):
+                target[field] = cls._merge_doc(dict(target[field]), value)
+            else:
+                target[field] = value
+        return target
+
+    @classmethod
+    def _coalesce(cls, previous, action):
+        """
+        :return a single action equivalent to previous followed by action (merging into previous),
+            None if they can't be combined:
+        """
+        op_type, previous_op_type = action["_op_type"], previous["_op_type"]
+        if op_type in ("index", "delete"):
+            return action
+        if op_type != "update" or "doc" not in action or "script" in previous:
+            return None
+        if previous_op_type == "index":
+            cls._merge_doc(previous["_source"], action["doc"])
+            return previous
+        if previous_op_type == "update" and previous.get("doc_as_upsert") == action.get("doc_as_upsert"):
+            cls._merge_doc(previous["doc"], action["doc"])
+            return previous
+        if previous_op_type == "delete" and action.get("doc_as_upsert"):
+            return {"_op_type": "index", "_index": action["_index"], "_type": action["_type"],
+                    "_id": action["_id"], "_source": action["doc"]}
+        return None
+
+    # Flushing
+
+    def flush(self, wait=True):
+        """
+        Send the buffered actions
+        :param wait: block until every sent action was applied
+        """
+        with self._lock:
+            pending, self._pending = self._pending, collections.OrderedDict()
+            self._pending_bytes = 0
+            self._oldest = None
+            if pending:
+                self._count("flushes")
+                batches = [[] for queue in self._queues]
+                for key, action in pending.iteritems():
+                    batches[hash(key) % len(batches)].append(action)
+                for queue, batch in zip(self._queues, batches):
+                    if batch:
+                        queue.put(batch)
+        if wait:
+            for queue in self._queues:
+                queue.join()
+
+    def pop_failures(self):
+        """
+        :return the items that failed since the last call:
+        """
+        with self._stats_lock:
+            failures, self._failures = self._failures, []
+        return failures
+
+    def _tick(self):
+        while not self._closed.wait(self._max_age / 2.0):
+            with self._lock:
+                if self._oldest is not None and time.time() - self._oldest >= self._max_age:
+                    self.flush(wait=False)
+
+    def _work(self, queue):
+        while True:
+            batch = queue.get()
+            try:
+                if batch is None:
+                    return
+                self._send(batch)
+            except Exception:
+                logging.exception("Failed to process a bulk request")
+            finally:
+                queue.task_done()
+
+    def _bulk_lines(self, action):
+        meta = {field: action[field] for field in ("_index", "_type", "_id") if field in action}
+        op_type = action["_op_type"]
+        yield self._serializer.dumps({op_type: meta})
+        if op_type == "update":
+            yield self._serializer.dumps({field: value for field, value in action.iteritems()
+                                          if not field.startswith("_")})
+        elif op_type != "delete":
+            yield self._serializer.dumps(action["_source"])
+
+    def _send(self, batch):
+        lines = [line for action in batch for line in self._bulk_lines(action)]
+        try:
+            items = self._es.bulk("\n".join(lines) + "\n")["items"]
+        except TransportError, err:
+            items = [{action["_op_type"]: {"_index": action["_index"], "_type": action["_type"],
+                                           "_id": action["_id"], "status": err.status_code, "error": str(err)}}
+                     for action in batch]
+        failures = [item for item in items if not 200 <= item.values()[0].get("status", 500) < 300]
+        with self._stats_lock:
+            self._stats["sent"] += len(batch)
+            self._stats["failed"] += len(failures)
+            self._failures += failures
+        if self._on_failure is not None:
+            for item in failures:
+                self._on_failure(item)
+
+    def stats(self):
+        """
+        :return counters of the added, coalesced, sent and failed actions, and of the flushes:
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._lock:
+            stats["pending"] = len(self._pending)
+        return stats
+
+    def close(self):
+        """
+        Flush the buffer and stop the workers
+        :return the items that failed since the last pop_failures:
+        """
+        self.flush()
+        self._closed.set()
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        return self.pop_failures()
@@ -1,7 +1,9 @@
 import collections
+import threading
 from serialization import PassThroughSerializer
+from bulk_buffer import BulkBuffer
 from elasticsearch import Elasticsearch, NotFoundError
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import bulk, scan, BulkIndexError
 
 class Nil(object):
     pass
@@ -14,35 +16,93 @@ class KeyShouldBeStringException(ValueError):
     pass
 
 
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """
+    :return the Elasticsearch client (localhost:9200) shared by the ElasticDocDicts created without one:
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = Elasticsearch()
+        return _default_client
+
+
 class ElasticDocDict(collections.MutableMapping):
     """
     A Dict interface for ElasticSearch Documents.
     Every item-value is stored as a document with the item-key as the document-id
+
+    Keys are tracked either in a single keys document (KEYS_MODE_DOCUMENT, the default),
+    or enumerated from the index itself (KEYS_MODE_INDEX) with the count and scroll APIs.
+    The index mode keeps writes to a single command, but len() and keys() only see documents
+    once the index is refreshed.
+
+    Within a with block (bulk mode) writes are buffered and sent in the background by a BulkBuffer-
+    repeated writes of a key, and the keys document updates, are coalesced into a single action per flush.
+    Leaving the block flushes the buffer, and raises BulkIndexError if any write failed.
+    Reads within the block may not see writes that are still buffered.
+
+    Writes outside of bulk mode follow a refresh policy, set per instance and overridable per call (set, upsert):
+    REFRESH_FALSE leaves refreshing to the index's refresh interval, REFRESH_TRUE refreshes after the write,
+    and REFRESH_WAIT_FOR (ES 5 and later) waits for the next refresh, so search, count and scroll see the write.
+    Single key reads (get, mget) are realtime and see writes regardless of refreshes.
     """
 
+    KEYS_MODE_DOCUMENT = "document"
+    KEYS_MODE_INDEX = "index"
+    PAGE_SIZE = 1000
+
+    REFRESH_FALSE = "false"
+    REFRESH_TRUE = "true"
+    REFRESH_WAIT_FOR = "wait_for"
+
+    # Index settings applied during tuned bulk loads- no refreshes, no replicas and asynchronous translog fsyncs
+    BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": "0",
+                          "index.translog.durability": "async"}
+    # Restored after a tuned bulk load for settings the index didn't set explicitly
+    DEFAULT_INDEX_SETTINGS = {"index.refresh_interval": "1s", "index.number_of_replicas": "1",
+                              "index.translog.durability": "request"}
+
     KEYS_ID = "__ElasticDocDict_Keys"
     DOT_ESCAPE_SEQ = '_;_'
     DOT_CHAR = "."
     VALUE_FIELD_NAME = "__value__"
     TYPE_FIELD_NAME = "__type__"
 
-    def __init__(self, index, doc_type, es=None):
+    def __init__(self, index, doc_type, es=None, keys_mode=KEYS_MODE_DOCUMENT, refresh=REFRESH_FALSE):
         if es is None:
-            self._es = Elasticsearch()
+            self._es = default_client()
         else:
             self._es = es
         self._index = index.lower()
         self._doc_type = doc_type
+        self._keys_mode = keys_mode
+        self._refresh = refresh
         self._is_in_bulk_mode = False
-        self._bulk_commands = []
-        # Set Keys document
-        bulk(self._es, [
-                        {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
-                         "_id": self.KEYS_ID, "doc": {}, "doc_as_upsert": True}
-                        ])
+        self._bulk_options = {}
+        self._tune_index = False
+        self._saved_settings = None
+        self._bulk_buffer = None
+        if self._keys_mode == self.KEYS_MODE_DOCUMENT:
+            # Set Keys document
+            bulk(self._es, [
+                            {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
+                             "_id": self.KEYS_ID, "doc": {}, "doc_as_upsert": True}
+                            ])
+        else:
+            # Make sure the index exists, so it can be counted and scrolled before the first write
+            self._es.indices.create(index=self._index, ignore=[400])
+
+    @property
+    def keys_mode(self):
+        return self._keys_mode
 
     def __repr__(self):
-        return dict(self).__repr__()
+        return dict(self.iteritems()).__repr__()
 
     def serialize(self, value):
         if isinstance(value, dict):
@@ -95,89 +155,316 @@ class ElasticDocDict(collections.MutableMapping):
         else:
             raise KeyError(data)
 
+    def bulk_mode(self, tune_index=False, **options):
+        """
+        Configure the next with block, e.g. with d.bulk_mode(tune_index=True, workers=4):
+        :param tune_index: apply BULK_LOAD_SETTINGS to the index during the block, restoring its settings
+            and refreshing it on exit. The index is shared- other writers lose replicas meanwhile too.
+        :param options: passed on to BulkBuffer (max_bytes, max_actions, max_age, workers, queue_size, on_failure)
+        :return self:
+        """
+        self._tune_index = tune_index
+        self._bulk_options = options
+        return self
+
     def __enter__(self):
+        if self._tune_index:
+            self._saved_settings = self.__get_settings(self.BULK_LOAD_SETTINGS)
+            self._es.indices.put_settings(index=self._index, body=self.BULK_LOAD_SETTINGS)
+        self._bulk_buffer = BulkBuffer(self._es, **self._bulk_options)
         self._is_in_bulk_mode = True
         return self
 
+    def __get_settings(self, names):
+        """
+        :return the index's current values of the named (flat) settings, defaulting to DEFAULT_INDEX_SETTINGS:
+        """
+        response = self._es.indices.get_settings(index=self._index, flat_settings=True)
+        settings = response.get(self._index, {}).get("settings", {})
+        return {name: settings.get(name, self.DEFAULT_INDEX_SETTINGS.get(name)) for name in names}
+
     def _bulk_add_commands(self, commands):
-        self._bulk_commands += commands
-        if len(self._bulk_commands) > 100:
-            bulk(self._es, self._bulk_commands)
-            self._bulk_commands = []
+        for command in commands:
+            self._bulk_buffer.add(command)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        bulk(self._es, self._bulk_commands)
-        self._is_in_bulk_mode = False
-        self._bulk_commands = []
+        try:
+            failures = self._bulk_buffer.close()
+        finally:
+            self._is_in_bulk_mode = False
+            self._bulk_options = {}
+            self._bulk_buffer = None
+            if self._tune_index:
+                self._es.indices.put_settings(index=self._index, body=self._saved_settings)
+                self.refresh()
+                self._tune_index = False
+                self._saved_settings = None
+        if failures and exc_type is None:
+            raise BulkIndexError("%i document(s) failed to index." % len(failures), failures)
+
+    def refresh(self):
+        """Make all the writes so far visible to search, count and scroll."""
+        self._es.indices.refresh(index=self._index)
+
+    def _bulk(self, commands, refresh=None):
+        """
+        Send commands in a bulk request
+        :param refresh: the refresh policy of the request, None for the instance's policy
+        """
+        bulk(self._es, commands, refresh=refresh or self._refresh)
+
+    def _write(self, commands, refresh=None):
+        if self._is_in_bulk_mode:
+            self._bulk_add_commands(commands)
+        else:
+            self._bulk(commands, refresh)
 
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, refresh=None):
+        """
+        :param refresh: the refresh policy of the write, None for the instance's policy (ignored in bulk mode)
+        """
         assert isinstance(key, basestring), KeyShouldBeStringException("Data loss- Keys are serialized to strings")
         body = self.serialize(value)
         commands = [{'_op_type': 'index', "_index": self._index,
-                         "_type": self._doc_type, "_id": key, "_source": body},
+                         "_type": self._doc_type, "_id": key, "_source": body}
+                    ] + self.__add_key_commands(key)
+        # Store value and update keys
+        self._write(commands, refresh)
 
-                    {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
-                     "_id": self.KEYS_ID, "doc": {self.__escape_field(key): ""},  "doc_as_upsert": True}
-                    ]
-        if self._is_in_bulk_mode:
-            self._bulk_add_commands(commands)
-        else:
-            # Store value and update keys
-            bulk(self._es, commands)
-
-    def upsert(self, key, data):
+    def upsert(self, key, data, refresh=None):
         """
         Update (or create) an entry in place
         :param key: the key of the updated/created entry
         :param data: The data to update/create
+        :param refresh: the refresh policy of the write, None for the instance's policy (ignored in bulk mode)
         """
         data = self.serialize(data)
-        bulk(self._es, [
-                        {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
-                         "_id": key, "doc": data, "doc_as_upsert": True},
+        self._write([
+                     {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
+                      "_id": key, "doc": data, "doc_as_upsert": True}
+                     ] + self.__add_key_commands(key), refresh)
+
+    def __add_key_commands(self, key):
+        """
+        :return the commands that register key in the keys document (none in index keys mode):
+        """
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            return []
+        return [{'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
+                 "_id": self.KEYS_ID, "doc": {self.__escape_field(key): ""}, "doc_as_upsert": True}]
+
+    def __values_query(self, filters=()):
+        """
+        Matches every document but the keys document (which may be left over from the document keys mode)
+        :param filters: query clauses the documents must also match
+        """
+        query = {"bool": {"must_not": {"ids": {"values": [self.KEYS_ID]}}}}
+        if filters:
+            query["bool"]["filter"] = list(filters)
+        return {"query": query}
+
+    def _scan_hits(self, filters=(), source=False, page_size=None):
+        """
+        Scroll through the documents matching filters
+        :param source: field names to fetch from dict values, None fetches the whole values, False fetches none
+        :return an iterator over the hits:
+        """
+        query = dict(self.__values_query(filters), sort=["_doc"],
+                     _source=False if source is False else self.__source_fields(source))
+        return scan(self._es, query=query, index=self._index, doc_type=self._doc_type,
+                    size=page_size or self.PAGE_SIZE, preserve_order=True)
+
+    def _first_hit(self, filters):
+        """
+        :return the first hit matching filters, None if none does:
+        """
+        body = dict(self.__values_query(filters), size=1)
+        hits = self._es.search(index=self._index, doc_type=self._doc_type, body=body)["hits"]["hits"]
+        return hits[0] if hits else None
 
-                        {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
-                         "_id": self.KEYS_ID, "doc": {self.__escape_field(key): ""}, "doc_as_upsert": True}
-                        ])
+    def _count_hits(self, filters=()):
+        return self._es.count(index=self._index, doc_type=self._doc_type,
+                              body=self.__values_query(filters))["count"]
+
+    def _aggregate(self, filters, aggs):
+        """
+        :param aggs: a dict of aggregation names to ES aggregations
+        :return the aggregations part of the response:
+        """
+        body = dict(self.__values_query(filters), size=0, aggs=aggs)
+        return self._es.search(index=self._index, doc_type=self._doc_type, body=body)["aggregations"]
+
+    def _query_field(self, field):
+        """
+        :return the document field of a dict-value field, or of plain values if field is None:
+        """
+        return self.VALUE_FIELD_NAME if field is None else self.__escape_field(field)
+
+    def _filters(self, query=None, range=None, **terms):
+        """
+        @see where
+        :return a list of query clauses:
+        """
+        filters = [] if query is None else [query]
+        for field, value in terms.iteritems():
+            kind = "terms" if isinstance(value, (list, tuple, set)) else "term"
+            filters.append({kind: {self._query_field(field): list(value) if kind == "terms" else value}})
+        for field, bounds in (range or {}).iteritems():
+            filters.append({"range": {self._query_field(field): bounds}})
+        return filters
+
+    def where(self, query=None, range=None, **terms):
+        """
+        Filter the dict on the server side, e.g. d.where(color=["red", "blue"], range={"age": {"gte": 18}})
+        Filters apply to the fields of dict values- the field None refers to plain values, e.g. range={None: {"lt": 5}}.
+        Only documents the index has refreshed are matched.
+        :param query: an ES query clause the values must match
+        :param range: a dict of fields to range bounds (gt, gte, lt, lte)
+        :param terms: fields the values must equal (term), or be one of, if given a list (terms).
+            Analyzed string fields match their analyzed terms only.
+        :return a lazy DocDictView of the matching items:
+        """
+        return DocDictView(self, self._filters(query, range, **terms))
 
     def __len__(self):
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            return self._count_hits()
         return len(self.keys())
 
     def __get_keys_document(self):
         return {self.__unescape_field(k): v for k, v in self.get(self.KEYS_ID, {}).iteritems()}
 
     def keys(self):
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            return list(self.iterkeys())
         return self.__get_keys_document().keys()
 
     def iterkeys(self):
-        for key in self.keys():
-            yield key
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            for hit in self._scan_hits():
+                yield hit["_id"]
+        else:
+            for key in self.keys():
+                yield key
 
     __iter__ = iterkeys
 
+    def __source_fields(self, source):
+        """
+        :param source: field names of dict values to fetch, None for the whole documents
+        :return the matching _source filter- which always includes the fields of plain values:
+        """
+        if source is None:
+            return True
+        return [self.__escape_field(field) for field in source] + [self.VALUE_FIELD_NAME, self.TYPE_FIELD_NAME]
+
+    def __mget(self, keys, source=None):
+        """
+        Fetch keys in a single mget request
+        :return an iterator over the (key, value) of the found keys:
+        """
+        docs = [{"_id": key, "_source": self.__source_fields(source)} for key in keys]
+        response = self._es.mget(index=self._index, doc_type=self._doc_type, body={"docs": docs})
+        for doc in response["docs"]:
+            if doc.get("found"):
+                yield doc["_id"], self.deserialize(doc["_source"])
+
+    def get_many(self, keys, default=None, source=None):
+        """
+        Retrieve several keys in a single request (mget)
+        :param keys: an iterable of keys to retrieve
+        :param default: the value returned for keys that do not exist
+        :param source: field names to fetch from dict values, None fetches the whole values.
+            Plain values are always fetched.
+        :return a dict mapping every requested key to its value:
+        """
+        keys = list(keys)
+        values = dict.fromkeys(keys, default)
+        if keys:
+            values.update(self.__mget(keys, source))
+        return values
+
+    def iteritems(self, page_size=None, source=None):
+        """
+        Stream the items a page at a time - scrolling the index in index keys mode,
+        or fetching the keys document keys with mget otherwise
+        :param page_size: number of documents fetched per request
+        :param source: field names to fetch from dict values, None fetches the whole values.
+            Plain values are always fetched.
+        :return an iterator over the (key, value) items:
+        """
+        page_size = page_size or self.PAGE_SIZE
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            for hit in self._scan_hits(source=source, page_size=page_size):
+                yield hit["_id"], self.deserialize(hit.get("_source", {}))
+        else:
+            keys = self.keys()
+            for i in xrange(0, len(keys), page_size):
+                for item in self.__mget(keys[i:i + page_size], source):
+                    yield item
+
+    def itervalues(self, page_size=None, source=None):
+        for key, value in self.iteritems(page_size=page_size, source=source):
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
     def __delitem__(self, key):
-        new_keys = {k: v for k, v in self.__get_keys_document().iteritems() if k != key}
-        bulk(self._es, [
-            # remove document
-            {'_op_type': 'delete', "_index": self._index, "_type": self._doc_type, "_id": key},
-            # update key document, removing deleted key
-            {'_op_type': 'index', "_index": self._index, "_type": self._doc_type,
-             "_id": self.KEYS_ID, "_source": new_keys},
-            # TODO: consider enabling scripting for better performance
-            # erase key from key document
-            # {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
-            #  "_id": self.KEYS_ID, "script": {'script': "ctx._source.remove(field_name)", 'params': {"field_name": key}}}
-        ])
+        if self._is_in_bulk_mode:
+            # The keys document is rewritten from its stored version, so buffered writes must land first
+            self._bulk_buffer.flush()
+        # remove document
+        commands = [{'_op_type': 'delete', "_index": self._index, "_type": self._doc_type, "_id": key}]
+        if self._keys_mode == self.KEYS_MODE_DOCUMENT:
+            new_keys = {k: v for k, v in self.__get_keys_document().iteritems() if k != key}
+            commands += [
+                # update key document, removing deleted key
+                {'_op_type': 'index', "_index": self._index, "_type": self._doc_type,
+                 "_id": self.KEYS_ID, "_source": new_keys},
+                # TODO: consider enabling scripting for better performance
+                # erase key from key document
+                # {'_op_type': 'update', "_index": self._index, "_type": self._doc_type,
+                #  "_id": self.KEYS_ID, "script": {'script': "ctx._source.remove(field_name)", 'params': {"field_name": key}}}
+            ]
+        self._bulk(commands)
 
     def delete_all(self):
         """
         Remove all keys (and matching ES documents)
         """
-        delete_operations = [{'_op_type': 'delete', "_index": self._index, "_type": self._doc_type,
-                             "_id": key} for key in self.keys()]
-        empty_keys = [{'_op_type': 'index', "_index": self._index, "_type": self._doc_type,
-                       "_id": self.KEYS_ID, "_source": {}}]
-        bulk(self._es, delete_operations + empty_keys)
+        if self._is_in_bulk_mode:
+            self._bulk_buffer.flush()
+        delete_operations = ({'_op_type': 'delete', "_index": self._index, "_type": self._doc_type,
+                              "_id": key} for key in self.iterkeys())
+        if self._keys_mode == self.KEYS_MODE_INDEX:
+            self._bulk(delete_operations)
+        else:
+            empty_keys = [{'_op_type': 'index', "_index": self._index, "_type": self._doc_type,
+                           "_id": self.KEYS_ID, "_source": {}}]
+            self._bulk(list(delete_operations) + empty_keys)
+
+    def migrate_to_index_keys(self):
+        """
+        Switch an existing dict to the index keys mode.
+        Keys are already stored as document ids, so only the keys document is dropped.
+        """
+        self._es.delete(index=self._index, doc_type=self._doc_type, id=self.KEYS_ID, ignore=[404])
+        self._keys_mode = self.KEYS_MODE_INDEX
+
+    def migrate_to_document_keys(self):
+        """
+        Switch an existing dict back to the keys document mode, rebuilding the keys document from the index.
+        """
+        keys = {self.__escape_field(key): "" for key in self.iterkeys()}
+        self._es.index(index=self._index, doc_type=self._doc_type, id=self.KEYS_ID, body=keys)
+        self._keys_mode = self.KEYS_MODE_DOCUMENT
 
     def delete_elastic_index(self):
         """
@@ -186,3 +473,99 @@ class ElasticDocDict(collections.MutableMapping):
         """
         self.delete_all()
         self._es.indices.delete(index=self._index)
+
+
+class DocDictView(collections.Mapping):
+    """
+    A lazy, read-only view of the ElasticDocDict items matching a query, created by ElasticDocDict.where.
+    Items are streamed from the index page by page, and counts and aggregations are computed by ElasticSearch.
+    """
+
+    def __init__(self, doc_dict, filters):
+        self._doc_dict = doc_dict
+        self._filters = filters
+
+    def where(self, query=None, range=None, **terms):
+        """
+        @see ElasticDocDict.where
+        :return a view of the items matching both this view's query and the given one:
+        """
+        return DocDictView(self._doc_dict, self._filters + self._doc_dict._filters(query, range, **terms))
+
+    def __repr__(self):
+        return dict(self.iteritems()).__repr__()
+
+    def count(self):
+        return self._doc_dict._count_hits(self._filters)
+
+    __len__ = count
+
+    def __getitem__(self, key):
+        hit = self._doc_dict._first_hit(self._filters + [{"ids": {"values": [key]}}])
+        if hit is None:
+            raise KeyError(key)
+        return self._doc_dict.deserialize(hit.get("_source", {}))
+
+    def __contains__(self, key):
+        return self._doc_dict._count_hits(self._filters + [{"ids": {"values": [key]}}]) > 0
+
+    def iterkeys(self):
+        for hit in self._doc_dict._scan_hits(self._filters):
+            yield hit["_id"]
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self, page_size=None, source=None):
+        """
+        :param page_size: number of documents fetched per request
+        :param source: field names to fetch from dict values, None fetches the whole values.
+            Plain values are always fetched.
+        :return an iterator over the matching (key, value) items:
+        """
+        for hit in self._doc_dict._scan_hits(self._filters, source=source, page_size=page_size):
+            yield hit["_id"], self._doc_dict.deserialize(hit.get("_source", {}))
+
+    def itervalues(self, page_size=None, source=None):
+        for key, value in self.iteritems(page_size=page_size, source=source):
+            yield value
+
+    def items(self, source=None):
+        return list(self.iteritems(source=source))
+
+    def values(self, source=None):
+        return list(self.itervalues(source=source))
+
+    def aggregate(self, aggs):
+        """
+        :param aggs: a dict of aggregation names to ES aggregations, over the matching documents
+        :return the aggregations part of the response:
+        """
+        return self._doc_dict._aggregate(self._filters, aggs)
+
+    def __metric(self, kind, field):
+        return self.aggregate({kind: {kind: {"field": self._doc_dict._query_field(field)}}})[kind]["value"]
+
+    def sum(self, field=None):
+        """
+        :param field: a field of dict values, None for plain values
+        """
+        return self.__metric("sum", field)
+
+    def avg(self, field=None):
+        return self.__metric("avg", field)
+
+    def min(self, field=None):
+        return self.__metric("min", field)
+
+    def max(self, field=None):
+        return self.__metric("max", field)
+
+    def terms(self, field=None, size=10):
+        """
+        :return the (term, count) of the field's `size` most common terms:
+        """
+        aggs = {"terms": {"terms": {"field": self._doc_dict._query_field(field), "size": size}}}
+        return [(bucket["key"], bucket["doc_count"]) for bucket in self.aggregate(aggs)["terms"]["buckets"]]
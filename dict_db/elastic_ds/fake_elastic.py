@@ -0,0 +1,367 @@
+"""
+An in-process ElasticSearch stand-in, for benchmarks and tests that can't reach a cluster:
+
+    es = Elasticsearch(connection_class=FakeElasticConnection, server=FakeElasticServer())
+
+Implements the subset of the REST API used by ElasticDocDict - documents, bulk, mget, count,
+scrolled search with basic queries and aggregations, and index settings.
+Every document is searchable as soon as it is written (no refresh interval).
+"""
+__author__ = 'OrW'
+
+import collections
+import itertools
+import json
+import threading
+
+from elasticsearch import Connection
+
+
+class FakeElasticError(Exception):
+
+    def __init__(self, status, error):
+        super(FakeElasticError, self).__init__(error)
+        self.status = status
+        self.error = error
+
+
+class FakeElasticServer(object):
+    """
+    Holds the indices shared by all the FakeElasticConnections created with it.
+    """
+
+    SHARDS = {"total": 1, "successful": 1, "failed": 0}
+
+    def __init__(self):
+        self._indices = {}
+        self._scrolls = {}
+        self._scroll_ids = itertools.count()
+        self._lock = threading.RLock()
+
+    # Routing
+
+    def handle(self, method, path, params, body):
+        """
+        :return (status, response) for a REST request:
+        """
+        parts = [part for part in path.split("?")[0].split("/") if part]
+        with self._lock:
+            try:
+                return self._route(method, parts, params, body)
+            except FakeElasticError as err:
+                return err.status, {"error": err.error, "status": err.status}
+
+    def _route(self, method, parts, params, body):
+        action = parts[-1] if parts else ""
+        if action == "_bulk":
+            return 200, self._bulk(body)
+        elif parts == ["_search", "scroll"]:
+            if method == "DELETE":
+                return 200, self._clear_scroll(body, params)
+            return self._scroll(body, params)
+        elif action == "_mget":
+            return 200, self._mget(parts[:-1], body, params)
+        elif action == "_count":
+            return 200, self._count(parts[:-1], body)
+        elif action == "_search":
+            return 200, self._search(parts[:-1], body, params)
+        elif action == "_refresh":
+            return 200, {"_shards": self.SHARDS}
+        elif action == "_settings":
+            return 200, self._settings(method, parts[0], body, params)
+        elif len(parts) == 1:
+            return self._index_request(method, parts[0], body)
+        elif len(parts) == 3:
+            return self._document_request(method, parts[0], parts[1], parts[2], body)
+        elif len(parts) == 4 and action == "_update":
+            return self._update(parts[0], parts[1], parts[2], body)
+        raise FakeElasticError(400, "Unsupported request %s /%s" % (method, "/".join(parts)))
+
+    # Indices
+
+    def _get_index(self, index, create=False):
+        if index not in self._indices:
+            if not create:
+                raise FakeElasticError(404, "index_not_found_exception")
+            self._indices[index] = {"docs": collections.OrderedDict(),
+                                    "settings": {"index": {"refresh_interval": "1s", "number_of_replicas": "1"}}}
+        return self._indices[index]
+
+    def _index_request(self, method, index, body):
+        if method == "DELETE":
+            self._get_index(index)
+            del self._indices[index]
+        elif method == "PUT":
+            if index in self._indices:
+                raise FakeElasticError(400, "index_already_exists_exception")
+            self._get_index(index, create=True)
+        elif method == "HEAD":
+            self._get_index(index)
+        else:
+            raise FakeElasticError(400, "Unsupported request %s /%s" % (method, index))
+        return 200, {"acknowledged": True}
+
+    def _settings(self, method, index, body, params):
+        settings = self._get_index(index, create=method == "PUT")["settings"]
+        if method == "PUT":
+            for key, value in self._flatten(body.get("index", body)).iteritems():
+                settings["index"][key[len("index."):] if key.startswith("index.") else key] = str(value)
+            return {"acknowledged": True}
+        if params.get("flat_settings") in (True, "true"):
+            return {index: {"settings": {"index." + key: value for key, value in settings["index"].iteritems()}}}
+        return {index: {"settings": settings}}
+
+    @classmethod
+    def _flatten(cls, data, prefix=""):
+        flat = {}
+        for key, value in data.iteritems():
+            if isinstance(value, dict):
+                flat.update(cls._flatten(value, prefix + key + "."))
+            else:
+                flat[prefix + key] = value
+        return flat
+
+    # Documents
+
+    def _hit(self, index, doc_type, doc_id, source, source_filter=True):
+        hit = {"_index": index, "_type": doc_type, "_id": doc_id, "_version": 1}
+        source = self._filter_source(source, source_filter)
+        if source is not None:
+            hit["_source"] = source
+        return hit
+
+    @staticmethod
+    def _filter_source(source, source_filter):
+        if source_filter is True or source_filter is None:
+            return source
+        if source_filter is False:
+            return None
+        if isinstance(source_filter, dict):
+            source_filter = source_filter.get("includes", source_filter.get("include", []))
+        if isinstance(source_filter, basestring):
+            source_filter = source_filter.split(",")
+        return {k: v for k, v in source.iteritems() if k in source_filter}
+
+    def _document_request(self, method, index, doc_type, doc_id, body):
+        if method in ("PUT", "POST"):
+            docs = self._get_index(index, create=True)["docs"]
+            created = (doc_type, doc_id) not in docs
+            docs[(doc_type, doc_id)] = body
+            return 201 if created else 200, dict(self._hit(index, doc_type, doc_id, None, False), created=created)
+        docs = self._get_index(index)["docs"]
+        if (doc_type, doc_id) not in docs:
+            return 404, {"_index": index, "_type": doc_type, "_id": doc_id, "found": False}
+        if method == "DELETE":
+            del docs[(doc_type, doc_id)]
+            return 200, dict(self._hit(index, doc_type, doc_id, None, False), found=True)
+        return 200, dict(self._hit(index, doc_type, doc_id, docs[(doc_type, doc_id)]), found=True)
+
+    def _update(self, index, doc_type, doc_id, body):
+        docs = self._get_index(index, create=True)["docs"]
+        if (doc_type, doc_id) in docs:
+            docs[(doc_type, doc_id)].update(body.get("doc", {}))
+        elif body.get("doc_as_upsert"):
+            docs[(doc_type, doc_id)] = body.get("doc", {})
+        elif "upsert" in body:
+            docs[(doc_type, doc_id)] = body["upsert"]
+        else:
+            raise FakeElasticError(404, "document_missing_exception")
+        return 200, self._hit(index, doc_type, doc_id, None, False)
+
+    def _bulk(self, body):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            op_type, meta = lines[i].items()[0]
+            i += 1
+            index, doc_type, doc_id = meta["_index"], meta["_type"], meta.get("_id")
+            source = None
+            if op_type != "delete":
+                source = lines[i]
+                i += 1
+            try:
+                if op_type == "delete":
+                    status, response = self._document_request("DELETE", index, doc_type, doc_id, None)
+                elif op_type == "update":
+                    status, response = self._update(index, doc_type, doc_id, source)
+                else:
+                    status, response = self._document_request("PUT", index, doc_type, doc_id, source)
+            except FakeElasticError as err:
+                status, response = err.status, {"error": err.error}
+            response = dict(response, _index=index, _type=doc_type, _id=doc_id, status=status)
+            errors = errors or not 200 <= status < 300
+            items.append({op_type: response})
+        return {"took": 1, "errors": errors, "items": items}
+
+    def _mget(self, parts, body, params):
+        index = parts[0] if len(parts) > 0 else None
+        doc_type = parts[1] if len(parts) > 1 else None
+        if "ids" in body:
+            requests = [{"_id": doc_id} for doc_id in body["ids"]]
+        else:
+            requests = body["docs"]
+        docs = []
+        for request in requests:
+            doc_index = request.get("_index", index)
+            doc_type_ = request.get("_type", doc_type)
+            source_filter = request.get("_source", params.get("_source", True))
+            stored = self._indices.get(doc_index, {"docs": {}})["docs"].get((doc_type_, request["_id"]))
+            if stored is None:
+                docs.append({"_index": doc_index, "_type": doc_type_, "_id": request["_id"], "found": False})
+            else:
+                docs.append(dict(self._hit(doc_index, doc_type_, request["_id"], stored, source_filter), found=True))
+        return {"docs": docs}
+
+    # Search
+
+    def _matching(self, parts, body):
+        index = self._get_index(parts[0])
+        doc_type = parts[1] if len(parts) > 1 else None
+        query = (body or {}).get("query", {"match_all": {}})
+        return [(key, source) for key, source in index["docs"].iteritems()
+                if (doc_type is None or key[0] == doc_type) and self.matches(query, key[1], source)]
+
+    def _count(self, parts, body):
+        return {"count": len(self._matching(parts, body)), "_shards": self.SHARDS}
+
+    def _search(self, parts, body, params):
+        body = body or {}
+        matching = self._matching(parts, body)
+        source_filter = body.get("_source", params.get("_source", True))
+        if isinstance(source_filter, basestring) and source_filter in ("true", "false"):
+            source_filter = source_filter == "true"
+        hits = [self._hit(parts[0], key[0], key[1], source, source_filter) for key, source in matching]
+        size = int(body.get("size", params.get("size", 10)))
+        start = int(body.get("from", params.get("from", 0)))
+        response = {"took": 1, "timed_out": False, "_shards": self.SHARDS,
+                    "hits": {"total": len(hits), "max_score": None, "hits": hits[start:start + size]}}
+        aggs = body.get("aggs", body.get("aggregations"))
+        if aggs:
+            response["aggregations"] = {name: self._aggregate(agg, [source for key, source in matching])
+                                        for name, agg in aggs.iteritems()}
+        if "scroll" in params:
+            scroll_id = "scroll_%d" % next(self._scroll_ids)
+            self._scrolls[scroll_id] = (hits[start + size:], size)
+            response["_scroll_id"] = scroll_id
+        return response
+
+    def _scroll(self, body, params):
+        scroll_id = params.get("scroll_id") or (body.get("scroll_id") if isinstance(body, dict) else body)
+        if scroll_id not in self._scrolls:
+            raise FakeElasticError(404, "search_context_missing_exception")
+        hits, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (hits[size:], size)
+        return 200, {"_scroll_id": scroll_id, "took": 1, "timed_out": False, "_shards": self.SHARDS,
+                     "hits": {"total": len(hits), "max_score": None, "hits": hits[:size]}}
+
+    def _clear_scroll(self, body, params):
+        scroll_ids = params.get("scroll_id") or (body.get("scroll_id") if isinstance(body, dict) else body)
+        if isinstance(scroll_ids, basestring):
+            scroll_ids = scroll_ids.split(",")
+        for scroll_id in scroll_ids or []:
+            self._scrolls.pop(scroll_id, None)
+        return {"succeeded": True}
+
+    @classmethod
+    def _aggregate(cls, agg, sources):
+        """
+        :return the result of a (basic) metrics or terms aggregation over the documents' sources:
+        """
+        (kind, clause), = agg.items()
+        values = []
+        for source in sources:
+            value = cls._field(source, clause["field"])
+            values += value if isinstance(value, list) else [] if value is None else [value]
+        if kind == "terms":
+            counts = collections.Counter(values)
+            buckets = sorted(counts.iteritems(), key=lambda (key, count): (-count, key))[:clause.get("size", 10)]
+            return {"doc_count_error_upper_bound": 0, "sum_other_doc_count": sum(counts.values()) - sum(
+                count for key, count in buckets), "buckets": [{"key": key, "doc_count": count} for key, count in buckets]}
+        elif kind == "sum":
+            return {"value": float(sum(values))}
+        elif kind == "avg":
+            return {"value": float(sum(values)) / len(values) if values else None}
+        elif kind == "min":
+            return {"value": float(min(values)) if values else None}
+        elif kind == "max":
+            return {"value": float(max(values)) if values else None}
+        elif kind == "value_count":
+            return {"value": len(values)}
+        raise FakeElasticError(400, "Unsupported aggregation %s" % kind)
+
+    # Queries
+
+    @staticmethod
+    def _field(source, field):
+        value = source
+        for part in field.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    @classmethod
+    def matches(cls, query, doc_id, source):
+        """
+        :return whether a document matches a (basic) query DSL clause:
+        """
+        (kind, clause), = query.items()
+        if kind == "match_all":
+            return True
+        elif kind == "ids":
+            return doc_id in clause["values"]
+        elif kind in ("term", "match"):
+            (field, value), = clause.items()
+            if isinstance(value, dict):
+                value = value.get("value", value.get("query"))
+            found = cls._field(source, field)
+            return found == value or (isinstance(found, list) and value in found)
+        elif kind == "terms":
+            (field, values), = clause.items()
+            return cls._field(source, field) in values
+        elif kind == "exists":
+            return cls._field(source, clause["field"]) is not None
+        elif kind == "range":
+            (field, bounds), = clause.items()
+            value = cls._field(source, field)
+            if value is None:
+                return False
+            return all(((op != "gt" or value > bound) and (op != "gte" or value >= bound) and
+                        (op != "lt" or value < bound) and (op != "lte" or value <= bound))
+                       for op, bound in bounds.iteritems())
+        elif kind == "bool":
+            def clauses(name):
+                found = clause.get(name, [])
+                return found if isinstance(found, list) else [found]
+            return (all(cls.matches(q, doc_id, source) for q in clauses("must") + clauses("filter")) and
+                    not any(cls.matches(q, doc_id, source) for q in clauses("must_not")) and
+                    (not clauses("should") or any(cls.matches(q, doc_id, source) for q in clauses("should"))))
+        raise FakeElasticError(400, "Unsupported query %s" % kind)
+
+
+class FakeElasticConnection(Connection):
+    """
+    An elasticsearch-py Connection served by a FakeElasticServer instead of HTTP.
+    """
+
+    def __init__(self, server=None, **kwargs):
+        """
+        :param server: the FakeElasticServer to serve requests, defaults to a new (empty) one
+        """
+        super(FakeElasticConnection, self).__init__(**kwargs)
+        self.server = server if server is not None else FakeElasticServer()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=()):
+        if body is not None and not url.rstrip("/").endswith("_bulk"):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                # Bare scroll ids
+                pass
+        status, response = self.server.handle(method, url, params or {}, body)
+        raw_data = json.dumps(response)
+        if not (200 <= status < 300) and status not in ignore:
+            self._raise_error(status, raw_data)
+        return status, {}, raw_data
@@ -1,4 +1,6 @@
 import unittest
+from elasticsearch.helpers import BulkIndexError
+from bulk_buffer import BulkBuffer
 from doc_dict import ElasticDocDict
 
 
@@ -27,6 +29,99 @@ class TestDocDict(unittest.TestCase):
         for k, v in d.iteritems():
             self.assertEqual(d[k], v)
 
+    def test_iteritems_pages(self):
+        for keys_mode in (ElasticDocDict.KEYS_MODE_DOCUMENT, ElasticDocDict.KEYS_MODE_INDEX):
+            d = ElasticDocDict("test", "TestDocDict", keys_mode=keys_mode)
+            d.delete_all()
+            for i in range(5):
+                d[str(i)] = {"i": i, "a.b": str(i)}
+            d["plain"] = 5
+            d._es.indices.refresh(index="test")
+            self.assertDictEqual(dict(d.iteritems(page_size=2)),
+                                 dict({str(i): {"i": i, "a.b": str(i)} for i in range(5)}, plain=5))
+            self.assertItemsEqual(d.itervalues(page_size=2, source=["i"]), [{"i": i} for i in range(5)] + [5])
+            d.delete_all()
+
+    def test_get_many(self):
+        d = ElasticDocDict("test", "TestDocDict")
+        d.delete_all()
+        d["1"] = 1
+        d["2"] = {"a.b": 2, "c": 3}
+        self.assertDictEqual(d.get_many(["1", "2", "3"]), {"1": 1, "2": {"a.b": 2, "c": 3}, "3": None})
+        self.assertDictEqual(d.get_many(["1", "2"], source=["a.b"]), {"1": 1, "2": {"a.b": 2}})
+        self.assertDictEqual(d.get_many([]), {})
+
+    def test_bulk_mode(self):
+        d = ElasticDocDict("test", "TestDocDict")
+        d.delete_all()
+        with d.bulk_mode(max_actions=5, workers=2):
+            for i in range(20):
+                d[str(i % 10)] = i
+            d.upsert("x", {"a": 1})
+            d.upsert("x", {"b": 2})
+            del d["9"]
+        self.assertEqual(d["0"], 10)
+        self.assertDictEqual(d["x"], {"a": 1, "b": 2})
+        self.assertItemsEqual(d.keys(), [str(i) for i in range(9)] + ["x"])
+
+    def test_bulk_mode_tune_index(self):
+        d = ElasticDocDict("test", "TestDocDict", refresh=ElasticDocDict.REFRESH_TRUE)
+        d.delete_all()
+        settings = d._es.indices.get_settings(index="test", flat_settings=True)["test"]["settings"]
+        with d.bulk_mode(tune_index=True):
+            tuned = d._es.indices.get_settings(index="test", flat_settings=True)["test"]["settings"]
+            self.assertEqual(tuned["index.refresh_interval"], "-1")
+            self.assertEqual(tuned["index.number_of_replicas"], "0")
+            d["1"] = 1
+        restored = d._es.indices.get_settings(index="test", flat_settings=True)["test"]["settings"]
+        self.assertEqual(restored["index.refresh_interval"], settings.get("index.refresh_interval", "1s"))
+        self.assertEqual(restored["index.number_of_replicas"], settings["index.number_of_replicas"])
+        d.set("2", 2, refresh=ElasticDocDict.REFRESH_FALSE)
+        d.upsert("3", {"a": 1})
+        self.assertEqual(d["1"], 1)
+        d.delete_all()
+
+    def test_where(self):
+        d = ElasticDocDict("test", "TestDocDict")
+        d.delete_all()
+        for i in range(10):
+            d[str(i)] = {"i": i, "color": "red" if i % 2 else "blue", "a.b": i * 10}
+        d["plain"] = 5
+        d.refresh()
+        red = d.where(color="red")
+        self.assertEqual(red.count(), 5)
+        self.assertItemsEqual(red.keys(), ["1", "3", "5", "7", "9"])
+        self.assertEqual(red["1"]["i"], 1)
+        self.assertNotIn("2", red)
+        with self.assertRaises(KeyError):
+            red["2"]
+        view = red.where(range={"a.b": {"gte": 50}})
+        self.assertDictEqual(dict(view.iteritems(source=["i"])), {"5": {"i": 5}, "7": {"i": 7}, "9": {"i": 9}})
+        self.assertEqual(view.sum("i"), 21)
+        self.assertEqual(view.avg("a.b"), 70)
+        self.assertEqual(d.where(i=[1, 2]).max("i"), 2)
+        self.assertEqual(d.where(range={None: {"gt": 1}}).values(), [5])
+        self.assertEqual(d.where(range={"i": {"lt": 5}}).terms("color"), [("blue", 3), ("red", 2)])
+        d.delete_all()
+
+    def test_bulk_buffer(self):
+        d = ElasticDocDict("test", "TestDocDict")
+        d.delete_all()
+        buf = BulkBuffer(d._es, max_age=None)
+        action = {"_index": "test", "_type": "TestDocDict", "_id": "1"}
+        buf.add(dict(action, _source={"a": 1}))
+        buf.add(dict(action, _op_type="update", doc={"b": {"c": 1}}))
+        buf.add(dict(action, _op_type="update", doc={"b": {"d": 2}}))
+        buf.add(dict(action, _id="missing", _op_type="update", doc={"a": 1}))
+        self.assertEqual(buf.stats()["coalesced"], 2)
+        failures = buf.close()
+        self.assertEqual([failure["update"]["_id"] for failure in failures], ["missing"])
+        self.assertDictEqual(d["1"], {"a": 1, "b": {"c": 1, "d": 2}})
+        with self.assertRaises(BulkIndexError):
+            with d:
+                d._bulk_add_commands([dict(action, _id="missing", _op_type="update", doc={"a": 1})])
+        d.delete_all()
+
     def test_iterkeys(self):
         d = ElasticDocDict("test", "TestDocDict")
         d.delete_all()
@@ -51,6 +146,23 @@ class TestDocDict(unittest.TestCase):
             count -= 1
             self.assertEqual(count, len(d))
 
+    def test_index_keys_mode(self):
+        d = ElasticDocDict("test", "TestDocDict")
+        d.delete_all()
+        d["1"] = 1
+        d["2"] = 2
+        d.migrate_to_index_keys()
+        d["3"] = 3
+        d._es.indices.refresh(index="test")
+        self.assertEqual(len(d), 3)
+        self.assertItemsEqual(d.keys(), ["1", "2", "3"])
+        del d["1"]
+        d._es.indices.refresh(index="test")
+        self.assertItemsEqual(d.keys(), ["2", "3"])
+        d.migrate_to_document_keys()
+        self.assertItemsEqual(d.keys(), ["2", "3"])
+        self.assertEqual(len(d), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
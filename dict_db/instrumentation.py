@@ -0,0 +1,425 @@
+"""
+Instrumentation of the data-structures- per-method call counts, round trips, bytes serialized and deserialized,
+serialization time and latency histograms, e.g.:
+
+    from dict_db import instrumentation
+    registry = instrumentation.enable()
+    ...
+    registry.snapshot()["JSONRedisHashDict.get_many"]
+    instrumentation.disable()
+
+enable wraps the methods of the data-structures (of every loaded copy of their modules, e.g. redis_hash_dict imported
+both as redis_ds.redis_hash_dict and as a top-level module), the round trips of the redis and elasticsearch clients,
+and the serializers; disable restores the original methods, so a disabled instrumentation costs nothing.
+Only the outermost call of a thread is recorded- the round trips and serialization of the calls it makes
+(e.g. update calling set_many) are attributed to it. Generators (iteritems...) record the time spent producing
+their items, and are recorded once exhausted or closed.
+
+Every recorded call is passed to the hooks as a CallRecord. The default hook is a MetricsRegistry, whose stats
+a MetricsExporter writes periodically from long-running processes, e.g. a QueueApi worker:
+
+    with instrumentation.MetricsExporter({"structures": registry.snapshot, "dispatcher": dispatcher.metrics},
+                                         interval=60, path="/var/log/api_metrics.jsonl"):
+        api.run(dispatcher)
+
+Each process records its own calls- a forked QueueDispatcher worker inherits the hooks, but not the exporter thread.
+"""
+__author__ = 'OrW'
+
+import collections
+import functools
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from timeit import default_timer
+
+# The classes whose methods are instrumented, by module. Subclasses inherit the instrumented methods.
+REDIS_CLASSES = {
+    "redis_hash_dict": ("RedisHashDict", "JSONMergeMixin", "ExpirableRedisHashDict"),
+    "redis_dict": ("RedisDict",),
+    "redis_path_dict": ("RedisPathDict",),
+    "redis_list": ("RedisList",),
+    "redis_set": ("RedisSet",),
+    "redis_shard": ("ShardedRedisHashDict",),
+    "redis_cache": ("CachedRedisHashDict", "CachedRedisDict"),
+    "message_queue": ("MessageQueue", "StreamMessageQueue"),
+}
+REDIS_SERIALIZERS = ("PassThroughSerializer", "PickleSerializer", "JSONSerializer", "CodecSerializer")
+ELASTIC_CLASSES = {
+    "doc_dict": ("ElasticDocDict", "DocDictView"),
+}
+# Special methods instrumented along with the public ones
+SPECIAL_METHODS = ("__getitem__", "__setitem__", "__delitem__", "__contains__", "__len__", "__iter__")
+SERIALIZATION_METHODS = ("serialize", "deserialize")
+
+# The package the data-structure modules are imported from
+_PREFIX = __name__.rpartition(".")[0] + "." if "." in __name__ else ""
+
+
+class _Local(threading.local):
+    # The calling thread's outermost instrumented call
+    call = None
+
+
+_local = _Local()
+_hooks = []
+_patched = []
+_patch_lock = threading.Lock()
+
+
+class CallRecord(object):
+    """
+    A recorded call of a data-structure's method.
+    """
+
+    __slots__ = ("name", "latency", "error", "round_trips", "bytes_serialized", "bytes_deserialized",
+                 "serialization_time", "serializing")
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = 0.0
+        self.error = False
+        self.round_trips = 0
+        self.bytes_serialized = 0
+        self.bytes_deserialized = 0
+        self.serialization_time = 0.0
+        self.serializing = False
+
+
+class MethodStats(object):
+    """
+    Aggregated calls of a single method. Latencies are kept in a histogram of power of 2 microsecond buckets.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.round_trips = 0
+        self.bytes_serialized = 0
+        self.bytes_deserialized = 0
+        self.serialization_time = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = {}
+
+    def record(self, call):
+        self.calls += 1
+        if call.error:
+            self.errors += 1
+        self.round_trips += call.round_trips
+        self.bytes_serialized += call.bytes_serialized
+        self.bytes_deserialized += call.bytes_deserialized
+        self.serialization_time += call.serialization_time
+        latency = call.latency
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+        bucket = 1 << int(latency * 1e6).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        """
+        :return the upper bound (seconds) of the histogram bucket holding the percentile:
+        """
+        rank = self.calls * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return bucket / 1e6
+        return 0.0
+
+    def as_dict(self):
+        return {"calls": self.calls, "errors": self.errors, "round_trips": self.round_trips,
+                "bytes_serialized": self.bytes_serialized, "bytes_deserialized": self.bytes_deserialized,
+                "serialization_time": self.serialization_time,
+                "mean_latency": self.total_latency / self.calls if self.calls else 0.0,
+                "max_latency": self.max_latency, "p50_latency": self.percentile(50),
+                "p90_latency": self.percentile(90), "p99_latency": self.percentile(99),
+                "histogram_usec": dict(self.histogram)}
+
+
+class MetricsRegistry(object):
+    """
+    A hook aggregating the recorded calls per method ("<class name>.<method name>").
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(MethodStats)
+
+    def __call__(self, call):
+        with self._lock:
+            self._stats[call.name].record(call)
+
+    def snapshot(self, reset=False):
+        """
+        :param reset: start counting from scratch
+        :return a dict of method names to their calls, errors, round trips, bytes serialized and deserialized,
+            serialization time, latencies (seconds) and latency histogram:
+        """
+        with self._lock:
+            snapshot = {name: method_stats.as_dict() for name, method_stats in self._stats.iteritems()}
+            if reset:
+                self._stats = collections.defaultdict(MethodStats)
+        return snapshot
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Writes metrics as JSON lines every interval seconds, and once more when stopped.
+    """
+
+    def __init__(self, sources, interval=60, path=None, logger=None):
+        """
+        :param sources: a MetricsRegistry, or a dict of names to callables returning JSON serializable metrics
+        :param interval: seconds between exports
+        :param path: a file the lines are appended to, None to log them
+        :param logger: the logger of the lines, defaults to this module's logger
+        """
+        super(MetricsExporter, self).__init__(name="MetricsExporter")
+        self.daemon = True
+        if isinstance(sources, MetricsRegistry):
+            sources = {"metrics": sources.snapshot}
+        self._sources = sources
+        self._interval = interval
+        self._path = path
+        self._logger = logger or logging.getLogger(__name__)
+        self._stopped = threading.Event()
+
+    def export(self):
+        line = {"time": time.time(), "pid": os.getpid()}
+        for name, source in self._sources.iteritems():
+            line[name] = source()
+        line = json.dumps(line)
+        if self._path is not None:
+            with open(self._path, "a") as output:
+                output.write(line + "\n")
+        else:
+            self._logger.info(line)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.export()
+            except Exception:
+                self._logger.exception("Failed to export metrics")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.export()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def current_call():
+    """
+    :return the CallRecord of the calling thread's outermost instrumented call, None outside of one:
+    """
+    return _local.call
+
+
+def _emit(call):
+    for hook in _hooks:
+        try:
+            hook(call)
+        except Exception:
+            logging.exception("Instrumentation hook failed")
+
+
+def _instrument_method(func, method_name):
+    # The recorded names of the method, by the class of the instance
+    names = {}
+
+    def call_name(instance):
+        cls = type(instance)
+        name = names.get(cls)
+        if name is None:
+            name = names[cls] = "%s.%s" % (cls.__name__, method_name)
+        return name
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(self, *args, **kwargs):
+            if _local.call is not None:
+                return func(self, *args, **kwargs)
+            return _iterate(CallRecord(call_name(self)), func(self, *args, **kwargs))
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if _local.call is not None:
+            return func(self, *args, **kwargs)
+        call = _local.call = CallRecord(call_name(self))
+        start = default_timer()
+        try:
+            return func(self, *args, **kwargs)
+        except Exception:
+            call.error = True
+            raise
+        finally:
+            call.latency = default_timer() - start
+            _local.call = None
+            _emit(call)
+    return wrapper
+
+
+def _iterate(call, generator):
+    """
+    Iterate a generator, recording the time spent producing its items as a call
+    """
+    try:
+        while True:
+            previous, _local.call = _local.call, call
+            start = default_timer()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception:
+                call.error = True
+                raise
+            finally:
+                call.latency += default_timer() - start
+                _local.call = previous
+            yield item
+    finally:
+        _emit(call)
+
+
+def _instrument_serialization(func, counter, measure_output):
+    """
+    :param counter: the CallRecord field counting the bytes
+    :param measure_output: count the bytes of the result (serializing), rather than of the argument (deserializing)
+    """
+    @functools.wraps(func)
+    def wrapper(self, data, *args, **kwargs):
+        call = _local.call
+        if call is None or call.serializing:
+            return func(self, data, *args, **kwargs)
+        call.serializing = True
+        start = default_timer()
+        try:
+            result = func(self, data, *args, **kwargs)
+        finally:
+            call.serialization_time += default_timer() - start
+            call.serializing = False
+        measured = result if measure_output else data
+        if isinstance(measured, basestring):
+            setattr(call, counter, getattr(call, counter) + len(measured))
+        return result
+    return wrapper
+
+
+def _instrument_round_trip(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call = _local.call
+        if call is not None:
+            call.round_trips += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def _patch(owner, name, wrapper):
+    _patched.append((owner, name, owner.__dict__[name]))
+    setattr(owner, name, wrapper)
+
+
+def _modules(package, module_name):
+    """
+    A module may be loaded under several names, e.g. redis_hash_dict, redis_ds.redis_hash_dict and
+    dict_db.redis_ds.redis_hash_dict, each with classes of its own, depending on sys.path.
+    :return the module imported from this package, and the other loaded copies of it:
+    """
+    modules = [importlib.import_module("%s%s.%s" % (_PREFIX, package, module_name))]
+    for name, module in sys.modules.items():
+        if module is not None and module not in modules and \
+                (name == module_name or name.endswith("%s.%s" % (package, module_name))):
+            modules.append(module)
+    return modules
+
+
+def _instrument_classes(package, module_name, class_names):
+    for module in _modules(package, module_name):
+        for class_name in class_names:
+            cls = getattr(module, class_name, None)
+            if inspect.isclass(cls):
+                _instrument_class(cls)
+
+
+def _instrument_class(cls):
+    for name, func in cls.__dict__.items():
+        if not inspect.isfunction(func):
+            continue
+        if name in SERIALIZATION_METHODS:
+            _patch(cls, name, _instrument_serialization(func, "bytes_" + name + "d", name == "serialize"))
+        elif not name.startswith("_") or name in SPECIAL_METHODS:
+            _patch(cls, name, _instrument_method(func, name))
+
+
+def _instrument_redis():
+    from redis.client import StrictRedis, BasePipeline
+    _patch(StrictRedis, "execute_command", _instrument_round_trip(StrictRedis.__dict__["execute_command"]))
+    _patch(BasePipeline, "execute", _instrument_round_trip(BasePipeline.__dict__["execute"]))
+    for module_name, class_names in REDIS_CLASSES.iteritems():
+        _instrument_classes("redis_ds", module_name, class_names)
+    _instrument_classes("redis_ds", "serialization", REDIS_SERIALIZERS)
+
+
+def _instrument_elastic():
+    from elasticsearch.serializer import JSONSerializer
+    from elasticsearch.transport import Transport
+    _patch(Transport, "perform_request", _instrument_round_trip(Transport.__dict__["perform_request"]))
+    _patch(JSONSerializer, "dumps", _instrument_serialization(JSONSerializer.__dict__["dumps"],
+                                                              "bytes_serialized", True))
+    _patch(JSONSerializer, "loads", _instrument_serialization(JSONSerializer.__dict__["loads"],
+                                                              "bytes_deserialized", False))
+    for module_name, class_names in ELASTIC_CLASSES.iteritems():
+        _instrument_classes("elastic_ds", module_name, class_names)
+
+
+def enable(*hooks):
+    """
+    Instrument the data-structures of the installed backends
+    :param hooks: callables called with the CallRecord of every recorded call, defaults to a new MetricsRegistry
+    :return the first hook:
+    """
+    with _patch_lock:
+        if not _patched:
+            for instrument in (_instrument_redis, _instrument_elastic):
+                try:
+                    instrument()
+                except ImportError, err:
+                    logging.info("Backend not instrumented- %s" % err)
+        if not hooks:
+            hooks = (MetricsRegistry(),)
+        _hooks.extend(hooks)
+    return hooks[0]
+
+
+def disable():
+    """Restore the original methods, and remove the hooks."""
+    with _patch_lock:
+        while _patched:
+            owner, name, original = _patched.pop()
+            setattr(owner, name, original)
+        del _hooks[:]
+
+
+def is_enabled():
+    return bool(_patched)
@@ -5,4 +5,5 @@ based on a fork of: https://github.com/lethain/Redis-Python-Datastructures
 __version__ = '1.1'
 
 __all__ = ["redis_config", "redis_dict", "redis_hash_dict",
-           "redis_list", "redis_path_dict", "redis_set", "message_queue"]
+           "redis_list", "redis_path_dict", "redis_set", "message_queue", "redis_cache", "redis_async",
+           "queue_dispatcher", "redis_shard"]
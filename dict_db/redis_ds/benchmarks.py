@@ -0,0 +1,70 @@
+"Micro-benchmarks for redis datastructures."
+import sys
+import os
+import timeit
+
+from redis import Redis
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+import redis_config
+import redis_pipe
+from redis_hash_dict import RedisHashDict
+
+
+class GetattributeRedisPipe(redis_pipe.RedisPipe):
+    """
+    The former RedisPipe dispatch, delegating every attribute lookup - kept for comparison.
+    """
+
+    def __getattribute__(self, name):
+        local = super(GetattributeRedisPipe, self).__getattribute__("_local")
+        if name == "_local":
+            return local
+        current_pipe = getattr(local, "pipe", None)
+        if current_pipe is not None:
+            return getattr(current_pipe, name)
+        else:
+            return super(GetattributeRedisPipe, self).__getattribute__(name)
+
+
+CLIENT_CLASSES = (Redis, redis_pipe.RedisPipe, GetattributeRedisPipe, redis_config.LazyClient)
+
+
+def bench_attribute_lookup(number=1000000, repeat=3):
+    """
+    Time looking up a command method on each client class (no server needed)
+    :return a dict of class name to the best seconds per lookup:
+    """
+    results = {}
+    for client_class in CLIENT_CLASSES:
+        client = client_class()
+        timings = timeit.repeat(lambda: client.hget, number=number, repeat=repeat)
+        results[client_class.__name__] = min(timings) / number
+    return results
+
+
+def bench_hash_dict_get(number=10000, repeat=3, hash_key="bench_rds.hash_dict"):
+    """
+    Time RedisHashDict.get against a live server with each client class
+    :return a dict of class name to the best seconds per get:
+    """
+    results = {}
+    for client_class in CLIENT_CLASSES:
+        rhd = RedisHashDict(hash_key, redis_client=client_class())
+        rhd["key"] = "value"
+        timings = timeit.repeat(lambda: rhd.get("key"), number=number, repeat=repeat)
+        results[client_class.__name__] = min(timings) / number
+        rhd.delete_all()
+    return results
+
+
+def print_results(title, results):
+    print title
+    for name, seconds in sorted(results.items(), key=lambda item: item[1]):
+        print "    %-24s %10.3f usec" % (name, seconds * 1e6)
+
+
+if __name__ == '__main__':
+    print_results("Attribute lookup", bench_attribute_lookup())
+    print_results("RedisHashDict.get", bench_hash_dict_get())
@@ -1,11 +1,17 @@
+import collections
 import logging
+import os
+import socket
+import uuid
 from collections import Callable
 
 __author__ = 'OrW'
 
+from redis import ResponseError
+
 import redis_pipe
 
-from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer
+from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer, CodecSerializer
 import time
 
 
@@ -21,13 +27,36 @@ class MessageQueue(PassThroughSerializer):
         self._received_subscription = False
 
     def write(self, message, wait_for_readers = True):
-        for channel in self._channels:
-            received = 0
-            while received == 0:
-                received = self._redis_client.publish(channel, self.serialize(message))
-                if not wait_for_readers:
-                    received = 1
-                time.sleep(0)
+        self.write_many([message], wait_for_readers=wait_for_readers)
+
+    def write_many(self, messages, wait_for_readers=True):
+        """
+        Publish messages to all the channels in a single round trip, serializing each message once
+        :param messages: a list of messages, published to every channel in order
+        :param wait_for_readers: republish, in order, from the first message of each channel that reached no
+            reader, until they all do
+        :return a dict of channel -> the number of readers that received each message:
+        """
+        serialized = [self.serialize(message) for message in messages]
+        received = {channel: [0] * len(serialized) for channel in self._channels}
+        # channel -> the index of the first message to (re)publish
+        unreceived = {channel: 0 for channel in self._channels} if serialized else {}
+        while unreceived:
+            pipe = self._redis_client.pipeline(transaction=False)
+            published = [(channel, i) for i in xrange(min(unreceived.itervalues()), len(serialized))
+                         for channel in self._channels if unreceived.get(channel, len(serialized)) <= i]
+            for channel, i in published:
+                pipe.publish(channel, serialized[i])
+            counts = pipe.execute()
+            unreceived = {}
+            for (channel, i), count in zip(published, counts):
+                received[channel][i] = count
+                if count == 0 and channel not in unreceived:
+                    unreceived[channel] = i
+            if not wait_for_readers:
+                break
+            time.sleep(0)
+        return received
 
     def read(self, block=True, accept_old_messages=False):
         """
@@ -73,6 +102,262 @@ class JSONMessageQueue(MessageQueue, JSONSerializer):
     pass
 
 
+class CodecMessageQueue(MessageQueue, CodecSerializer):
+    """Serialize messages using a Codec."""
+    pass
+
+
+class StreamMessageQueue(PassThroughSerializer):
+    """
+    A message queue over Redis Streams, with the write/read/with API of MessageQueue.
+    Unlike pub/sub, messages are kept in the streams until read, so they are not lost when no reader is connected.
+    Readers sharing a group split the messages between them (each message is read by one reader of the group),
+    reads fetch up to `count` messages per round trip and block on the server instead of polling.
+    Messages returned by read are acknowledged along with the next fetch, or on leaving the with block.
+    Messages that were fetched but not acknowledged are re-read on entering the with block with the same consumer name.
+    Messages left pending by other readers for min_idle_time (readers that died- a restarted reader gets a new
+    default consumer name) are claimed and re-read, so they're processed at least once.
+    """
+
+    MESSAGE_FIELD = "m"
+    DEFAULT_GROUP = "dict_db"
+
+    StreamEntry = collections.namedtuple("StreamEntry", ["stream", "id", "message"])
+
+    def __init__(self, streams, redis_client=None, group=DEFAULT_GROUP, consumer=None,
+                 max_len=100000, count=100, block_timeout=1000, min_idle_time=300000):
+        """
+        :param streams: list of stream keys written to / read from
+        :param group: the consumer group of the reader
+        :param consumer: unique name of the reader within its group, defaults to host:pid:random
+        :param max_len: approximate cap of each stream's length, None for unbounded streams
+        :param count: maximal number of messages fetched per round trip
+        :param block_timeout: milliseconds a single fetch blocks on the server, capped at half the client's
+            socket_timeout- a fetch blocking longer would fail with a socket timeout
+        :param min_idle_time: milliseconds a message stays pending with another reader of the group before this
+            reader claims it, checked on entering the with block and every min_idle_time while reading.
+            None to never claim messages. Keep it well above the time it takes to process a fetch of messages.
+        """
+        assert isinstance(streams, list)
+        self._redis_client = redis_client or redis_pipe.RedisPipe()
+        self._streams = streams
+        self._group = group
+        self._consumer = consumer or "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._max_len = max_len
+        self._count = count
+        self._block_timeout = block_timeout
+        self._min_idle_time = min_idle_time
+        self._next_claim = 0
+        self._buffer = collections.deque()
+        self._pending_acks = []
+        self._is_in_read_mode = False
+        self._recovering = False
+        self._recovered_ids = {}
+
+    @property
+    def consumer(self):
+        return self._consumer
+
+    def _max_block_timeout(self):
+        socket_timeout = self._redis_client.connection_pool.connection_kwargs.get("socket_timeout")
+        if socket_timeout is None:
+            return self._block_timeout
+        return max(min(self._block_timeout, int(socket_timeout * 500)), 1)
+
+    def _xadd_args(self, stream, message):
+        args = ["XADD", stream]
+        if self._max_len is not None:
+            args += ["MAXLEN", "~", self._max_len]
+        return args + ["*", self.MESSAGE_FIELD, self.serialize(message)]
+
+    def write(self, message, wait_for_readers=True):
+        """
+        :param message: the message to add to every stream
+        :param wait_for_readers: ignored- messages wait in the streams until read
+        :return the ids of the added messages:
+        """
+        return self.write_many([message])
+
+    def write_many(self, messages):
+        """
+        Add many messages to every stream in a single round trip
+        :param messages: an iterable of messages
+        :return the ids of the added messages:
+        """
+        pipe = self._redis_client.pipeline(transaction=False)
+        for message in messages:
+            for stream in self._streams:
+                pipe.execute_command(*self._xadd_args(stream, message))
+        return pipe.execute()
+
+    @staticmethod
+    def _next_id(entry_id):
+        milliseconds, sequence = entry_id.split("-")
+        return "%s-%d" % (milliseconds, int(sequence) + 1)
+
+    def claim_idle(self):
+        """
+        Claim the messages pending with other readers of the group for min_idle_time,
+        paging through the pending lists until they're exhausted. Claimed messages stay pending until acknowledged.
+        :return a list of the claimed StreamEntries:
+        """
+        entries = []
+        for stream in self._streams:
+            start = "-"
+            while True:
+                pending = self._redis_client.execute_command("XPENDING", stream, self._group, start, "+", self._count)
+                idle_ids = [entry_id for entry_id, consumer, idle_time, deliveries in pending
+                            if consumer != self._consumer and idle_time >= self._min_idle_time]
+                if idle_ids:
+                    claimed = self._redis_client.execute_command("XCLAIM", stream, self._group, self._consumer,
+                                                                 self._min_idle_time, *idle_ids)
+                    entries += self._parse_entries(stream, claimed)
+                if len(pending) < self._count:
+                    break
+                start = self._next_id(pending[-1][0])
+        return entries
+
+    def _parse_entries(self, stream, stream_entries):
+        """
+        :return the StreamEntries of a reply's entries- entries trimmed out of the stream while pending are
+            acknowledged along with the next fetch:
+        """
+        entries = []
+        for stream_entry in stream_entries:
+            if not stream_entry:
+                continue
+            entry_id, fields = stream_entry
+            entry = self.StreamEntry(stream, entry_id, None)
+            if fields:
+                entries.append(entry._replace(message=self.deserialize(self._message_data(fields))))
+            else:
+                self._pending_acks.append(entry)
+        return entries
+
+    def read_entries(self, block=True, timeout=None, count=None):
+        """
+        Fetch the next messages of the group in a single round trip. Fetched entries are not acknowledged-
+        they stay pending until passed to ack.
+        :param block: wait for messages to arrive
+        :param timeout: seconds to wait for messages, None to wait until any arrive
+        :param count: maximal number of messages, defaults to the queue's count
+        :return a list of StreamEntries, empty if none arrived:
+        """
+        assert self._is_in_read_mode
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if not self._recovering and self._min_idle_time is not None and time.time() >= self._next_claim:
+                self._next_claim = time.time() + self._min_idle_time / 1000.0
+                entries = self.claim_idle()
+                if entries:
+                    return entries
+            args = ["XREADGROUP", "GROUP", self._group, self._consumer, "COUNT", count or self._count]
+            if self._recovering:
+                # Re-read messages fetched but never acknowledged by a former reader of the same consumer name
+                start_ids = [self._recovered_ids.get(stream, "0") for stream in self._streams]
+            else:
+                start_ids = [">"] * len(self._streams)
+                if block:
+                    block_timeout = self._max_block_timeout()
+                    if deadline is not None:
+                        block_timeout = min(block_timeout, max(int((deadline - time.time()) * 1000), 1))
+                    args += ["BLOCK", block_timeout]
+            args += ["STREAMS"] + self._streams + start_ids
+            pipe = self._redis_client.pipeline(transaction=False)
+            self._pipe_ack(pipe, self._pending_acks)
+            self._pending_acks = []
+            pipe.execute_command(*args)
+            entries = []
+            fetched = False
+            for stream, stream_entries in pipe.execute()[-1] or []:
+                if stream_entries:
+                    fetched = True
+                    if self._recovering:
+                        self._recovered_ids[stream] = stream_entries[-1][0]
+                entries += self._parse_entries(stream, stream_entries)
+            if self._recovering and not fetched:
+                # Page through the pending entries until none are left- a page may hold trimmed entries only
+                self._recovering = False
+                continue
+            if entries or not block or (deadline is not None and time.time() >= deadline):
+                return entries
+
+    def _message_data(self, fields):
+        fields = dict(zip(fields[::2], fields[1::2]))
+        return fields.get(self.MESSAGE_FIELD)
+
+    def read(self, block=True, timeout=None):
+        """
+        :param block: wait until a message is received
+        :param timeout: seconds to wait for a message, None to wait until one arrives
+        :return the received message, None if none arrived:
+        """
+        if not self._buffer:
+            self._buffer.extend(self.read_entries(block=block, timeout=timeout))
+        if not self._buffer:
+            return None
+        entry = self._buffer.popleft()
+        self._pending_acks.append(entry)
+        return entry.message
+
+    def _pipe_ack(self, pipe, entries):
+        ids_by_stream = collections.defaultdict(list)
+        for entry in entries:
+            ids_by_stream[entry.stream].append(entry.id)
+        for stream, ids in ids_by_stream.iteritems():
+            pipe.execute_command("XACK", stream, self._group, *ids)
+
+    def ack(self, entries):
+        """
+        Acknowledge the processing of entries returned by read_entries, in a single round trip
+        :param entries: a list of StreamEntries
+        """
+        if entries:
+            pipe = self._redis_client.pipeline(transaction=False)
+            self._pipe_ack(pipe, entries)
+            pipe.execute()
+
+    def __enter__(self):
+        for stream in self._streams:
+            try:
+                # New groups start at the stream's end, existing groups resume where they stopped
+                self._redis_client.execute_command("XGROUP", "CREATE", stream, self._group, "$", "MKSTREAM")
+            except ResponseError, err:
+                if "BUSYGROUP" not in str(err):
+                    raise
+        self._is_in_read_mode = True
+        self._recovering = True
+        self._recovered_ids = {}
+        self._next_claim = 0
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.ack(self._pending_acks)
+        self._pending_acks = []
+        # Messages fetched but not read stay pending, and are re-read by the next reader of this consumer name
+        self._buffer.clear()
+        self._is_in_read_mode = False
+
+    def delete(self):
+        """Delete the streams, along with their groups."""
+        self._redis_client.delete(*self._streams)
+
+
+class PickleStreamMessageQueue(StreamMessageQueue, PickleSerializer):
+    """Serialize messages using pickle."""
+    pass
+
+
+class JSONStreamMessageQueue(StreamMessageQueue, JSONSerializer):
+    """Serialize messages using JSON."""
+    pass
+
+
+class CodecStreamMessageQueue(StreamMessageQueue, CodecSerializer):
+    """Serialize messages using a Codec."""
+    pass
+
+
 class QueueApi(JSONMessageQueue):
 
     METHOD_NAME_KEY = '$name'
@@ -80,16 +365,32 @@ class QueueApi(JSONMessageQueue):
     def __init__(self, channels):
         super(QueueApi, self).__init__(channels)
 
-    def run(self):
+    def run(self, dispatcher=None):
+        """
+        Read and call incoming messages forever
+        :param dispatcher: a QueueDispatcher running the calls concurrently, None to call them one by one
+        """
         with self:
             while True:
                 msg = self.read()
-                try:
-                    self.message_to_call(msg)
-                except AssertionError:
-                    logging.exception("Incoming message is malformed- %s" % msg)
-                except KeyError:
-                    logging.exception("Failed to execute incoming message- %s" % msg)
+                if dispatcher is None:
+                    self.call_message(msg)
+                else:
+                    dispatcher.dispatch(msg)
+
+    def call_message(self, msg):
+        """
+        Call the method a message maps to, logging failures
+        :return whether the call succeeded:
+        """
+        try:
+            self.message_to_call(msg)
+            return True
+        except AssertionError:
+            logging.exception("Incoming message is malformed- %s" % msg)
+        except KeyError:
+            logging.exception("Failed to execute incoming message- %s" % msg)
+        return False
 
     def message_to_call(self, msg):
         assert isinstance(msg, dict)
@@ -0,0 +1,252 @@
+"""
+Concurrent dispatch of QueueApi messages.
+The reading loop hands each message to a QueueDispatcher, which runs it on a thread or process pool, e.g.:
+
+    api = MyApi(["channel"])
+    with QueueDispatcher(api, workers=8, executor=QueueDispatcher.EXECUTOR_PROCESS,
+                         method_limits={"reindex": 1}, order_key="user_id") as dispatcher:
+        api.run(dispatcher)
+"""
+__author__ = 'OrW'
+
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
+# The api called by process pool workers, set in each worker by _init_process_worker
+_worker_api = None
+
+
+def _init_process_worker(api):
+    global _worker_api
+    _worker_api = api
+
+
+def _timed_call(api, msg):
+    """
+    :return the time the call took, and whether it succeeded:
+    """
+    start = default_timer()
+    try:
+        succeeded = api.call_message(msg)
+    except Exception:
+        # Unlike a failing synchronous call, a failing dispatched call must not stop the reading loop
+        logging.exception("Incoming message failed- %s" % msg)
+        succeeded = False
+    return default_timer() - start, succeeded
+
+
+def _process_call(msg):
+    return _timed_call(_worker_api, msg)
+
+
+class MethodMetrics(object):
+    """
+    Call counters and latencies of a single api method.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.running = 0
+        self.waiting = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency, succeeded):
+        self.calls += 1
+        if not succeeded:
+            self.errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        return {"calls": self.calls, "errors": self.errors, "running": self.running, "waiting": self.waiting,
+                "mean_latency": self.total_latency / self.calls if self.calls else 0.0,
+                "max_latency": self.max_latency}
+
+
+class QueueDispatcher(object):
+    """
+    Runs the messages of a QueueApi concurrently on a pool of workers.
+    - max_in_flight bounds the messages submitted to the pool (running, or queued for a worker)- dispatch blocks
+      once it is reached, so the reading loop stops pulling messages faster than they are handled.
+    - method_limits caps the concurrent calls of specific methods. Messages held back by a limit (or by order_key)
+      wait outside of the pool, bounded by max_waiting, so other methods keep running meanwhile.
+    - order_key makes messages sharing a key run one after another, in the order they were dispatched.
+    Process pool workers are forked, each calling a copy of the api, so the api's state is not shared between them.
+    A lock held by another thread at fork time stays locked in the workers, so create a process dispatcher before
+    starting other threads (sweepers, invalidators, exporters...). The pool forks replacement workers from its own
+    threads, which hold no locks of the data-structures.
+    """
+
+    EXECUTOR_THREAD = "thread"
+    EXECUTOR_PROCESS = "process"
+
+    def __init__(self, api, workers=None, executor=EXECUTOR_THREAD, max_in_flight=None, max_waiting=None,
+                 method_limits=None, order_key=None):
+        """
+        :param api: the QueueApi whose messages are dispatched
+        :param workers: number of pool workers, defaults to the number of cores
+        :param executor: EXECUTOR_THREAD or EXECUTOR_PROCESS
+        :param max_in_flight: maximal number of messages submitted to the pool, defaults to 4 per worker
+        :param max_waiting: maximal number of messages held back by method_limits or order_key,
+            defaults to max_in_flight
+        :param method_limits: a dict of method names to their maximal concurrent calls
+        :param order_key: a message field name, or a callable msg -> key, None to run messages in any order
+        """
+        workers = workers or multiprocessing.cpu_count()
+        if executor == self.EXECUTOR_THREAD:
+            self._pool = ThreadPool(workers)
+            self._call = lambda msg: _timed_call(api, msg)
+        elif executor == self.EXECUTOR_PROCESS:
+            self._pool = multiprocessing.Pool(workers, initializer=_init_process_worker, initargs=(api,))
+            self._call = _process_call
+        else:
+            raise ValueError("Unknown executor %s" % executor)
+        self._api = api
+        self._method_limits = method_limits or {}
+        if order_key is None or callable(order_key):
+            self._order_key = order_key
+        else:
+            self._order_key = lambda msg: msg.get(order_key)
+        self._max_in_flight = max_in_flight or workers * 4
+        self._max_waiting = max_waiting or self._max_in_flight
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        self._waiting = collections.deque()
+        # The AsyncResults of the submitted messages, to their method names and keys
+        self._submitted = {}
+        self._busy_keys = set()
+        self._metrics = collections.defaultdict(MethodMetrics)
+        self._in_flight_count = 0
+
+    def _method_name(self, msg):
+        if isinstance(msg, dict):
+            return msg.get(self._api.METHOD_NAME_KEY)
+        return None
+
+    def dispatch(self, msg):
+        """
+        Queue a message to be called on the pool,
+        blocking while max_in_flight messages are submitted or max_waiting messages are held back
+        :param msg: an incoming QueueApi message
+        """
+        name = self._method_name(msg)
+        key = self._order_key(msg) if self._order_key is not None and isinstance(msg, dict) else None
+        with self._lock:
+            while len(self._submitted) >= self._max_in_flight or len(self._waiting) >= self._max_waiting:
+                self._has_room.wait(1)
+                self._reap_failed()
+            self._in_flight_count += 1
+            self._metrics[name].waiting += 1
+            self._waiting.append((msg, name, key))
+            self._start_runnable()
+
+    def _start_runnable(self):
+        """
+        Start every waiting message whose method is under its limit and whose key isn't running,
+        keeping messages of the same key in order, while fewer than max_in_flight messages are submitted.
+        Called with the lock held.
+        """
+        blocked_keys = set()
+        for item in list(self._waiting):
+            if len(self._submitted) >= self._max_in_flight:
+                return
+            msg, name, key = item
+            limit = self._method_limits.get(name)
+            if key is not None and (key in self._busy_keys or key in blocked_keys):
+                blocked_keys.add(key)
+            elif limit is not None and self._metrics[name].running >= limit:
+                if key is not None:
+                    blocked_keys.add(key)
+            else:
+                self._waiting.remove(item)
+                self._metrics[name].waiting -= 1
+                self._metrics[name].running += 1
+                if key is not None:
+                    self._busy_keys.add(key)
+                token = object()
+                # The callback takes the lock, so it runs once the message is registered as submitted
+                result = self._pool.apply_async(self._call, (msg,), callback=lambda result, token=token:
+                                                self._on_done(token, *result))
+                self._submitted[token] = (result, name, key)
+
+    def _on_done(self, token, latency, succeeded):
+        with self._lock:
+            self._done(token, latency, succeeded)
+
+    def _done(self, token, latency, succeeded):
+        """Record a finished call, and start the messages waiting for it. Called with the lock held."""
+        result, name, key = self._submitted.pop(token)
+        metrics = self._metrics[name]
+        metrics.running -= 1
+        metrics.record(latency, succeeded)
+        self._busy_keys.discard(key)
+        self._in_flight_count -= 1
+        self._start_runnable()
+        self._has_room.notify_all()
+        if self._in_flight_count == 0:
+            self._idle.notify_all()
+
+    def _reap_failed(self):
+        """
+        Record the submitted messages the pool failed to call (e.g. that couldn't be pickled to a process worker)-
+        the pool doesn't call their callbacks. Called with the lock held.
+        """
+        for token, (result, name, key) in self._submitted.items():
+            if result.ready() and not result.successful():
+                try:
+                    result.get()
+                except Exception:
+                    logging.exception("Failed to dispatch message of %s" % name)
+                self._done(token, 0.0, False)
+
+    def metrics(self):
+        """
+        :return a dict with the number of messages in flight (waiting + running),
+            and the calls, errors, running, waiting and latencies (seconds) of every method:
+        """
+        with self._lock:
+            return {"in_flight": self._in_flight_count, "waiting": len(self._waiting),
+                    "methods": {name: metrics.as_dict() for name, metrics in self._metrics.iteritems()}}
+
+    def wait(self, timeout=None):
+        """
+        Block until every dispatched message has been called
+        :param timeout: seconds to wait, None to wait as long as it takes- a message whose process worker died
+            is never called
+        :return whether every dispatched message was called:
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._in_flight_count:
+                remaining = 1 if deadline is None else min(deadline - time.time(), 1)
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+                self._reap_failed()
+            return True
+
+    def close(self, timeout=None):
+        """
+        Wait for the dispatched messages and stop the pool
+        :param timeout: seconds to wait for the messages, after which the pool is terminated
+        """
+        if self.wait(timeout):
+            self._pool.close()
+        else:
+            logging.error("Terminating the pool, %d dispatched messages weren't called" % self._in_flight_count)
+            self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
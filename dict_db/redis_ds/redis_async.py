@@ -0,0 +1,90 @@
+"""
+Non-blocking access to the redis data-structures.
+Calls are run on a shared thread pool and return multiprocessing AsyncResults,
+so a single caller can keep many requests in flight, e.g.:
+
+    rhd = AsyncRedisDs(JSONRedisHashDict("hash"))
+    results = [rhd.get(key) for key in keys]
+    values = [result.get() for result in results]
+"""
+__author__ = 'OrW'
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+DEFAULT_POOL_SIZE = 32
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """
+    :return the process-wide thread pool, created on first use:
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(DEFAULT_POOL_SIZE)
+        return _pool
+
+
+class AsyncRedisDs(object):
+    """
+    Wraps a redis data-structure (RedisHashDict, RedisList, RedisSet, RedisDict, MessageQueue...),
+    running each of its methods on a thread pool and returning an AsyncResult instead of the value.
+    Values are (de)serialized by the wrapped data-structure's serializer on the pool threads.
+    Transactions (with client:) are per-thread and therefore can't span calls made through the wrapper.
+    """
+
+    def __init__(self, ds, pool=None):
+        """
+        :param ds: the data-structure to wrap
+        :param pool: the ThreadPool running the calls, defaults to a shared pool of DEFAULT_POOL_SIZE threads
+        """
+        self._ds = ds
+        self._pool = pool or default_pool()
+
+    @property
+    def ds(self):
+        return self._ds
+
+    def call(self, method, *args, **kwargs):
+        """
+        :param method: a callable to run on the pool
+        :return an AsyncResult of the call:
+        """
+        return self._pool.apply_async(method, args, kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._ds, name)
+        if not callable(attribute):
+            return attribute
+
+        def async_method(*args, **kwargs):
+            return self.call(attribute, *args, **kwargs)
+        async_method.__name__ = name
+        return async_method
+
+    def getitem(self, key):
+        return self.call(self._ds.__getitem__, key)
+
+    def setitem(self, key, value):
+        return self.call(self._ds.__setitem__, key, value)
+
+    def delitem(self, key):
+        return self.call(self._ds.__delitem__, key)
+
+    def contains(self, key):
+        return self.call(self._ds.__contains__, key)
+
+    def len(self):
+        return self.call(len, self._ds)
+
+    def collect(self, method="__iter__"):
+        """
+        Drain one of the wrapped data-structure's iterators (HSCAN, SSCAN, LRANGE windows...) on the pool
+        :param method: name of the iterating method
+        :return an AsyncResult of the list of iterated values:
+        """
+        return self.call(lambda: list(getattr(self._ds, method)()))
@@ -0,0 +1,371 @@
+"""
+Opt-in in-process read caches for the redis data-structures.
+Values read through the cached classes are kept in a bounded LRU (with an optional TTL),
+and are invalidated by local writes and, when a KeyspaceInvalidator is given, by
+other writers through Redis keyspace notifications.
+"""
+__author__ = 'OrW'
+
+import collections
+import logging
+import threading
+import time
+
+from redis import ConnectionError
+
+import redis_config as redis_config
+from redis_dict import RedisDict
+from redis_hash_dict import RedisHashDict
+from serialization import PickleSerializer, JSONSerializer
+
+
+class _Sentinel(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __repr__(self):
+        return self._name
+
+
+# Returned by LocalCache.get for keys that are not cached
+NOT_CACHED = _Sentinel("NOT_CACHED")
+# Cached for keys that do not exist in Redis, so negative lookups are cached too
+ABSENT = _Sentinel("ABSENT")
+
+
+class LocalCache(object):
+    """
+    A thread-safe bounded LRU cache with an optional TTL.
+    Keeps hit/miss/eviction counters for sizing.
+    Every invalidation advances the generation, so a value fetched while an invalidation came in isn't cached-
+    read the generation before fetching the value, and pass it on to set.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        :param max_size: maximal number of cached entries, least recently used entries are evicted
+        :param ttl: seconds an entry stays valid, None means until evicted or invalidated
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=NOT_CACHED):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.time() > expires_at:
+                self.misses += 1
+                self.expirations += 1
+                return default
+            # Re-insert as the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        :param generation: the generation read before fetching the value, None to cache it regardless
+        :return whether the value was cached:
+        """
+        expires_at = None if self._ttl is None else time.time() + self._ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self.generation += 1
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return a dict of the cache counters:
+        """
+        return {"size": len(self._data), "max_size": self._max_size,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations, "invalidations": self.invalidations}
+
+
+class KeyspaceInvalidator(object):
+    """
+    Listens to Redis keyspace notifications on a background thread,
+    and calls the callbacks watching the changed keys.
+    Notifications are pattern-subscribed once, narrow the pattern on busy shared servers.
+    """
+
+    KEYSPACE_CHANNEL = "__keyspace@%d__:"
+    NOTIFY_CONFIG = "notify-keyspace-events"
+    NOTIFY_FLAGS = "KA"
+
+    def __init__(self, redis_client=redis_config.CLIENT, pattern="*", configure_server=False):
+        """
+        :param redis_client: the client whose database is watched
+        :param pattern: the key pattern to receive notifications for
+        :param configure_server: enable keyspace notifications on the server (CONFIG SET)
+        """
+        self._client = redis_client
+        db = redis_client.connection_pool.connection_kwargs.get("db", 0)
+        self._channel_prefix = self.KEYSPACE_CHANNEL % db
+        self._pattern = pattern
+        self._configure_server = configure_server
+        self._key_callbacks = collections.defaultdict(list)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._pub_sub = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def watch(self, key, callback):
+        """
+        :param key: the Redis key to watch
+        :param callback: called with the key whenever it is changed
+        """
+        with self._lock:
+            self._key_callbacks[key].append(callback)
+
+    def watch_all(self, callback):
+        """
+        :param callback: called with the key of every change received
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unwatch(self, key, callback):
+        with self._lock:
+            callbacks = self._key_callbacks.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._key_callbacks.pop(key, None)
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if self._configure_server:
+            flags = self._client.config_get(self.NOTIFY_CONFIG).get(self.NOTIFY_CONFIG, "")
+            missing = "".join(f for f in self.NOTIFY_FLAGS if f not in flags)
+            if missing:
+                self._client.config_set(self.NOTIFY_CONFIG, flags + missing)
+        self._pub_sub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pub_sub.psubscribe(self._channel_prefix + self._pattern)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="KeyspaceInvalidator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pub_sub is not None:
+            self._pub_sub.close()
+            self._pub_sub = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                message = self._pub_sub.get_message(timeout=1.0)
+            except ConnectionError:
+                # Notifications may have been missed - drop everything
+                logging.exception("Lost keyspace notifications connection, invalidating all watchers")
+                self._notify_all()
+                time.sleep(1.0)
+                continue
+            if message is not None and message["type"] == "pmessage":
+                self._notify(message["channel"][len(self._channel_prefix):])
+
+    def _notify(self, key):
+        with self._lock:
+            callbacks = self._key_callbacks.get(key, []) + self._callbacks
+        for callback in callbacks:
+            callback(key)
+
+    def _notify_all(self):
+        with self._lock:
+            callbacks = [(key, callback) for key, key_callbacks in self._key_callbacks.iteritems()
+                         for callback in key_callbacks]
+        for key, callback in callbacks:
+            callback(key)
+        for callback in list(self._callbacks):
+            callback(None)
+
+
+class CachedRedisHashDict(RedisHashDict):
+    """
+    A RedisHashDict whose reads go through a LocalCache.
+    Keyspace notifications are per hash, so any remote change to the hash drops all its cached fields.
+    Cached values are shared - do not mutate values returned from the cache.
+    """
+
+    def __init__(self, hash_key, redis_client=redis_config.CLIENT, max_size=10000, ttl=None, invalidator=None):
+        """
+        :param max_size: maximal number of cached fields
+        :param ttl: seconds a cached field stays valid, bounds staleness when no invalidator is given
+        :param invalidator: a started KeyspaceInvalidator that watches changes by other writers
+        """
+        super(CachedRedisHashDict, self).__init__(hash_key, redis_client=redis_client)
+        self._cache = LocalCache(max_size=max_size, ttl=ttl)
+        if invalidator is not None:
+            invalidator.watch(hash_key, self._invalidate)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _invalidate(self, key):
+        self._cache.clear()
+
+    def _fetch(self, key):
+        generation = self._cache.generation
+        value = self._cache.get(key)
+        if value is NOT_CACHED:
+            value = super(CachedRedisHashDict, self).get(key, ABSENT)
+            self._cache.set(key, value, generation)
+        return value
+
+    def __getitem__(self, key):
+        value = self._fetch(key)
+        if value is ABSENT:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._fetch(key)
+        return default if value is ABSENT else value
+
+    def __contains__(self, key):
+        return self._fetch(key) is not ABSENT
+
+    def get_many(self, keys, default=None):
+        generation = self._cache.generation
+        values = {}
+        missing = []
+        for key in keys:
+            value = self._cache.get(key)
+            if value is NOT_CACHED:
+                missing.append(key)
+            else:
+                values[key] = value
+        for key, value in super(CachedRedisHashDict, self).get_many(missing, default=ABSENT).iteritems():
+            self._cache.set(key, value, generation)
+            values[key] = value
+        return {key: default if value is ABSENT else value for key, value in values.iteritems()}
+
+    def __setitem__(self, key, val):
+        self._cache.discard(key)
+        return super(CachedRedisHashDict, self).__setitem__(key, val)
+
+    def set_many(self, mapping):
+        for key in mapping:
+            self._cache.discard(key)
+        return super(CachedRedisHashDict, self).set_many(mapping)
+
+    def increment_key(self, key, value=1):
+        self._cache.discard(key)
+        return super(CachedRedisHashDict, self).increment_key(key, value)
+
+    def __delitem__(self, key):
+        self._cache.discard(key)
+        return super(CachedRedisHashDict, self).__delitem__(key)
+
+    def delete_all(self):
+        self._cache.clear()
+        super(CachedRedisHashDict, self).delete_all()
+
+
+class PickleCachedRedisHashDict(CachedRedisHashDict, PickleSerializer):
+    """Serialize cached hash-map values using pickle."""
+    pass
+
+
+class JSONCachedRedisHashDict(CachedRedisHashDict, JSONSerializer):
+    """Serialize cached hash-map values using JSON."""
+    pass
+
+
+class CachedRedisDict(RedisDict):
+    """
+    A RedisDict whose reads go through a LocalCache.
+    Cached values are shared - do not mutate values returned from the cache.
+    """
+
+    def __init__(self, redis_client=redis_config.CLIENT, max_size=10000, ttl=None, invalidator=None):
+        """
+        :param max_size: maximal number of cached keys
+        :param ttl: seconds a cached key stays valid, bounds staleness when no invalidator is given
+        :param invalidator: a started KeyspaceInvalidator that watches changes by other writers
+        """
+        super(CachedRedisDict, self).__init__(redis_client=redis_client)
+        self._cache = LocalCache(max_size=max_size, ttl=ttl)
+        if invalidator is not None:
+            invalidator.watch_all(self._invalidate)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _invalidate(self, key):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.discard(key)
+
+    def __getitem__(self, key):
+        generation = self._cache.generation
+        value = self._cache.get(key)
+        if value is NOT_CACHED:
+            value = super(CachedRedisDict, self).__getitem__(key)
+            self._cache.set(key, value, generation)
+        return value
+
+    def __setitem__(self, key, val):
+        self._cache.discard(key)
+        return super(CachedRedisDict, self).__setitem__(key, val)
+
+    def increment_key(self, key, value=1):
+        self._cache.discard(key)
+        return super(CachedRedisDict, self).increment_key(key, value)
+
+    def __delitem__(self, key):
+        self._cache.discard(key)
+        return super(CachedRedisDict, self).__delitem__(key)
+
+
+class PickleCachedRedisDict(CachedRedisDict, PickleSerializer):
+    "Serialize cached redis dictionary values via pickle."
+    pass
+
+
+class JSONCachedRedisDict(CachedRedisDict, JSONSerializer):
+    "Serialize cached redis dictionary values via JSON."
+    pass
@@ -1,6 +1,139 @@
 """
 Monkey patch configuration here...
+The default CLIENT connects on first use, so importing the data-structures doesn't import redis or connect-
+configure it before using it, e.g. redis_config.CLIENT.configure(unix_socket_path="/tmp/redis.sock")
 """
-import redis_pipe
+import threading
+import types
+from os import getpid
 
-CLIENT = redis_pipe.RedisPipe()
+# Options selecting the server, which a URL selects instead
+TARGET_OPTIONS = ("host", "port", "db", "unix_socket_path")
+
+
+def create_client(url=None, auto_batch=False, **options):
+    """
+    Create a client with its own connection pool, to be shared by the data-structures
+    :param url: redis://[:password@]host[:port][/db] or unix://[:password@]/path/to/socket[?db=db],
+        None to connect by the options (localhost:6379 by default). The TARGET_OPTIONS can't be combined with a URL.
+    :param auto_batch: coalesce the commands of concurrent callers into pipelines (a BatchingRedisPipe),
+        configured by the batch_delay and batch_size options
+    :param options: connection and pool options of the Redis client- host, port, db, unix_socket_path,
+        max_connections, socket_timeout, socket_connect_timeout, socket_keepalive, socket_keepalive_options...
+    :return a RedisPipe:
+    """
+    import redis_pipe
+    if auto_batch:
+        client_class = redis_pipe.BatchingRedisPipe
+        client_options = {name: options.pop(name) for name in ("batch_delay", "batch_size") if name in options}
+    else:
+        client_class = redis_pipe.RedisPipe
+        client_options = {}
+    if url is not None:
+        targets = [name for name in TARGET_OPTIONS if name in options]
+        if targets:
+            raise ValueError("The URL %s selects the server, can't pass %s as well" % (url, ", ".join(targets)))
+        from redis import ConnectionPool
+        return client_class(connection_pool=ConnectionPool.from_url(url, **options), **client_options)
+    client_options.update(options)
+    return client_class(**client_options)
+
+
+class _Command(object):
+    """
+    A command of LazyClient, found on the class so looking it up skips __getattr__.
+    Returns the bound command cached in the current process, resolving it again after a fork.
+    """
+
+    __slots__ = ("_name",)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        pid, commands = instance._commands
+        if pid == getpid():
+            command = commands.get(self._name)
+            if command is not None:
+                return command
+        return instance._resolve(self._name)
+
+
+class LazyClient(object):
+    """
+    Stands in for a RedisPipe, creating it on first use.
+    A forked process creates its own client on first use, rather than sharing the parent's connections.
+    Commands are resolved once per process and cached, a lookup costs a pid check and a dict lookup.
+    """
+
+    _client = None
+    _pid = None
+
+    def __init__(self, url=None, **options):
+        """
+        @see create_client
+        """
+        self._lock = threading.Lock()
+        self._url = url
+        self._options = options
+        # The pid the bound commands were cached in, and the commands by name
+        self._commands = (None, {})
+
+    def configure(self, url=None, **options):
+        """
+        Replace the options of the client, the client is recreated on its next use
+        @see create_client
+        """
+        with self._lock:
+            self._url = url
+            self._options = options
+            self._client = None
+            self._commands = (None, {})
+
+    def _create(self):
+        with self._lock:
+            if self._client is None or self._pid != getpid():
+                self._client = create_client(self._url, **self._options)
+                self._pid = getpid()
+                self._commands = (self._pid, {})
+            return self._client
+
+    @property
+    def client(self):
+        """
+        :return the RedisPipe of the current process:
+        """
+        client = self._client
+        if client is None or self._pid != getpid():
+            client = self._create()
+        return client
+
+    def _resolve(self, name):
+        client = self.client
+        value = getattr(client, name)
+        if isinstance(value, types.MethodType) and value.__self__ is client:
+            pid, commands = self._commands
+            if pid == getpid() and client is self._client:
+                commands[name] = value
+            if name[0] != "_" and name not in LazyClient.__dict__:
+                setattr(LazyClient, name, _Command(name))
+        return value
+
+    def __getattr__(self, name):
+        if name[:2] == "__":
+            raise AttributeError(name)
+        return self._resolve(name)
+
+    def __enter__(self):
+        return self.client.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.client.__exit__(exc_type, exc_val, exc_tb)
+
+    def __repr__(self):
+        return "%s<%r>" % (type(self).__name__, self._client if self._client is not None else self._options)
+
+
+CLIENT = LazyClient()
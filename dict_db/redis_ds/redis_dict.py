@@ -10,28 +10,72 @@ not a Redis hashmap. If you prefer an interface to a hashmap, the
 import redis_config as redis_config
 import UserDict
 import redis_pipe
-from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer
+from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer, CodecSerializer
 
 
 class RedisDict(UserDict.DictMixin, PassThroughSerializer):
-    """Dictionary interface to Redis database."""
-    def __init__(self, redis_client=redis_config.CLIENT):
+    """
+    Dictionary interface to Redis database.
+    Keys are enumerated with SCAN, a page at a time, so enumerating a large database doesn't block the server.
+    """
+
+    # Keys examined by the server per SCAN call
+    SCAN_COUNT = 1000
+
+    def __init__(self, redis_client=redis_config.CLIENT, pattern="*"):
         """
         Parameters:
         - redis_client: configured redis_client to use for all requests.
                         should be fine to monkey patch this to set the
                         default settings for your environment...
+        - pattern: glob-style pattern of the database keys that belong to the dictionary
         """
         self._client = redis_client or redis_pipe.RedisPipe()
         self._default_expiration = None
+        self._pattern = pattern
+
+    def _key_pattern(self, pattern=None):
+        """
+        :return the SCAN pattern of the dictionary keys matching pattern (None for all of them):
+        """
+        return pattern or self._pattern
+
+    def scan_keys(self, pattern=None, count=None):
+        """
+        Lazily iterate over the dictionary keys
+        :param pattern: glob-style pattern the keys must match, None for all the dictionary keys
+        :param count: keys examined by the server per round trip
+        :return an iterator over the keys (a key may be returned more than once if it's modified meanwhile):
+        """
+        return self._client.scan_iter(match=self._key_pattern(pattern), count=count or self.SCAN_COUNT)
 
-    def keys(self, pattern="*"):
+    def scan_keys_cursor(self, cursor="0", pattern=None, count=None):
+        """
+        Same as scan_keys, but iteration is done in segments,
+        and continued by calling the function again with the last returned cursor
+        :param cursor: the cursor to resume from, "0" to start over
+        :return an iterator over (cursor, key) - the cursor continues after the segment of the key:
+        """
+        while cursor != 0:
+            cursor, keys = self._client.scan(cursor=cursor, match=self._key_pattern(pattern),
+                                             count=count or self.SCAN_COUNT)
+            for key in keys:
+                yield cursor, key
+
+    def keys(self, pattern=None):
         """Keys for Redis dictionary."""
-        return self._client.keys(pattern)
+        return list(self.scan_keys(pattern))
+
+    def __iter__(self):
+        return self.scan_keys()
+
+    iterkeys = __iter__
 
     def __len__(self):
         """Number of key-value pairs in dictionary/database."""
-        return self._client.dbsize()
+        if self._key_pattern() == "*":
+            return self._client.dbsize()
+        return sum(1 for key in self.scan_keys())
 
     def __getitem__(self, key):
         """Retrieve a value by key."""
@@ -90,3 +134,8 @@ class PickleRedisDict(RedisDict, PickleSerializer):
 class JSONRedisDict(RedisDict, JSONSerializer):
     "Serialize redis dictionary values via JSON."
     pass
+
+
+class CodecRedisDict(RedisDict, CodecSerializer):
+    "Serialize redis dictionary values via a Codec."
+    pass
@@ -3,8 +3,10 @@ Module contains RedisHashDict, which allows users to interact with Redis hashes
 as if they were Python dictionaries.
 """
 import redis_config as redis_config
-from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer
+from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer, CodecSerializer
 import UserDict
+import logging
+import threading
 import time
 
 
@@ -19,6 +21,14 @@ class RedisHashDict(UserDict.DictMixin, PassThroughSerializer):
     def client(self):
         return self._client
 
+    def _run_script(self, script, keys, args):
+        """
+        Run a registered script. Within the calling thread's transaction (with client:) the script is queued on it,
+        and loaded by it before it executes, rather than failing the transaction if the server doesn't have it.
+        """
+        pipe = getattr(self._client, "current_pipe", None)
+        return script(keys=keys, args=args, client=self._client if pipe is None else pipe)
+
     def keys(self):
         """Return all keys in the Redis hash-map."""
         return self._client.hkeys(self.hash_key)
@@ -68,6 +78,20 @@ class RedisHashDict(UserDict.DictMixin, PassThroughSerializer):
         else:
             return self.deserialize(value)
 
+    def get_many(self, keys, default=None):
+        """
+        Retrieve several keys from the hash-map in a single round trip (HMGET)
+        :param keys: an iterable of keys to retrieve
+        :param default: the value returned for keys that do not exist
+        :return a dict mapping every requested key to its value:
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self._client.hmget(self.hash_key, keys)
+        return {key: default if value is None else self.deserialize(value)
+                for key, value in zip(keys, values)}
+
     def increment_key(self, key,  value=1):
         if isinstance(value, int):
             return self._client.hincrby(self.hash_key, key, value)
@@ -81,15 +105,33 @@ class RedisHashDict(UserDict.DictMixin, PassThroughSerializer):
         val = self.serialize(val)
         return self._client.hset(self.hash_key, key, val)
 
+    def set_many(self, mapping):
+        """
+        Set several keys in the hash-map in a single round trip (HMSET)
+        :param mapping: a dict of keys to values
+        """
+        if not mapping:
+            return True
+        mapping = {key: self.serialize(val) for key, val in mapping.iteritems()}
+        return self._client.hmset(self.hash_key, mapping)
+
+    def update(self, other=None, **kwargs):
+        """Same as dict.update, but sends all the keys in a single round trip."""
+        mapping = {}
+        if other is not None:
+            mapping.update(other)
+        mapping.update(kwargs)
+        self.set_many(mapping)
+
     def upsert(self, key, data):
         """
         Update (or create) an entry in place
         :param key: the key of the updated/created entry
         :param data: The data to update/create
         """
-        data = self.get(key, {}) or {}
-        data.update(data)
-        self[key] = data
+        value = self.get(key, {}) or {}
+        value.update(data)
+        self[key] = value
 
     def __delitem__(self, key):
         """Ensure a key does not exist in the hashmap."""
@@ -108,34 +150,345 @@ class PickleRedisHashDict(RedisHashDict, PickleSerializer):
     pass
 
 
-class JSONRedisHashDict(RedisHashDict, JSONSerializer):
+class JSONMergeMixin(object):
+    """
+    Atomic, server-side upserts of JSON documents, merged by a Lua script inside Redis.
+    A single round trip per call, only the partial update goes over the wire,
+    and concurrent writers can't overwrite each other's updates.
+    Documents are merged shallowly, like dict.update. The script splices the stored JSON text rather than
+    decoding it, so the fields an upsert doesn't touch are kept byte for byte, and set values are stored as
+    serialized here. Incremented numbers are computed in doubles- an increment that doubles can't compute exactly
+    (integers beyond 2^53) raises a ResponseError, and the call writes nothing.
+    """
+
+    # KEYS[1] - the hash, KEYS[2] - its expiration index (optional)
+    # ARGV[1] - now, ARGV[2] - the new expiration ('' to leave expirations as they are),
+    # followed by (field, JSON of the values to set, JSON of the values to increment) triplets.
+    MERGE_SCRIPT = r"""
+    local now, expiration = tonumber(ARGV[1]), tonumber(ARGV[2])
+    -- Doubles hold integers exactly up to 2^53
+    local MAX_EXACT = 9007199254740992
+
+    local function skip_space(s, i)
+        return string.find(s, '[^ \t\r\n]', i) or #s + 1
+    end
+
+    -- The index after the JSON string starting at i, nil if it's unterminated
+    local function scan_string(s, i)
+        local j = i + 1
+        while true do
+            local k = string.find(s, '["\\]', j)
+            if not k then
+                return nil
+            elseif string.sub(s, k, k) == '\\' then
+                j = k + 2
+            else
+                return k + 1
+            end
+        end
+    end
+
+    -- The index after the JSON value starting at i, nil if it's malformed
+    local function scan_value(s, i)
+        local c = string.sub(s, i, i)
+        if c == '"' then
+            return scan_string(s, i)
+        elseif c == '{' or c == '[' then
+            local depth, j = 0, i
+            while true do
+                local k = string.find(s, '[%[%]{}"]', j)
+                if not k then
+                    return nil
+                end
+                c = string.sub(s, k, k)
+                if c == '"' then
+                    j = scan_string(s, k)
+                    if not j then
+                        return nil
+                    end
+                else
+                    depth = depth + ((c == '{' or c == '[') and 1 or -1)
+                    j = k + 1
+                    if depth == 0 then
+                        return j
+                    end
+                end
+            end
+        end
+        local j = string.find(s, '[,}%] \t\r\n]', i) or #s + 1
+        if j > i then
+            return j
+        end
+    end
+
+    -- Split a JSON object into its members' raw keys and values, leaving the values' text as it is.
+    -- Returns the raw keys, the raw values and the members' indices by name, nil if s isn't a JSON object
+    local function split(s)
+        local keys, values, index = {}, {}, {}
+        local i = skip_space(s, 1)
+        if string.sub(s, i, i) ~= '{' then
+            return nil
+        end
+        i = skip_space(s, i + 1)
+        if string.sub(s, i, i) == '}' then
+            return keys, values, index
+        end
+        while true do
+            local j = string.sub(s, i, i) == '"' and scan_string(s, i)
+            if not j then
+                return nil
+            end
+            local key = string.sub(s, i, j - 1)
+            i = skip_space(s, j)
+            if string.sub(s, i, i) ~= ':' then
+                return nil
+            end
+            i = skip_space(s, i + 1)
+            j = scan_value(s, i)
+            if not j then
+                return nil
+            end
+            local name = cjson.decode(key)
+            if not index[name] then
+                keys[#keys + 1] = key
+                index[name] = #keys
+            end
+            values[index[name]] = string.sub(s, i, j - 1)
+            i = skip_space(s, j)
+            local c = string.sub(s, i, i)
+            if c == '}' then
+                return keys, values, index
+            elseif c ~= ',' then
+                return nil
+            end
+            i = skip_space(s, i + 1)
+        end
+    end
+
+    -- The raw JSON number of raw + increment (missing and non-numeric values count as 0),
+    -- nil if doubles can't compute it exactly
+    local function add(raw, increment)
+        local is_float = string.find(increment, '[.eE]') ~= nil
+        local value = raw and tonumber(raw)
+        if value then
+            is_float = is_float or string.find(raw, '[.eE]') ~= nil
+        else
+            value = 0
+        end
+        local sum = value + tonumber(increment)
+        if not is_float then
+            if math.max(math.abs(value), math.abs(sum), math.abs(tonumber(increment))) >= MAX_EXACT then
+                return nil
+            end
+            return string.format('%d', sum)
+        end
+        -- The shortest text reading back as the sum
+        for precision = 15, 17 do
+            local text = string.format('%.' .. precision .. 'g', sum)
+            if precision == 17 or tonumber(text) == sum then
+                if not string.find(text, '[.eEn]') then
+                    text = text .. '.0'
+                end
+                return text
+            end
+        end
+    end
+
+    local fields, docs, was_expired = {}, {}, {}
+    for i = 3, #ARGV, 3 do
+        local field = ARGV[i]
+        local current = redis.call('HGET', KEYS[1], field)
+        local expired = false
+        if current and KEYS[2] then
+            local expires = redis.call('ZSCORE', KEYS[2], field)
+            if expires and tonumber(expires) < now then
+                current = false
+                expired = true
+            end
+        end
+        local ok, keys, values, index = false
+        if current then
+            ok, keys, values, index = pcall(split, current)
+        end
+        if not (ok and keys) then
+            keys, values, index = {}, {}, {}
+        end
+        local function set(key, value)
+            local name = cjson.decode(key)
+            if not index[name] then
+                keys[#keys + 1] = key
+                index[name] = #keys
+            end
+            values[index[name]] = value
+        end
+        local update_keys, updates = split(ARGV[i + 1])
+        for j, key in ipairs(update_keys) do
+            set(key, updates[j])
+        end
+        local increment_keys, increments = split(ARGV[i + 2])
+        for j, key in ipairs(increment_keys) do
+            local position = index[cjson.decode(key)]
+            local sum = add(position and values[position], increments[j])
+            if not sum then
+                return redis.error_reply('Can not increment ' .. key .. ' of ' .. field .. ' exactly')
+            end
+            set(key, sum)
+        end
+        local members = {}
+        for j, key in ipairs(keys) do
+            members[j] = key .. ': ' .. values[j]
+        end
+        fields[#fields + 1] = field
+        docs[#fields] = '{' .. table.concat(members, ', ') .. '}'
+        was_expired[#fields] = expired
+    end
+    -- Written once every document merged, so a failing merge writes nothing
+    for j, field in ipairs(fields) do
+        redis.call('HSET', KEYS[1], field, docs[j])
+        if KEYS[2] and expiration then
+            redis.call('ZADD', KEYS[2], expiration, field)
+        elseif was_expired[j] then
+            -- The document replaces an expired one, and must not inherit its expiration
+            redis.call('ZREM', KEYS[2], field)
+        end
+    end
+    return #fields
+    """
+
+    MERGE_BATCH_SIZE = 500
+
+    def _merge_keys(self):
+        return [self.hash_key]
+
+    def _merge_expiration(self):
+        return ""
+
+    def _merge(self, updates):
+        """
+        :param updates: a list of (key, data, increments) tuples, merged in a single script call
+        """
+        if not hasattr(self, "_merge_script"):
+            self._merge_script = self._client.register_script(self.MERGE_SCRIPT)
+        args = [time.time(), self._merge_expiration()]
+        for key, data, increments in updates:
+            args += [key, self.serialize(data or {}), self.serialize(increments or {})]
+        return self._run_script(self._merge_script, self._merge_keys(), args)
+
+    def upsert(self, key, data, increments=None):
+        """
+        Atomically update (or create) a document
+        :param key: the key of the updated/created document
+        :param data: a dict of the document's fields to set
+        :param increments: a dict of the document's numeric fields to increment (missing fields count as 0)
+        """
+        self._merge([(key, data, increments)])
+
+    def upsert_many(self, mapping, increments=None):
+        """
+        Atomically update (or create) many documents, MERGE_BATCH_SIZE documents per round trip
+        :param mapping: a dict of keys to the fields to set in their documents
+        :param increments: a dict of keys to the numeric fields to increment in their documents
+        """
+        increments = increments or {}
+        keys = list(set(mapping) | set(increments))
+        for i in xrange(0, len(keys), self.MERGE_BATCH_SIZE):
+            self._merge([(key, mapping.get(key), increments.get(key))
+                         for key in keys[i:i + self.MERGE_BATCH_SIZE]])
+
+
+class JSONRedisHashDict(JSONMergeMixin, RedisHashDict, JSONSerializer):
     """Serialize hash-map values using JSON."""
     pass
 
 
+class CodecRedisHashDict(RedisHashDict, CodecSerializer):
+    """Serialize hash-map values using a Codec."""
+    pass
+
+
 class ExpirableRedisHashDict(RedisHashDict):
     """
-    A RedisHashDict
+    A RedisHashDict whose keys can expire.
+    Expiration times are kept as the scores of a sorted set next to the hash,
+    so reads check freshness in the same round trip and sweep() purges expired keys in batches.
+    Within a transaction (with client:) reads and writes are queued on it, returning the transaction's pipeline-
+    their replies are in its transaction_results.
+    Expiration times of the former pickled hash are migrated on the first use of the hash-dict (outside of a
+    transaction), @see migrate_expirations.
     """
 
     class KeyExpiredError(KeyError):
         pass
 
-    def __init__(self, hash_key):
-        super(ExpirableRedisHashDict, self).__init__(hash_key)
+    # Atomically purge up to ARGV[2] keys that expired before ARGV[1]
+    SWEEP_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, key in ipairs(expired) do
+        redis.call('HDEL', KEYS[1], key)
+        redis.call('ZREM', KEYS[2], key)
+    end
+    return #expired
+    """
+
+    def __init__(self, hash_key, redis_client=redis_config.CLIENT):
+        super(ExpirableRedisHashDict, self).__init__(hash_key, redis_client=redis_client)
         self._default_expiration = None
-        self._expiration = PickleRedisHashDict("meta_%s|expiration" % hash_key)
+        self._expiration_key = "meta_%s|expiration_index" % hash_key
+        # Expiration times were formerly stored in a pickled hash, @see migrate_expirations
+        self._legacy_expiration_key = "meta_%s|expiration" % hash_key
+        self._legacy_checked = False
+        self._sweep_script = self._client.register_script(self.SWEEP_SCRIPT)
 
     def set_default_expiration(self, expiration):
         self._default_expiration = expiration
 
+    def _pipeline(self, transaction=True):
+        """
+        Commands spanning the hash and its expiration index are queued on the calling thread's transaction
+        (with client:) if there is one, so they're committed with it, their replies in its transaction_results
+        :return a pipeline, and whether it's the transaction's- which executes it on exit:
+        """
+        pipe = getattr(self._client, "current_pipe", None)
+        if pipe is not None:
+            return pipe, True
+        self._check_legacy()
+        return self._client.pipeline(transaction=transaction), False
+
+    def _check_legacy(self):
+        """Migrate the expiration times of the former pickled hash on first use, if there are any"""
+        if self._legacy_checked or getattr(self._client, "current_pipe", None) is not None:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        pipe.exists(self._legacy_expiration_key)
+        if pipe.execute()[0]:
+            logging.warning("Migrating the legacy expiration times of %s" % self.hash_key)
+            self.migrate_expirations()
+        self._legacy_checked = True
+
+    @staticmethod
+    def _is_expired(expiration, now=None):
+        return expiration is not None and (now or time.time()) > expiration
+
+    def _read_with_expiration(self, command, *args):
+        """
+        Run a read command on the hash together with the expiration lookup, in a single round trip
+        :return the pipeline, and the command's result and the key's expiration- None if they were queued on
+            a transaction:
+        """
+        pipe, queued = self._pipeline(transaction=False)
+        getattr(pipe, command)(self.hash_key, *args)
+        pipe.zscore(self._expiration_key, args[0])
+        return pipe, None if queued else pipe.execute()
+
     def iter_fresh_items(self):
         """
         Iterate through the hash-dict, yielding only items that haven't expired yet
         :return an iterator over the dict:
         """
+        self._check_legacy()
+        expired = set(self._client.zrangebyscore(self._expiration_key, "-inf", time.time()))
         for k, v in self.iteritems():
-            if not self.should_expire(k):
+            if k not in expired:
                 yield k, v
 
     def always_get(self, key):
@@ -147,15 +500,68 @@ class ExpirableRedisHashDict(RedisHashDict):
 
     def __contains__(self, key):
         """Check if a key exists within the hash-map."""
-        if self.should_expire(key):
-            return False
-        else:
-            return super(ExpirableRedisHashDict, self).__contains__(key)
+        pipe, results = self._read_with_expiration("hexists", key)
+        if results is None:
+            return pipe
+        exists, expiration = results
+        return bool(exists) and not self._is_expired(expiration)
 
     def __setitem__(self, key, value):
-        super(ExpirableRedisHashDict, self).__setitem__(key, value)
-        if self._default_expiration is not None:
-            self.expire(key, timeout=self._default_expiration)
+        if self._default_expiration is None:
+            super(ExpirableRedisHashDict, self).__setitem__(key, value)
+        else:
+            self.set(key, value, timeout=self._default_expiration)
+
+    def set_many(self, mapping):
+        if not mapping or self._default_expiration is None:
+            return super(ExpirableRedisHashDict, self).set_many(mapping)
+        expiration = self._default_expiration + time.time()
+        pipe, queued = self._pipeline()
+        pipe.hmset(self.hash_key, {key: self.serialize(val) for key, val in mapping.iteritems()})
+        pipe.execute_command("ZADD", self._expiration_key, *self._zadd_args(dict.fromkeys(mapping, expiration)))
+        return pipe if queued else pipe.execute()[0]
+
+    @staticmethod
+    def _zadd_args(expirations):
+        """
+        ZADD arguments are passed explicitly, as score/member order differs between redis-py client classes
+        """
+        args = []
+        for key, expiration in expirations.iteritems():
+            args += [expiration, key]
+        return args
+
+    def get(self, key, default=None):
+        """Retrieve a key's value or a default value if the key does not exist or has expired."""
+        pipe, results = self._read_with_expiration("hget", key)
+        if results is None:
+            return pipe
+        value, expiration = results
+        if value is None or self._is_expired(expiration):
+            return default
+        else:
+            return self.deserialize(value)
+
+    def get_many(self, keys, default=None):
+        """
+        Retrieve several keys in a single round trip, treating expired keys as missing
+        :param keys: an iterable of keys to retrieve
+        :param default: the value returned for keys that do not exist or have expired
+        :return a dict mapping every requested key to its value, the transaction's pipeline within one:
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        pipe, queued = self._pipeline(transaction=False)
+        pipe.hmget(self.hash_key, keys)
+        for key in keys:
+            pipe.zscore(self._expiration_key, key)
+        if queued:
+            return pipe
+        results = pipe.execute()
+        now = time.time()
+        return {key: default if value is None or self._is_expired(expiration, now) else self.deserialize(value)
+                for key, value, expiration in zip(keys, results[0], results[1:])}
 
     def set(self, key, value, timeout=None):
         """
@@ -164,11 +570,14 @@ class ExpirableRedisHashDict(RedisHashDict):
         :param timeout: when should the key expire, None means never.
         :return:
         """
-        super(ExpirableRedisHashDict, self).__setitem__(key, value)
-        self.expire(key, timeout=timeout)
+        pipe, queued = self._pipeline()
+        pipe.hset(self.hash_key, key, self.serialize(value))
+        self._pipe_expire(pipe, key, timeout)
+        return pipe if queued else pipe.execute()[0]
 
     def get_expiration(self, key):
-        expiration = self._expiration.get(key, None)
+        self._check_legacy()
+        expiration = self._client.zscore(self._expiration_key, key)
         return expiration
 
     def get_expiration_as_text(self, key):
@@ -179,22 +588,42 @@ class ExpirableRedisHashDict(RedisHashDict):
             return time.ctime(ex)
 
     def should_expire(self, key):
-        expiration = self._expiration.get(key, None)
-        should_expire = expiration is not None and time.time() > expiration
-        return should_expire
+        return self._is_expired(self.get_expiration(key))
 
     def __getitem__(self, key):
         """Retrieve a value from the hash-map."""
-        if self.should_expire(key):
+        pipe, results = self._read_with_expiration("hget", key)
+        if results is None:
+            return pipe
+        value, expiration = results
+        if self._is_expired(expiration):
             del self[key]
             raise self.KeyExpiredError(key)
+        elif value is None:
+            raise KeyError(key)
         else:
-            return super(ExpirableRedisHashDict, self).__getitem__(key)
+            return self.deserialize(value)
+
+    def __delitem__(self, key):
+        """Ensure a key (and its expiration) does not exist in the hashmap."""
+        pipe, queued = self._pipeline()
+        pipe.hdel(self.hash_key, key)
+        pipe.zrem(self._expiration_key, key)
+        return pipe if queued else pipe.execute()[0]
+
+    def delete_all(self):
+        self._client.delete(self.hash_key, self._expiration_key)
 
     @property
     def default_expiration(self):
         return self._default_expiration
 
+    def _pipe_expire(self, pipe, key, timeout):
+        if timeout is None:
+            pipe.zrem(self._expiration_key, key)
+        else:
+            pipe.execute_command("ZADD", self._expiration_key, timeout + time.time(), key)
+
     def expire(self, key, timeout):
         """
         Set expiration on a key
@@ -202,10 +631,72 @@ class ExpirableRedisHashDict(RedisHashDict):
         :param timeout: time in seconds, or None to remove expiration
         :return:
         """
-        if timeout is None:
-            self._expiration[key] = None
-        else:
-            self._expiration[key] = timeout + time.time()
+        pipe, queued = self._pipeline()
+        self._pipe_expire(pipe, key, timeout)
+        if not queued:
+            pipe.execute()
+
+    def sweep(self, batch_size=1000):
+        """
+        Purge all the expired keys, batch_size keys per round trip.
+        Within a transaction (with client:) a single batch is queued, its count in the transaction_results.
+        :return the number of purged keys:
+        """
+        keys = [self.hash_key, self._expiration_key]
+        if getattr(self._client, "current_pipe", None) is not None:
+            return self._run_script(self._sweep_script, keys, [time.time(), batch_size])
+        self._check_legacy()
+        purged = 0
+        while True:
+            count = self._run_script(self._sweep_script, keys, [time.time(), batch_size])
+            purged += count
+            if count < batch_size:
+                return purged
+
+    def migrate_expirations(self):
+        """
+        Move expiration times from the former pickled expiration hash into the expiration index.
+        Runs on the first use of the hash-dict (outside of a transaction), so it's only needed for a hash-dict
+        whose legacy expiration times were written after that.
+        """
+        legacy = PickleRedisHashDict(self._legacy_expiration_key, redis_client=self._client)
+        expirations = {key: expiration for key, expiration in legacy.iteritems() if expiration is not None}
+        pipe = self._client.pipeline()
+        if expirations:
+            pipe.execute_command("ZADD", self._expiration_key, *self._zadd_args(expirations))
+        pipe.delete(self._legacy_expiration_key)
+        pipe.execute()
+
+
+class ExpirationSweeper(threading.Thread):
+    """
+    A background thread periodically sweeping the expired keys of ExpirableRedisHashDicts
+    """
+
+    def __init__(self, hash_dicts, interval=60, batch_size=1000):
+        """
+        :param hash_dicts: the ExpirableRedisHashDicts to sweep
+        :param interval: seconds between sweeps
+        :param batch_size: keys purged per round trip
+        """
+        super(ExpirationSweeper, self).__init__(name="ExpirationSweeper")
+        self.daemon = True
+        self._hash_dicts = list(hash_dicts)
+        self._interval = interval
+        self._batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            for hash_dict in self._hash_dicts:
+                try:
+                    hash_dict.sweep(batch_size=self._batch_size)
+                except Exception:
+                    logging.exception("Failed to sweep expired keys of %s" % hash_dict.hash_key)
+            self._stopped.wait(self._interval)
+
+    def stop(self):
+        self._stopped.set()
 
 
 class ExpirablePickleRedisHashDict(ExpirableRedisHashDict, PickleSerializer):
@@ -213,6 +704,22 @@ class ExpirablePickleRedisHashDict(ExpirableRedisHashDict, PickleSerializer):
     pass
 
 
-class ExpirableJSONRedisHashDict(ExpirableRedisHashDict, JSONSerializer):
-    """Serialize hashmap values using JSON."""
+class ExpirableJSONRedisHashDict(JSONMergeMixin, ExpirableRedisHashDict, JSONSerializer):
+    """
+    Serialize hashmap values using JSON.
+    Upserts treat expired documents as missing, and renew the default expiration when one is set.
+    """
+
+    def _merge_keys(self):
+        self._check_legacy()
+        return [self.hash_key, self._expiration_key]
+
+    def _merge_expiration(self):
+        if self._default_expiration is None:
+            return ""
+        return self._default_expiration + time.time()
+
+
+class ExpirableCodecRedisHashDict(ExpirableRedisHashDict, CodecSerializer):
+    """Serialize hashmap values using a Codec."""
     pass
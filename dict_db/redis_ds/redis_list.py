@@ -1,14 +1,20 @@
 """A pythonic interface to a Redis list."""
 import redis_config as redis_config
-from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer
+from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer, CodecSerializer
 
 
 class RedisList(PassThroughSerializer):
     "Interface to a Redis list."
-    def __init__(self, list_key, redis_client=redis_config.CLIENT):
-        "Initialize interface."
+    DEFAULT_CHUNK_SIZE = 1000
+
+    def __init__(self, list_key, redis_client=redis_config.CLIENT, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Initialize interface.
+        :param chunk_size: number of values fetched per round trip when iterating
+        """
         self._client = redis_client
         self.list_key = list_key
+        self._chunk_size = chunk_size
 
     def __len__(self):
         "Number of values in list."
@@ -27,8 +33,34 @@ class RedisList(PassThroughSerializer):
             raise IndexError
 
     def __iter__(self):
-        for i in range(0, len(self)):
-            yield self[i]
+        return self.iter_range()
+
+    def iter_range(self, start=0, stop=-1, chunk=None):
+        """
+        Stream the values between start and stop, fetching them in LRANGE windows
+        Note that values pushed or popped at the head during iteration shift the windows.
+        :param start: index of the first value
+        :param stop: index of the last value (inclusive, as in LRANGE), -1 for the end of the list
+        :param chunk: number of values per round trip, defaults to the list's chunk_size
+        :return an iterator over the deserialized values:
+        """
+        chunk = chunk or self._chunk_size
+        if start < 0 or stop < -1:
+            length = len(self)
+            if start < 0:
+                start = max(length + start, 0)
+            if stop < -1:
+                stop = length + stop
+        while stop == -1 or start <= stop:
+            end = start + chunk - 1
+            if stop != -1:
+                end = min(end, stop)
+            values = self._client.lrange(self.list_key, start, end)
+            for value in values:
+                yield self.deserialize(value)
+            if len(values) < end - start + 1:
+                break
+            start = end + 1
 
     def trim(self, start=0, end=-1):
         return self._client.ltrim(self.list_key, start, end)
@@ -77,3 +109,8 @@ class PickleRedisList(RedisList, PickleSerializer):
 class JSONRedisList(RedisList, JSONSerializer):
     "Serialize Redis List values via JSON."
     pass
+
+
+class CodecRedisList(RedisList, CodecSerializer):
+    "Serialize Redis List values via a Codec."
+    pass
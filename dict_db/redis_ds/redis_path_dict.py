@@ -7,6 +7,12 @@ import redis_config as redis_config
 
 
 class RedisPathDict(RedisDict):
+    """
+    A dictionary of Redis strings sharing a path prefix, whose keys are tracked in a set.
+    Bulk reads, writes and deletes go CHUNK_SIZE keys per round trip.
+    """
+
+    CHUNK_SIZE = 1000
 
     def __init__(self, path, redis_client=redis_config.CLIENT):
         super(RedisPathDict, self).__init__(redis_client=redis_client)
@@ -17,33 +23,85 @@ class RedisPathDict(RedisDict):
     def path(self):
         return self._path
 
-    def keys(self, pattern="*"):
-        """Keys for Redis dictionary."""
-        pattern = self._build_path(pattern)
-        return self._client.keys(pattern)
-
-    def delete_all(self):
-        for key in self._keys:
-            with self._client:
-                    self._client.delete(key)
-                    self._keys.delete_all()
+    def _key_pattern(self, pattern=None):
+        return self._build_path(pattern or "*")
+
+    def _iter_key_chunks(self, chunk=None):
+        """
+        :return an iterator over lists of up to chunk keys:
+        """
+        chunk = chunk or self.CHUNK_SIZE
+        keys = []
+        for key in self._client.sscan_iter(self._keys.set_key, count=chunk):
+            keys.append(key)
+            if len(keys) == chunk:
+                yield keys
+                keys = []
+        if keys:
+            yield keys
+
+    def delete_all(self, chunk=None):
+        """
+        Delete all the keys, UNLINKing (freeing memory in the background) chunk keys per round trip.
+        UNLINK requires Redis 4.0 or later.
+        """
+        for keys in self._iter_key_chunks(chunk):
+            self._client.execute_command("UNLINK", *[self._build_path(key) for key in keys])
+        self._client.execute_command("UNLINK", self._keys.set_key)
 
     def __len__(self):
         return len(self._keys)
 
     def __iter__(self):
-        for key in self._keys:
-            yield key
+        for keys in self._iter_key_chunks():
+            for key in keys:
+                yield key
 
     iterkeys = __iter__
 
-    def itervalues(self):
-        for key in self:
-            yield self[key]
-
-    def iteritems(self):
-        for key in self:
-            yield key, self[key]
+    def itervalues(self, chunk=None):
+        for key, value in self.iteritems(chunk):
+            yield value
+
+    def iteritems(self, chunk=None):
+        """
+        :param chunk: number of values fetched per round trip (MGET)
+        :return an iterator over the (key, value) items:
+        """
+        for keys in self._iter_key_chunks(chunk):
+            values = self._client.mget([self._build_path(key) for key in keys])
+            for key, value in zip(keys, values):
+                yield key, self.deserialize(value)
+
+    def _pipeline(self):
+        """
+        Commands are queued on the calling thread's transaction (with client:) if there is one, so they're
+        committed with it
+        :return a pipeline, and whether it's the transaction's- which executes it on exit:
+        """
+        pipe = getattr(self._client, "current_pipe", None)
+        if pipe is not None:
+            return pipe, True
+        return self._client.pipeline(), False
+
+    def set_many(self, mapping, chunk=None):
+        """
+        Set many keys, chunk keys (and their registration in the keys set) per round trip.
+        Within a transaction (with client:) they're all queued on it.
+        :param mapping: a dict of keys to values
+        """
+        items = mapping.items()
+        chunk = chunk or self.CHUNK_SIZE
+        for i in xrange(0, len(items), chunk):
+            pipe, queued = self._pipeline()
+            pipe.sadd(self._keys.set_key, *[key for key, val in items[i:i + chunk]])
+            for key, val in items[i:i + chunk]:
+                if isinstance(self.default_expiration, int):
+                    pipe.setex(self._build_path(key), self.serialize(val), self.default_expiration)
+                else:
+                    pipe.set(self._build_path(key), self.serialize(val))
+            if not queued:
+                pipe.execute()
 
     def _build_path(self, key, prefix=None):
         if prefix is None:
@@ -1,41 +1,229 @@
 __author__ = 'OrW'
 
-from redis import Redis
+import threading
+import time
+
+from redis import Redis, ConnectionError, TimeoutError
 
 
 class RedisPipe(Redis):
     """
     A Wrapper of the Redis client that allows using the with statement to channel all
     calls within the block into a transaction.
+    Transactions are per-thread, so a single client can be shared by many threads-
+    calls made by other threads while one thread is in a with block are not channeled into its transaction.
+    Commands are channeled at execute_command, which every redis command goes through,
+    so attribute lookups cost the same as on a plain Redis client.
     """
 
-    def __init__(self):
-        self._current_pipe = None
-        super(RedisPipe, self).__init__()
-        self._transaction_results = None
-
-    def __getattribute__(self, name):
-        current_pipe = super(RedisPipe, self).__getattribute__("_current_pipe")
-        if name == "_current_pipe":
-            return current_pipe
-        elif current_pipe is not None:
-            return getattr(current_pipe, name)
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: passed on to the Redis client (host, port, connection_pool...)
+        """
+        self._local = threading.local()
+        super(RedisPipe, self).__init__(**kwargs)
+
+    @property
+    def current_pipe(self):
+        """
+        :return the pipeline of the calling thread's transaction, None outside of a with block:
+        """
+        return getattr(self._local, "pipe", None)
+
+    def execute_command(self, *args, **options):
+        pipe = getattr(self._local, "pipe", None)
+        if pipe is not None:
+            return pipe.execute_command(*args, **options)
         else:
-            return super(RedisPipe, self).__getattribute__(name)
+            return super(RedisPipe, self).execute_command(*args, **options)
 
     def __enter__(self):
-        assert self._current_pipe is None
-        self._current_pipe = self.pipeline()
+        assert self.current_pipe is None, "Nested transactions are not supported"
+        self._local.pipe = self.pipeline()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._current_pipe.execute()
-        self._current_pipe = None
+        pipe = self._local.pipe
+        self._local.pipe = None
+        self._local.transaction_results = pipe.execute()
 
     @property
     def transaction_results(self):
         """
-        :return the results returned by the last transaction __exit__:
+        :return the results returned by the last transaction __exit__ of the calling thread:
         """
-        return self._transaction_results
+        return getattr(self._local, "transaction_results", None)
+
+
+class CommandFuture(object):
+    """
+    The reply of a command sent in a batch.
+    """
+
+    def __init__(self):
+        # Held until the reply arrives- cheaper than an Event
+        self._pending = threading.Lock()
+        self._pending.acquire()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._pending.release()
+
+    def set_exception(self, error):
+        self._error = error
+        self._pending.release()
+
+    def result(self, timeout=None):
+        """
+        :param timeout: seconds to wait for the reply, None to wait until it arrives
+        :return the reply, blocking until it arrives- raises the command's error:
+        """
+        if timeout is None:
+            self._pending.acquire()
+        elif not self._pending.acquire(False):
+            # Locks can't be acquired with a timeout, poll them as threading.Condition.wait does
+            deadline = time.time() + timeout
+            delay = 0.0001
+            while not self._pending.acquire(False):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("No reply within %s seconds" % timeout)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.05)
+        self._pending.release()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
 
+class BatchingRedisPipe(RedisPipe):
+    """
+    A RedisPipe that coalesces the commands of concurrent callers into pipelines (not transactions).
+    The first command of a batch waits up to batch_delay seconds for commands of other threads to join it,
+    or until batch_size commands joined, and the batch is sent in a single round trip. Every caller blocks until
+    its own reply arrives, so data-structures using the client are unchanged.
+    A command is sent at once, without waiting, when no batch is being sent- a single thread doesn't slow down,
+    and batches form while the server is busy with earlier ones.
+    Transactions (with blocks), blocking and connection-state commands are sent as by a RedisPipe.
+    With a socket_timeout, callers wait for their replies up to the time a batch's round trip may take,
+    and raise a TimeoutError after it.
+    """
+
+    DEFAULT_BATCH_DELAY = 0.0002
+    DEFAULT_BATCH_SIZE = 100
+
+    # Commands that block, or change the state of their connection, are never batched
+    UNBATCHED_COMMANDS = frozenset(["BLPOP", "BRPOP", "BRPOPLPUSH", "BZPOPMIN", "BZPOPMAX", "WAIT", "WATCH",
+                                    "UNWATCH", "MULTI", "EXEC", "DISCARD", "SELECT", "MONITOR", "SUBSCRIBE",
+                                    "PSUBSCRIBE", "SHUTDOWN"])
+    BLOCKING_READS = frozenset(["XREAD", "XREADGROUP"])
+
+    def __init__(self, batch_delay=DEFAULT_BATCH_DELAY, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+        """
+        :param batch_delay: seconds the first command of a batch waits for more commands
+        :param batch_size: number of commands that sends a batch right away
+        :param kwargs: passed on to the Redis client (host, port, connection_pool...)
+        """
+        super(BatchingRedisPipe, self).__init__(**kwargs)
+        self._batch_delay = batch_delay
+        self._batch_size = batch_size
+        self._batch_lock = threading.Lock()
+        self._batch = None
+        self._batches_in_flight = 0
+        self._stats = {"commands": 0, "batches": 0}
+        self._reply_timeout = self._get_reply_timeout()
+
+    def _get_reply_timeout(self):
+        """
+        :return seconds a batch's round trip may take- connecting, sending and reading its replies,
+            None without a socket_timeout:
+        """
+        kwargs = self.connection_pool.connection_kwargs
+        socket_timeout = kwargs.get("socket_timeout")
+        if socket_timeout is None:
+            return None
+        return (kwargs.get("socket_connect_timeout") or socket_timeout) + 2 * socket_timeout + self._batch_delay
+
+    def _is_batched(self, args):
+        command = str(args[0]).upper()
+        if command in self.UNBATCHED_COMMANDS:
+            return False
+        if command in self.BLOCKING_READS:
+            return "BLOCK" not in (str(arg).upper() for arg in args[1:])
+        return True
+
+    def execute_command(self, *args, **options):
+        if self.current_pipe is not None or not self._is_batched(args):
+            return super(BatchingRedisPipe, self).execute_command(*args, **options)
+        future = CommandFuture()
+        with self._batch_lock:
+            batch = self._batch
+            is_first = batch is None
+            if is_first:
+                batch = self._batch = []
+            batch.append((args, options, future))
+            # Send at once a full batch, or when there is nothing to wait for
+            send = len(batch) >= self._batch_size or (is_first and not self._batches_in_flight)
+            if send:
+                self._detach_batch()
+        if is_first and not send:
+            try:
+                time.sleep(self._batch_delay)
+            except BaseException:
+                # Send the batch even so, the other callers in it wait for their replies
+                if self._take_batch(batch):
+                    self._send_batch(batch)
+                raise
+            send = self._take_batch(batch)
+        if send:
+            self._send_batch(batch)
+        return future.result(self._reply_timeout)
+
+    def _take_batch(self, batch):
+        """
+        :return whether the batch is still pending, and was detached to be sent by the caller:
+        """
+        with self._batch_lock:
+            if self._batch is batch:
+                self._detach_batch()
+                return True
+            return False
+
+    def _detach_batch(self):
+        """Start a new batch, the current one is about to be sent. Called with the batch lock held."""
+        self._batch = None
+        self._batches_in_flight += 1
+
+    def _send_batch(self, batch):
+        interrupt = None
+        try:
+            pipe = self.pipeline(transaction=False)
+            for args, options, future in batch:
+                pipe.execute_command(*args, **options)
+            results = pipe.execute(raise_on_error=False)
+        except Exception, err:
+            results = [err] * len(batch)
+        except BaseException, interrupt:
+            # Fail the batch, and let the interrupt propagate
+            results = [ConnectionError("The batch was interrupted by %r" % interrupt)] * len(batch)
+        finally:
+            with self._batch_lock:
+                self._batches_in_flight -= 1
+                self._stats["batches"] += 1
+                self._stats["commands"] += len(batch)
+        for (args, options, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        if interrupt is not None:
+            raise interrupt
+
+    def batch_stats(self):
+        """
+        :return the number of batched commands, and of the batches (round trips) they were sent in:
+        """
+        with self._batch_lock:
+            return dict(self._stats)
@@ -2,7 +2,7 @@
 
 import redis_config
 import redis_pipe
-from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer
+from serialization import PassThroughSerializer, PickleSerializer, JSONSerializer, CodecSerializer
 
 
 class RedisSet(PassThroughSerializer):
@@ -65,3 +65,8 @@ class JSONRedisSet(RedisSet, JSONSerializer):
     "JSON values stored in set."
     pass
 
+
+class CodecRedisSet(RedisSet, CodecSerializer):
+    "Codec values stored in set."
+    pass
+
@@ -0,0 +1,224 @@
+"""
+Client-side sharding over several Redis nodes.
+A HashRing maps keys to nodes by consistent hashing, so adding a node only moves about 1/N of the keys.
+ShardedRedisHashDict splits a single hash-map into sub-hashes spread over the nodes, e.g.:
+
+    ring = HashRing([RedisPipe(host="redis1"), RedisPipe(host="redis2")])
+    rhd = ShardedRedisHashDict("huge_hash", ring, shards=16)
+"""
+__author__ = 'OrW'
+
+import bisect
+import hashlib
+import threading
+import UserDict
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from redis_hash_dict import JSONRedisHashDict
+
+FAN_OUT_POOL_SIZE = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def fan_out_pool():
+    """
+    :return the process-wide thread pool running per-node calls in parallel, created on first use:
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(FAN_OUT_POOL_SIZE)
+        return _pool
+
+
+def node_name(client):
+    """
+    :return a name identifying a redis client's endpoint, which places it on the ring:
+    """
+    kwargs = client.connection_pool.connection_kwargs
+    if "path" in kwargs:
+        return "%s/%s" % (kwargs["path"], kwargs.get("db", 0))
+    return "%s:%s/%s" % (kwargs.get("host", "localhost"), kwargs.get("port", 6379), kwargs.get("db", 0))
+
+
+class HashRing(object):
+    """
+    A consistent hashing ring of redis clients.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        """
+        :param nodes: a list of redis clients, or a dict of names to redis clients
+        :param replicas: points per node on the ring- more points spread the keys more evenly
+        """
+        if not isinstance(nodes, dict):
+            nodes = {node_name(node): node for node in nodes}
+        assert nodes, "A ring needs at least one node"
+        self._nodes = nodes
+        self._ring = sorted((self._hash("%s#%d" % (name, i)), name)
+                            for name in nodes for i in xrange(replicas))
+        self._points = [point for point, name in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    @property
+    def nodes(self):
+        return self._nodes.values()
+
+    def get_node_name(self, key):
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._ring[index][1]
+
+    def get_node(self, key):
+        """
+        :return the redis client of the node the key is placed on:
+        """
+        return self._nodes[self.get_node_name(key)]
+
+
+class ShardedRedisHashDict(UserDict.DictMixin):
+    """
+    A hash-map too large for a single Redis node, split into sub-hashes ("<hash_key>|<shard>")
+    that a HashRing places on different nodes. Each field lives in the sub-hash its CRC32 selects.
+    Multi-key operations (get_many, set_many, len, delete_all) run in parallel, a single call per sub-hash.
+    Transactions (with client:) can't span sub-hashes on different nodes.
+    """
+
+    def __init__(self, hash_key, ring, shards=None, hash_dict_class=JSONRedisHashDict):
+        """
+        :param ring: the HashRing of the nodes
+        :param shards: number of sub-hashes, defaults to the number of nodes.
+            More sub-hashes than nodes spread the fields more evenly (and ease adding nodes later).
+            Changing the number of sub-hashes of an existing hash-map loses track of its fields.
+        :param hash_dict_class: the RedisHashDict class (serialization) of the sub-hashes
+        """
+        self.hash_key = hash_key
+        self._ring = ring
+        shard_keys = ["%s|%d" % (hash_key, i) for i in xrange(shards or len(ring.nodes))]
+        self._shards = [hash_dict_class(shard_key, redis_client=ring.get_node(shard_key)) for shard_key in shard_keys]
+
+    @property
+    def shards(self):
+        """
+        :return the sub-hashes' RedisHashDicts:
+        """
+        return self._shards
+
+    def _shard(self, key):
+        # Unicode keys are hashed by their UTF-8 encoding, the bytes Redis stores them as
+        key = key.encode("utf-8") if isinstance(key, unicode) else str(key)
+        return self._shards[(zlib.crc32(key) & 0xffffffff) % len(self._shards)]
+
+    def _group(self, keys):
+        """
+        :return a dict of sub-hashes to the keys they hold:
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard(key), []).append(key)
+        return groups
+
+    @staticmethod
+    def _fan_out(func, args):
+        """
+        :return [func(arg) for arg in args], calling func in parallel:
+        """
+        if len(args) < 2:
+            return map(func, args)
+        return fan_out_pool().map(func, args)
+
+    def keys(self):
+        return [key for keys in self._fan_out(lambda shard: shard.keys(), self._shards) for key in keys]
+
+    def iteritems(self):
+        for shard in self._shards:
+            for item in shard.iteritems():
+                yield item
+
+    def iteritems_cursor(self, cursor="0"):
+        """
+        Same as RedisHashDict.iteritems_cursor, the cursor "<shard>:<cursor>" continuing across the sub-hashes
+        """
+        shard_index, shard_cursor = (0, "0") if cursor == "0" else cursor.split(":", 1)
+        for i in xrange(int(shard_index), len(self._shards)):
+            for next_cursor, item in self._shards[i].iteritems_cursor(shard_cursor):
+                if next_cursor == 0:
+                    # Continue with the next sub-hash
+                    yield ("%d:0" % (i + 1) if i + 1 < len(self._shards) else 0), item
+                else:
+                    yield "%d:%s" % (i, next_cursor), item
+            shard_cursor = "0"
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def __len__(self):
+        return sum(self._fan_out(len, self._shards))
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def get_many(self, keys, default=None):
+        """
+        Retrieve several keys, a single round trip per sub-hash, in parallel
+        :return a dict mapping every requested key to its value:
+        """
+        groups = self._group(keys).items()
+        values = {}
+        for shard_values in self._fan_out(lambda (shard, shard_keys): shard.get_many(shard_keys, default), groups):
+            values.update(shard_values)
+        return values
+
+    def increment_key(self, key, value=1):
+        return self._shard(key).increment_key(key, value)
+
+    def __setitem__(self, key, val):
+        return self._shard(key).__setitem__(key, val)
+
+    def set_many(self, mapping):
+        """
+        Set several keys, a single round trip per sub-hash, in parallel
+        """
+        groups = self._group(mapping).items()
+        self._fan_out(lambda (shard, keys): shard.set_many({key: mapping[key] for key in keys}), groups)
+        return True
+
+    def update(self, other=None, **kwargs):
+        """Same as dict.update, but sends the keys of each sub-hash in a single round trip."""
+        mapping = {}
+        if other is not None:
+            mapping.update(other)
+        mapping.update(kwargs)
+        self.set_many(mapping)
+
+    def upsert(self, key, data, **kwargs):
+        """
+        @see the upsert of the sub-hashes' class
+        """
+        return self._shard(key).upsert(key, data, **kwargs)
+
+    def __delitem__(self, key):
+        return self._shard(key).__delitem__(key)
+
+    def delete_all(self):
+        self._fan_out(lambda shard: shard.delete_all(), self._shards)
+
+    def __contains__(self, key):
+        return self._shard(key).__contains__(key)
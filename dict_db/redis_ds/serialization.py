@@ -1,5 +1,6 @@
 "Mixins for serializing objects."
 import json
+import zlib
 import cPickle as pickle
 
 
@@ -52,3 +53,116 @@ class JSONSerializer(PassThroughSerializer):
                 return json.loads(obj)
             except Exception, err:
                 return self.LoadFailure(obj, err)
+
+
+# Binary codecs
+# Every encoded value starts with a header byte naming its format (or compression),
+# so values written with other codecs - or before codecs were used - stay readable.
+# Header bytes are control characters, which never start JSON or pickle data.
+
+FORMATS = {}
+COMPRESSIONS = {}
+_HEADERS = {}
+
+
+def register_format(name, header, dumps, loads):
+    """
+    Register a serialization format for Codec
+    :param name: the format name, as passed to Codec
+    :param header: a single, unused control character marking values of this format
+    :param dumps: obj -> str
+    :param loads: str -> obj
+    """
+    assert header not in _HEADERS, "Header %r already used by %s" % (header, _HEADERS.get(header))
+    FORMATS[name] = (header, dumps, loads)
+    _HEADERS[header] = name
+
+
+def register_compression(name, header, compress, decompress):
+    """
+    Register a compression for Codec
+    :param name: the compression name, as passed to Codec
+    :param header: a single, unused control character marking values compressed with it
+    :param compress: str -> str
+    :param decompress: str -> str
+    """
+    assert header not in _HEADERS, "Header %r already used by %s" % (header, _HEADERS.get(header))
+    COMPRESSIONS[name] = (header, compress, decompress)
+    _HEADERS[header] = name
+
+
+register_format("json", "\x01",
+                lambda obj: json.dumps(obj, skipkeys=True, default=JSONSerializer.default_none), json.loads)
+register_format("pickle", "\x02", lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), pickle.loads)
+register_compression("zlib", "\x11", zlib.compress, zlib.decompress)
+
+try:
+    import msgpack
+    register_format("msgpack", "\x03", lambda obj: msgpack.packb(obj, use_bin_type=True),
+                    lambda data: msgpack.unpackb(data, raw=False))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    register_compression("lz4", "\x12", lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+class Codec(object):
+    """
+    Encodes values with a registered format, compressing values above a size threshold.
+    """
+
+    def __init__(self, format_name="json", compression=None, compression_threshold=1024, legacy_format="json"):
+        """
+        :param format_name: a registered format to encode values with
+        :param compression: a registered compression, None to never compress
+        :param compression_threshold: values shorter than this (in bytes) are not compressed
+        :param legacy_format: the format of header-less values, written before codecs were used
+        """
+        if format_name not in FORMATS:
+            raise ValueError("Unknown serialization format %s, available: %s" % (format_name, FORMATS.keys()))
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %s, available: %s" % (compression, COMPRESSIONS.keys()))
+        self._header, self._dumps, _ = FORMATS[format_name]
+        self._compression = COMPRESSIONS.get(compression)
+        self._compression_threshold = compression_threshold
+        self._legacy_loads = FORMATS[legacy_format][2]
+
+    def encode(self, obj):
+        data = self._header + self._dumps(obj)
+        if self._compression is not None and len(data) >= self._compression_threshold:
+            header, compress, _ = self._compression
+            compressed = header + compress(data)
+            if len(compressed) < len(data):
+                return compressed
+        return data
+
+    def decode(self, data):
+        name = _HEADERS.get(data[:1])
+        if name in COMPRESSIONS:
+            return self.decode(COMPRESSIONS[name][2](data[1:]))
+        elif name in FORMATS:
+            return FORMATS[name][2](data[1:])
+        else:
+            return self._legacy_loads(data)
+
+
+class CodecSerializer(PassThroughSerializer):
+    """Serialize values using a Codec, assign an instance's codec to change its format."""
+    codec = Codec()
+    LoadFailure = JSONSerializer.LoadFailure
+
+    def serialize(self, obj):
+        return self.codec.encode(obj)
+
+    def deserialize(self, obj):
+        if obj is None:
+            return None
+        else:
+            try:
+                return self.codec.decode(obj)
+            except Exception, err:
+                return self.LoadFailure(obj, err)
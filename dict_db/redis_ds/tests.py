@@ -1,22 +1,31 @@
 "Tests for redis datastructures."
 import random
+import signal
 import unittest
 import sys
 import os
 import time
 import threading
 import redis_pipe
+import redis_config
+from redis import ResponseError
 
 sys.path.append(os.path.join(os.path.dirname(__file__), os.path.pardir))
 
 
 from redis_dict import RedisDict, PickleRedisDict, JSONRedisDict
 from redis_hash_dict import RedisHashDict, PickleRedisHashDict, JSONRedisHashDict,\
-                            ExpirableRedisHashDict, ExpirablePickleRedisHashDict, ExpirableJSONRedisHashDict
+                            ExpirableRedisHashDict, ExpirablePickleRedisHashDict, ExpirableJSONRedisHashDict,\
+                            CodecRedisHashDict
 from redis_path_dict import RedisPathDict
 from redis_list import RedisList, PickleRedisList, JSONRedisList
 from redis_set import RedisSet, PickleRedisSet, JSONRedisSet
-from message_queue import PickleMessageQueue
+from message_queue import PickleMessageQueue, StreamMessageQueue, PickleStreamMessageQueue, QueueApi
+from queue_dispatcher import QueueDispatcher
+from redis_async import AsyncRedisDs
+from serialization import Codec, FORMATS, COMPRESSIONS
+from redis_cache import LocalCache, KeyspaceInvalidator, JSONCachedRedisHashDict
+from redis_shard import HashRing, ShardedRedisHashDict
 
 
 
@@ -44,6 +53,37 @@ class TestRedisDatastructures(unittest.TestCase):
             self.assertFalse(key in rd)
             self.assertEqual(len(rd), init_size)
 
+    def test_redis_dict_scan(self):
+        "Test the SCAN based key enumeration of the redis dict and path dict."
+        rd = RedisDict(pattern="%s.scan.*" % self.prefix)
+        for key in rd.keys():
+            del rd[key]
+        keys = ["%s.scan.%d" % (self.prefix, i) for i in xrange(25)]
+        for key in keys:
+            rd[key] = 1
+        self.assertItemsEqual(rd.keys(), keys)
+        self.assertItemsEqual(rd, keys)
+        self.assertEqual(len(rd), 25)
+        self.assertItemsEqual(rd.keys("%s.scan.1*" % self.prefix), keys[1:2] + keys[10:20])
+
+        # Resume iteration from the cursor of the first segment
+        rd.SCAN_COUNT = 5
+        scanned = list(rd.scan_keys_cursor())
+        self.assertItemsEqual([key for cursor, key in scanned], keys)
+        first_cursor = scanned[0][0]
+        first_segment = [key for cursor, key in scanned if cursor == first_cursor]
+        self.assertEqual([key for cursor, key in rd.scan_keys_cursor(first_cursor)],
+                         [key for cursor, key in scanned[len(first_segment):]])
+        for key in keys:
+            del rd[key]
+
+        rpd = RedisPathDict("%s.scan_path" % self.prefix)
+        rpd.delete_all()
+        rpd["a"] = 1
+        rpd["b"] = 2
+        self.assertItemsEqual(rpd.keys(), [rpd._build_path("a"), rpd._build_path("b")])
+        rpd.delete_all()
+
     def test_redis_hash_dict(self):
         "Test the redis hash dict implementation."
         hash_key = "%s.hash_dict" % self.prefix
@@ -69,6 +109,179 @@ class TestRedisDatastructures(unittest.TestCase):
             self.assertFalse(key in rhd)
             self.assertEqual(len(rhd), 0)
 
+    def test_redis_hash_dict_many(self):
+        "Test the batched get/set of the redis hash dict."
+        hash_key = "%s.hash_dict" % self.prefix
+
+        for class_impl in (RedisHashDict, PickleRedisHashDict, JSONRedisHashDict):
+            rhd = class_impl(hash_key)
+            rhd.delete_all()
+            self.assertEqual(rhd.get_many([]), {})
+            rhd.set_many({"a": 1, "b": 2})
+            rhd.update({"c": 3}, d=4)
+            self.assertEqual(len(rhd), 4)
+            values = rhd.get_many(["a", "b", "c", "d", "missing"])
+            self.assertEqual(values["missing"], None)
+            for key, expected in (("a", 1), ("b", 2), ("c", 3), ("d", 4)):
+                self.assertTrue(values[key] in (str(expected), expected))
+            rhd.delete_all()
+
+    def test_json_upsert(self):
+        "Test the scripted merge of JSON documents."
+        hash_key = "%s.upsert_hash_dict" % self.prefix
+
+        for class_impl in (JSONRedisHashDict, ExpirableJSONRedisHashDict):
+            rhd = class_impl(hash_key)
+            rhd.delete_all()
+            rhd["doc"] = {"name": "a", "count": 1}
+            rhd.upsert("doc", {"name": "b"}, increments={"count": 2})
+            rhd.upsert("new", {"name": "c"})
+            self.assertEqual(rhd["doc"], {"name": "b", "count": 3})
+            self.assertEqual(rhd["new"], {"name": "c"})
+            rhd.upsert_many({"doc": {"tag": "x"}, "other": {"tag": "y"}}, increments={"doc": {"count": 1}})
+            self.assertEqual(rhd["doc"], {"name": "b", "count": 4, "tag": "x"})
+            self.assertEqual(rhd["other"], {"tag": "y"})
+            rhd.delete_all()
+
+        rhd = ExpirableJSONRedisHashDict(hash_key)
+        rhd.set("doc", {"name": "a"}, timeout=-1)
+        rhd.set_default_expiration(100)
+        rhd.upsert("doc", {"count": 1})
+        self.assertEqual(rhd["doc"], {"count": 1})
+        self.assertFalse(rhd.should_expire("doc"))
+        rhd.delete_all()
+
+        # Without a default expiration, the upserted document doesn't inherit the expired one's expiration
+        rhd = ExpirableJSONRedisHashDict(hash_key)
+        rhd.set("doc", {"a": 1}, timeout=-1)
+        rhd.upsert("doc", {"b": 2})
+        self.assertEqual(rhd["doc"], {"b": 2})
+        self.assertFalse(rhd.should_expire("doc"))
+        rhd.delete_all()
+
+    def test_json_upsert_round_trip(self):
+        "Test that upserts keep the fields they don't touch exactly as they were."
+        hash_key = "%s.upsert_hash_dict" % self.prefix
+        rhd = JSONRedisHashDict(hash_key)
+        rhd.delete_all()
+        doc = {"tags": [], "empty": {}, "id": 12345678901234567, "ratio": 0.1234567890123456789,
+               "nested": {"a": [1, {"b": "}\\\"]"}], "c": None}, u"\u05e9\u05dd": u"\u05e2\"x\"", "flag": False}
+        rhd["doc"] = doc
+        stored = rhd.client.hget(hash_key, "doc")
+        rhd.upsert("doc", {"name": "x"}, increments={"count": 1, "total": 0.1})
+        rhd.upsert("doc", {"name": "y"}, increments={"total": 0.2})
+        expected = dict(doc, name="y", count=1, total=0.1 + 0.2)
+        self.assertEqual(rhd["doc"], expected)
+        self.assertEqual(type(rhd["doc"]["total"]), float)
+        # The untouched fields' text is kept as it was
+        for key in doc:
+            self.assertIn(rhd.serialize({key: doc[key]})[1:-1], stored)
+            self.assertIn(rhd.serialize({key: doc[key]})[1:-1], rhd.client.hget(hash_key, "doc"))
+        # Integers doubles can't hold exactly aren't incremented, and nothing is written
+        self.assertRaises(ResponseError, rhd.upsert_many, {"doc": {"name": "z"}, "other": {}},
+                          increments={"doc": {"id": 1}})
+        self.assertEqual(rhd["doc"], expected)
+        self.assertFalse("other" in rhd)
+        # Values that aren't JSON objects are replaced
+        rhd["scalar"] = 5
+        rhd.upsert("scalar", {"a": 1})
+        self.assertEqual(rhd["scalar"], {"a": 1})
+        rhd.delete_all()
+
+    def test_scripts_in_transaction(self):
+        "Test that scripts queued in a transaction are loaded before it executes."
+        hash_key = "%s.upsert_hash_dict" % self.prefix
+        client = redis_pipe.RedisPipe()
+        rhd = ExpirableJSONRedisHashDict(hash_key, redis_client=client)
+        rhd.delete_all()
+        rhd.upsert("doc", {"a": 1})
+        rhd.set("old", 1, timeout=-1)
+        client.script_flush()
+        with client:
+            rhd.upsert("doc", {"b": 2})
+            rhd.sweep()
+        self.assertEqual(client.transaction_results, [1, 1])
+        self.assertEqual(rhd["doc"], {"a": 1, "b": 2})
+        self.assertFalse("old" in rhd)
+        rhd.delete_all()
+
+    def test_codec_redis_hash_dict(self):
+        "Test the codec formats, compression and reading of values written by other codecs."
+        hash_key = "%s.codec_hash_dict" % self.prefix
+        value = {"a": [1, 2, "x" * 2000]}
+        JSONRedisHashDict(hash_key)["legacy"] = value
+        for format_name in FORMATS:
+            for compression in [None] + COMPRESSIONS.keys():
+                rhd = CodecRedisHashDict(hash_key)
+                rhd.codec = Codec(format_name, compression=compression)
+                rhd[format_name] = value
+                self.assertEqual(rhd[format_name], value)
+                self.assertEqual(rhd["legacy"], value)
+        # Corrupt values are returned as load failures
+        RedisHashDict(hash_key)["corrupt"] = "\x11not zlib"
+        failure = rhd["corrupt"]
+        self.assertTrue(isinstance(failure, rhd.LoadFailure))
+        self.assertEqual(failure.value, "\x11not zlib")
+        rhd.delete_all()
+
+    def test_local_cache(self):
+        "Test the LRU eviction and TTL of the local cache."
+        cache = LocalCache(max_size=2, ttl=0.1)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b", None), None)
+        self.assertEqual(cache.evictions, 1)
+        time.sleep(0.101)
+        self.assertEqual(cache.get("a", None), None)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_cached_redis_hash_dict(self):
+        "Test that the cached hash dict is invalidated by other writers."
+        hash_key = "%s.cached_hash_dict" % self.prefix
+        invalidator = KeyspaceInvalidator(pattern=hash_key, configure_server=True).start()
+        try:
+            rhd = JSONCachedRedisHashDict(hash_key, invalidator=invalidator)
+            rhd.delete_all()
+            rhd["a"] = 1
+            # Let the write's own notification arrive, a fetch racing it isn't cached
+            time.sleep(0.1)
+            self.assertEqual(rhd["a"], 1)
+            self.assertEqual(rhd["a"], 1)
+            self.assertEqual(rhd.cache.hits, 1)
+            JSONRedisHashDict(hash_key)["a"] = 2
+            time.sleep(0.1)
+            self.assertEqual(rhd["a"], 2)
+            rhd.delete_all()
+        finally:
+            invalidator.stop()
+
+    def test_cached_redis_hash_dict_race(self):
+        "Test that a value fetched while the cache was invalidated isn't cached."
+        hash_key = "%s.cached_hash_dict" % self.prefix
+        rhd = JSONCachedRedisHashDict(hash_key)
+        rhd.delete_all()
+        rhd["a"] = 1
+        client = rhd.client
+
+        class RacingClient(object):
+            def hget(self, name, key):
+                value = client.hget(name, key)
+                # Another writer's change is notified before the fetched value is cached
+                client.hset(name, key, "2")
+                rhd._invalidate(name)
+                return value
+
+        rhd._client = RacingClient()
+        self.assertEqual(rhd["a"], 1)
+        rhd._client = client
+        self.assertEqual(rhd["a"], 2)
+        self.assertEqual(rhd["a"], 2)
+        self.assertEqual(rhd.cache.hits, 1)
+        rhd.delete_all()
+
     def test_expirable_redis_hash_dict(self):
         "Test the redis hash dict implementation."
         hash_key = "%s.hash_dict" % self.prefix
@@ -100,6 +313,99 @@ class TestRedisDatastructures(unittest.TestCase):
             self.assertTrue(key not in rhd)
             del rhd[key]
 
+    def test_expirable_redis_hash_dict_sweep(self):
+        "Test the batched purge of expired keys."
+        hash_key = "%s.hash_dict" % self.prefix
+        rhd = ExpirableJSONRedisHashDict(hash_key)
+        rhd.delete_all()
+        rhd.set_default_expiration(0.1)
+        rhd.update({str(i): i for i in range(25)})
+        rhd.set("fresh", 1, timeout=None)
+        self.assertEqual(rhd.get_many(["1", "fresh"]), {"1": 1, "fresh": 1})
+        time.sleep(0.101)
+        self.assertEqual(rhd.get_many(["1", "fresh"]), {"1": None, "fresh": 1})
+        self.assertEqual(list(rhd.iter_fresh_items()), [("fresh", 1)])
+        self.assertEqual(rhd.sweep(batch_size=10), 25)
+        self.assertEqual(len(rhd), 1)
+        rhd.delete_all()
+
+    def test_expirable_redis_hash_dict_migration(self):
+        "Test moving expirations from the former pickled hash."
+        hash_key = "%s.hash_dict" % self.prefix
+        rhd = ExpirableJSONRedisHashDict(hash_key)
+        rhd.delete_all()
+        rhd["old"] = 1
+        rhd["forever"] = 2
+        legacy = PickleRedisHashDict("meta_%s|expiration" % hash_key)
+        legacy["old"] = time.time() - 1
+        legacy["forever"] = None
+        rhd.migrate_expirations()
+        self.assertFalse("old" in rhd)
+        self.assertTrue("forever" in rhd)
+        self.assertEqual(len(legacy), 0)
+        rhd.delete_all()
+        # A new hash-dict migrates them on first use
+        rhd["old"] = 1
+        legacy["old"] = time.time() - 1
+        rhd = ExpirableJSONRedisHashDict(hash_key)
+        self.assertFalse("old" in rhd)
+        self.assertEqual(len(legacy), 0)
+        rhd.delete_all()
+
+    def test_expirable_redis_hash_dict_transaction(self):
+        "Writes within a transaction are committed with it."
+        hash_key = "%s.hash_dict" % self.prefix
+        client = redis_pipe.RedisPipe()
+        rhd = ExpirableJSONRedisHashDict(hash_key, redis_client=client)
+        observer = ExpirableJSONRedisHashDict(hash_key)
+        rhd.delete_all()
+        rhd.update({"gone": 0, "kept": 1})
+        rhd.set_default_expiration(10)
+        with client:
+            rhd.update({"a": 1, "b": 2})
+            rhd.set("c", 3, timeout=None)
+            rhd.expire("kept", 20)
+            del rhd["gone"]
+            rhd.get_many(["a", "c"])
+            # Nothing was sent yet
+            self.assertEqual(sorted(observer.keys()), ["gone", "kept"])
+            self.assertEqual(observer.get_expiration("kept"), None)
+        # The get_many replies- it reads the transaction's own writes
+        self.assertEqual(client.transaction_results[-3], ["1", "3"])
+        self.assertEqual(client.transaction_results[-1], None)
+        self.assertEqual(observer.get_many(["a", "b", "c", "gone"]), {"a": 1, "b": 2, "c": 3, "gone": None})
+        self.assertTrue(observer.get_expiration("a") > time.time())
+        self.assertEqual(observer.get_expiration("c"), None)
+        self.assertTrue(observer.get_expiration("kept") > time.time() + 10)
+        # Single key reads are queued as well
+        with client:
+            rhd.get("c")
+            rhd["c"]
+            "c" in rhd
+        self.assertEqual(client.transaction_results, ["3", None, "3", None, True, None])
+        rhd.delete_all()
+
+
+    def test_redis_path_dict_many(self):
+        "Test the chunked reads, writes and deletes of the redis path dict."
+        rpd = RedisPathDict("%s.path_dict_many" % self.prefix)
+        rpd.delete_all()
+        values = {str(i): str(i * 10) for i in xrange(25)}
+        rpd.set_many(values, chunk=10)
+        self.assertEqual(len(rpd), 25)
+        self.assertEqual(dict(rpd.iteritems(chunk=7)), values)
+        self.assertItemsEqual(rpd.itervalues(), values.values())
+        rpd.delete_all(chunk=10)
+        self.assertEqual(len(rpd), 0)
+        self.assertFalse("1" in rpd)
+        # Within a transaction they're committed with it
+        client = redis_pipe.RedisPipe()
+        rpd = RedisPathDict("%s.path_dict_many" % self.prefix, redis_client=client)
+        with client:
+            rpd.set_many(values, chunk=10)
+            self.assertEqual(len(RedisPathDict("%s.path_dict_many" % self.prefix)), 0)
+        self.assertEqual(dict(rpd.iteritems()), values)
+        rpd.delete_all()
 
     # def test_redis_path_dict(self):
     #     "Test the redis hash dict implementation."
@@ -145,6 +451,21 @@ class TestRedisDatastructures(unittest.TestCase):
             self.assertEquals(rl.pop(), "b")
             self.assertEquals(rl.pop(), "a")
 
+    def test_redis_list_iteration(self):
+        "Test the chunked iteration of the redis list."
+        list_key = "%s.list" % self.prefix
+
+        for class_impl in (PickleRedisList, JSONRedisList):
+            rl = class_impl(list_key, chunk_size=3)
+            rl.delete()
+            for i in range(10):
+                rl.append(i)
+            self.assertEqual(list(rl), range(10))
+            self.assertEqual(list(rl.iter_range(2, 7, chunk=2)), range(2, 8))
+            self.assertEqual(list(rl.iter_range(-4)), range(6, 10))
+            rl.delete()
+            self.assertEqual(list(rl), [])
+
     def test_redis_set(self):
         "Test redis set."
         set_key = "%s.list" % self.prefix
@@ -165,6 +486,52 @@ class TestRedisDatastructures(unittest.TestCase):
             self.assertTrue(rs.pop() in ("a", "b"))
             self.assertEquals(len(rs), 0)
 
+    def test_async_redis_ds(self):
+        "Test non-blocking calls on a wrapped hash dict."
+        hash_key = "%s.async_hash_dict" % self.prefix
+        rhd = AsyncRedisDs(JSONRedisHashDict(hash_key))
+        rhd.delete_all().get()
+        for result in [rhd.setitem(str(i), i) for i in range(50)]:
+            result.get()
+        self.assertEqual(rhd.len().get(), 50)
+        self.assertEqual([result.get() for result in [rhd.get(str(i)) for i in range(50)]], range(50))
+        self.assertTrue(rhd.contains("1").get())
+        self.assertItemsEqual(rhd.collect().get(), [str(i) for i in range(50)])
+        rhd.delete_all().get()
+
+    def test_redis_pipe_threads(self):
+        "Test that concurrent transactions on a shared client don't capture other threads' calls."
+        client = redis_pipe.RedisPipe()
+        hash_key = "%s.pipe_threads" % self.prefix
+        client.delete(hash_key)
+        errors = []
+
+        def worker(worker_id):
+            try:
+                for i in range(100):
+                    field = "%s_%s" % (worker_id, i)
+                    if worker_id % 2:
+                        with client:
+                            client.hset(hash_key, field, i)
+                            client.hget(hash_key, field)
+                        if client.transaction_results != [1, str(i)]:
+                            errors.append((field, client.transaction_results))
+                    else:
+                        client.hset(hash_key, field, i)
+                        if client.hget(hash_key, field) != str(i):
+                            errors.append((field, None))
+            except Exception, err:
+                errors.append((worker_id, err))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(client.hlen(hash_key), 20 * 100)
+        client.delete(hash_key)
+
     def test_msg_queue(self):
         messages = [random.randrange(0, 300) for i in xrange(0, random.randrange(0, 100))] + ["stop"]
         client = redis_pipe.RedisPipe()
@@ -190,6 +557,348 @@ class TestRedisDatastructures(unittest.TestCase):
 
 
 
+    def test_msg_queue_write_many(self):
+        "Test publishing batches of messages to several channels."
+        channels = ["test_msg_q_many_%d" % i for i in xrange(3)]
+        writer = PickleMessageQueue(channels)
+        self.assertEqual(writer.write_many([1, 2], wait_for_readers=False), {channel: [0, 0] for channel in channels})
+        with PickleMessageQueue(channels[:2]) as reader:
+            # Wait for the server to register the subscriptions
+            while 0 in redis_config.CLIENT.execute_command("PUBSUB", "NUMSUB", *channels[:2])[1::2]:
+                time.sleep(0.001)
+            received = writer.write_many([1, 2, 3], wait_for_readers=False)
+            self.assertEqual(received, {channels[0]: [1, 1, 1], channels[1]: [1, 1, 1], channels[2]: [0, 0, 0]})
+            self.assertEqual([reader.read() for i in xrange(6)], [1, 1, 2, 2, 3, 3])
+            # A message that reached no reader is republished in order, with the ones following it
+            writer = PickleMessageQueue(channels[:1])
+            real_pipeline = writer._redis_client.pipeline
+            dropped = []
+
+            def pipeline(**kwargs):
+                pipe = real_pipeline(**kwargs)
+                execute = pipe.execute
+
+                def drop_second():
+                    counts = execute()
+                    if not dropped:
+                        dropped.append(counts[1])
+                        counts[1] = 0
+                    return counts
+                pipe.execute = drop_second
+                return pipe
+            writer._redis_client.pipeline = pipeline
+            self.assertEqual(writer.write_many([1, 2, 3]), {channels[0]: [1, 1, 1]})
+            self.assertEqual([reader.read() for i in xrange(4)], [1, 2, 3, 2])
+            self.assertEqual(reader.read(), 3)
+
+    def test_stream_msg_queue(self):
+        "Test the streams message queue, its batched writes, timeouts and redelivery of unacknowledged messages."
+        key = "%s.stream_msg_q" % self.prefix
+        messages = [random.randrange(0, 300) for i in xrange(0, random.randrange(0, 100))] + ["stop"]
+        writer = PickleStreamMessageQueue([key], max_len=1000)
+        writer.delete()
+
+        with PickleStreamMessageQueue([key], count=10) as reader:
+            writer.write_many(messages[:-1])
+            writer.write(messages[-1])
+            received_messages = []
+            while not received_messages or received_messages[-1] != "stop":
+                received_messages.append(reader.read())
+            self.assertEqual(received_messages, messages)
+            self.assertEqual(reader.read(timeout=0.1), None)
+
+        writer.write_many(["a", "b"])
+        with PickleStreamMessageQueue([key], consumer="consumer") as reader:
+            self.assertEqual([entry.message for entry in reader.read_entries()], ["a", "b"])
+        with PickleStreamMessageQueue([key], consumer="consumer") as reader:
+            entries = reader.read_entries(timeout=0.1)
+            self.assertEqual([entry.message for entry in entries], ["a", "b"])
+            reader.ack(entries)
+        with PickleStreamMessageQueue([key], consumer="consumer") as reader:
+            self.assertEqual(reader.read_entries(timeout=0.1), [])
+
+        # Recovery pages past entries trimmed out of the stream while pending
+        writer.write_many(["x", "y", "z"])
+        with PickleStreamMessageQueue([key], consumer="consumer") as reader:
+            self.assertEqual(len(reader.read_entries()), 3)
+        writer._redis_client.execute_command("XTRIM", key, "MAXLEN", 1)
+        with PickleStreamMessageQueue([key], consumer="consumer", count=2) as reader:
+            entries = reader.read_entries(timeout=0.1)
+            self.assertEqual([entry.message for entry in entries], ["z"])
+            reader.ack(entries)
+
+        # Messages pending with a dead reader for min_idle_time are claimed, paging through the pending list
+        writer.write_many(range(25))
+        with PickleStreamMessageQueue([key], consumer="dead") as reader:
+            self.assertEqual(len(reader.read_entries()), 25)
+        with PickleStreamMessageQueue([key], consumer="alive", count=10, min_idle_time=200) as reader:
+            self.assertEqual(reader.read_entries(timeout=0.1), [])
+            time.sleep(0.2)
+            entries = reader.read_entries(timeout=0.1)
+            self.assertEqual(sorted(entry.message for entry in entries), range(25))
+            reader.ack(entries)
+        self.assertEqual(writer._redis_client.execute_command("XPENDING", key, StreamMessageQueue.DEFAULT_GROUP,
+                                                              "-", "+", 100), [])
+        writer.delete()
+
+
+    def test_queue_dispatcher(self):
+        "Test the concurrent dispatch of api messages, its method limits, ordering and metrics."
+        counter_key = "%s.dispatch_counter" % self.prefix
+
+        class Api(QueueApi):
+            lock = threading.Lock()
+            running = []
+            max_running = [0]
+            calls = []
+
+            def slow(self, user, i):
+                with self.lock:
+                    self.running.append(i)
+                    self.max_running[0] = max(self.max_running[0], len(self.running))
+                time.sleep(0.01)
+                with self.lock:
+                    self.running.remove(i)
+                    self.calls.append((user, i))
+
+            def count(self):
+                redis_config.CLIENT.incr(counter_key)
+
+            released = threading.Event()
+
+            def blocked(self):
+                self.released.wait()
+
+        api = Api(["test_dispatch"])
+        with QueueDispatcher(api, workers=8, max_in_flight=4, method_limits={"slow": 2}, order_key="user") as dispatcher:
+            for i in xrange(20):
+                dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "slow", "user": i % 3, "i": i})
+            dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "missing"})
+            dispatcher.wait()
+            metrics = dispatcher.metrics()
+        self.assertEqual(api.max_running[0], 2)
+        for user in xrange(3):
+            self.assertEqual([i for u, i in api.calls if u == user], range(user, 20, 3))
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertEqual(metrics["methods"]["slow"]["calls"], 20)
+        self.assertEqual(metrics["methods"]["missing"]["errors"], 1)
+
+        redis_config.CLIENT.delete(counter_key)
+        with QueueDispatcher(api, workers=2, executor=QueueDispatcher.EXECUTOR_PROCESS) as dispatcher:
+            for i in xrange(10):
+                dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "count"})
+        self.assertEqual(int(redis_config.CLIENT.get(counter_key)), 10)
+        redis_config.CLIENT.delete(counter_key)
+
+        # Messages held back by a method limit don't take the slots of other methods
+        dispatcher = QueueDispatcher(api, workers=4, max_in_flight=2, max_waiting=10, method_limits={"blocked": 1})
+        for i in xrange(5):
+            dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "blocked"})
+        counting = threading.Thread(target=lambda: [dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "count"})
+                                                    for i in xrange(10)])
+        counting.start()
+        counting.join(5)
+        self.assertFalse(counting.is_alive())
+        self.assertFalse(dispatcher.wait(timeout=0.1))
+        self.assertEqual(dispatcher.metrics()["methods"]["blocked"]["waiting"], 4)
+        api.released.set()
+        dispatcher.close()
+        self.assertEqual(int(redis_config.CLIENT.get(counter_key)), 10)
+        self.assertEqual(dispatcher.metrics()["in_flight"], 0)
+        redis_config.CLIENT.delete(counter_key)
+
+        # A message the pool fails to send to a worker is recorded as an error
+        with QueueDispatcher(api, workers=1, executor=QueueDispatcher.EXECUTOR_PROCESS) as dispatcher:
+            dispatcher.dispatch({QueueApi.METHOD_NAME_KEY: "count", "unpicklable": lambda: None})
+            self.assertTrue(dispatcher.wait(timeout=5))
+            self.assertEqual(dispatcher.metrics()["methods"]["count"]["errors"], 1)
+
+    def test_sharded_redis_hash_dict(self):
+        "Test splitting a hash-map over several nodes."
+        # Separate DBs of the local server stand in for separate nodes
+        nodes = [redis_pipe.RedisPipe(db=db) for db in (1, 2, 3)]
+        ring = HashRing(nodes)
+        placed = [ring.get_node("key%d" % i) for i in xrange(300)]
+        for node in nodes:
+            self.assertTrue(placed.count(node) > 50)
+        # Adding a node only moves the keys placed on it
+        new_node = redis_pipe.RedisPipe(db=4)
+        grown = HashRing(nodes + [new_node])
+        moved = [i for i, node in enumerate(placed) if grown.get_node("key%d" % i) is not node]
+        self.assertTrue(all(grown.get_node("key%d" % i) is new_node for i in moved))
+        self.assertTrue(len(moved) < 150)
+
+        rhd = ShardedRedisHashDict("%s.sharded" % self.prefix, ring, shards=6)
+        rhd.delete_all()
+        rhd.set_many({"key%d" % i: i for i in xrange(100)})
+        self.assertEqual(len(rhd), 100)
+        self.assertEqual(set(node for node in (shard.client for shard in rhd.shards)), set(nodes))
+        self.assertTrue(all(len(shard) < 100 for shard in rhd.shards))
+        self.assertEqual(rhd.get_many(["key1", "key50", "missing"]), {"key1": 1, "key50": 50, "missing": None})
+        rhd["key1"] = {"a": 1}
+        rhd.upsert("key1", {"b": 2})
+        self.assertEqual(rhd["key1"], {"a": 1, "b": 2})
+        self.assertEqual(rhd.increment_key("key2"), 3)
+        del rhd["key3"]
+        self.assertFalse("key3" in rhd)
+        self.assertEqual(len(rhd.keys()), 99)
+        self.assertEqual(sorted(key for cursor, (key, value) in rhd.iteritems_cursor()), sorted(rhd))
+        # Unicode keys are placed by their UTF-8 encoding, as Redis stores them
+        key = u"\u05de\u05e4\u05ea\u05d7"
+        rhd[key] = 1
+        self.assertEqual(rhd[key], 1)
+        self.assertEqual(rhd[key.encode("utf-8")], 1)
+        self.assertEqual(rhd.get_many([key]), {key: 1})
+        rhd.delete_all()
+        self.assertEqual(len(rhd), 0)
+
+    def test_create_client(self):
+        "Test configuring the connection pool of a shared client."
+        client = redis_config.create_client(max_connections=2, socket_timeout=5, socket_keepalive=True)
+        pool = client.connection_pool
+        self.assertEqual(pool.max_connections, 2)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 5)
+        rhd = JSONRedisHashDict("%s.pool" % self.prefix, redis_client=client)
+        rhd["a"] = 1
+        self.assertEqual(rhd["a"], 1)
+        rhd.delete_all()
+
+        client = redis_config.create_client("redis://localhost:6379/1", socket_connect_timeout=1)
+        self.assertEqual(client.connection_pool.connection_kwargs["db"], 1)
+        self.assertEqual(client.connection_pool.connection_kwargs["socket_connect_timeout"], 1)
+        self.assertTrue(client.ping())
+        self.assertRaises(ValueError, redis_config.create_client, "redis://localhost:6379/1", db=2)
+
+    def test_lazy_client_fork(self):
+        "Test that a forked process creates its own default client."
+        client = redis_config.LazyClient(db=1)
+        self.assertIsNone(client._client)
+        rhd = JSONRedisHashDict("%s.lazy" % self.prefix, redis_client=client)
+        rhd["parent"] = 1
+        parent_client = client.client
+        self.assertEqual(parent_client.connection_pool.connection_kwargs["db"], 1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                rhd["child"] = 2
+                child_client = client.client
+                os._exit(0 if child_client is not parent_client and client.hset.__self__ is child_client else 1)
+            except Exception:
+                os._exit(2)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertIs(client.client, parent_client)
+        self.assertIs(client.hset.__self__, parent_client)
+        self.assertEqual(dict(rhd), {"parent": 1, "child": 2})
+        with client:
+            rhd["a"] = 1
+            rhd["b"] = 2
+        self.assertEqual(len(rhd), 4)
+
+        # The parent's client is left alone even when one of its locks was held at fork
+        client = redis_config.LazyClient(db=1, auto_batch=True)
+        rhd = JSONRedisHashDict("%s.lazy" % self.prefix, redis_client=client)
+        self.assertEqual(rhd["parent"], 1)
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with client.client._batch_lock:
+                locked.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.alarm(5)
+                os._exit(0 if rhd["parent"] == 1 else 1)
+            except BaseException:
+                os._exit(2)
+        release.set()
+        holder.join()
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        rhd.delete_all()
+
+    def test_batching_redis_pipe(self):
+        "Test coalescing the commands of concurrent threads."
+        client = redis_config.create_client(auto_batch=True, batch_delay=0.005, batch_size=20)
+        self.assertIsInstance(client, redis_pipe.BatchingRedisPipe)
+        rhd = JSONRedisHashDict("%s.batching" % self.prefix, redis_client=client)
+        rs = JSONRedisSet("%s.batching_set" % self.prefix, redis_client=client)
+        rhd.delete_all()
+        rs.delete_all()
+        rhd.update({str(i): i for i in xrange(100)})
+        errors = []
+        counts = []
+
+        def work(thread):
+            try:
+                for i in xrange(thread, 100, 10):
+                    self.assertEqual(rhd[str(i)], i)
+                    counts.append(rhd.increment_key("count"))
+                    rs.add(i)
+            except Exception, err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(counts), range(1, 101))
+        self.assertEqual(sorted(rs), range(100))
+        stats = client.batch_stats()
+        self.assertTrue(stats["batches"] < stats["commands"])
+
+        # Errors are raised by the failing command only
+        client.set("%s.batching_string" % self.prefix, "a")
+        self.assertRaises(ResponseError, client.hget, "%s.batching_string" % self.prefix, "a")
+        client.delete("%s.batching_string" % self.prefix)
+        # Transactions and blocking commands are not batched
+        with client:
+            rhd["a"] = 1
+            rhd["b"] = 2
+        self.assertEqual(rhd.get_many(["a", "b"]), {"a": 1, "b": 2})
+        client.rpush("%s.batching_list" % self.prefix, "x")
+        self.assertEqual(client.blpop("%s.batching_list" % self.prefix, 1)[1], "x")
+        rhd.delete_all()
+        rs.delete_all()
+
+    def test_batching_redis_pipe_interrupted(self):
+        "Test that a batch is sent even if its first caller is interrupted while waiting for more commands."
+        client = redis_pipe.BatchingRedisPipe(batch_delay=10, socket_timeout=1)
+        key = "%s.batching_interrupted" % self.prefix
+        replies = []
+        joined = threading.Thread(target=lambda: replies.append(client.set(key, "b")))
+        original_sleep = redis_pipe.time.sleep
+        interrupted = threading.current_thread()
+
+        def interrupted_sleep(seconds):
+            if threading.current_thread() is not interrupted:
+                return original_sleep(seconds)
+            joined.start()
+            while len(client._batch) < 2:
+                original_sleep(0.001)
+            raise KeyboardInterrupt()
+
+        # A batch in flight makes the first caller wait for more commands
+        client._batches_in_flight += 1
+        redis_pipe.time.sleep = interrupted_sleep
+        try:
+            self.assertRaises(KeyboardInterrupt, client.set, key, "a")
+        finally:
+            redis_pipe.time.sleep = original_sleep
+            client._batches_in_flight -= 1
+        joined.join(5)
+        self.assertEqual(replies, [True])
+        self.assertEqual(client.get(key), "b")
+        self.assertEqual(client.batch_stats()["batches"], 2)
+        client.delete(key)
+
+        # Replies are waited for up to the time a round trip may take
+        self.assertRaises(redis_pipe.TimeoutError, redis_pipe.CommandFuture().result, 0.01)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import instrumentation
+
+PACKAGE_PARENT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+# Prints the seconds an import took, and the backends it loaded
+IMPORT_SCRIPT = """
+import sys
+from timeit import default_timer
+start = default_timer()
+%s
+print default_timer() - start, " ".join(name for name in ("redis", "elasticsearch") if name in sys.modules)
+"""
+
+
+def bench_import(statement, repeat=5):
+    """
+    Time an import statement in fresh interpreters
+    :return the best seconds the import took, and the backends (redis, elasticsearch) it loaded:
+    """
+    timings = []
+    for i in xrange(repeat):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT % statement], cwd=PACKAGE_PARENT)
+        seconds, backends = (output.strip().split(" ", 1) + [""])[:2]
+        timings.append(float(seconds))
+    return min(timings), backends.split()
+
+
+class TestImports(unittest.TestCase):
+
+    def test_import_time(self):
+        "Importing the factory doesn't import the backends."
+        seconds, backends = bench_import("import dict_db")
+        backend_seconds, _ = bench_import("import redis, elasticsearch")
+        self.assertEqual(backends, [])
+        self.assertTrue(seconds < backend_seconds, "import dict_db: %.1f msec, import redis, elasticsearch: %.1f msec"
+                                                   % (seconds * 1e3, backend_seconds * 1e3))
+
+    def test_import_redis_ds(self):
+        "Importing the redis data-structures doesn't create the default client."
+        seconds, backends = bench_import("from dict_db.redis_ds import redis_hash_dict, redis_list, redis_shard\n"
+                                         "assert redis_hash_dict.redis_config.CLIENT._client is None")
+        self.assertEqual(backends, [])
+
+    def test_create_imports_backend(self):
+        "Using a data-structure imports its backend only."
+        seconds, backends = bench_import("from dict_db import DictDbFactory, Consts\n"
+                                         "DictDbFactory(Consts.DB_REDIS).create('test', 'imports').client.ping()")
+        self.assertEqual(backends, ["redis"])
+
+
+class TestDictDbFactory(unittest.TestCase):
+
+    def test_redis_nodes_with_options(self):
+        "The redis_options apply to the URL nodes, but for the server the URLs select."
+        from dict_db import DictDbFactory, Consts
+        factory = DictDbFactory(Consts.DB_REDIS, redis_nodes=["redis://localhost:6379/1", "redis://localhost:6379/2"],
+                                redis_options={"unix_socket_path": "/tmp/missing.sock", "db": 3,
+                                               "socket_timeout": 5, "max_connections": 10})
+        db = factory.create("test", "factory_nodes")
+        db["a"] = 1
+        self.assertEqual(db["a"], 1)
+        pool = db.client.connection_pool
+        self.assertIn(pool.connection_kwargs["db"], (1, 2))
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 5)
+        self.assertEqual(pool.max_connections, 10)
+        db.delete_all()
+
+    def test_unsupported_ds_type(self):
+        "Creating an unsupported data-structure fails clearly, with or without a codec."
+        from dict_db import DictDbFactory, Consts
+        for serialization in (Consts.SER_JSON, Consts.SER_PICKLE):
+            factory = DictDbFactory(Consts.DB_REDIS, serialization=serialization)
+            self.assertRaises(ValueError, factory.create, "test", "unsupported", ds_type="set")
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+
+    def test_redis_metrics(self):
+        from redis_ds.redis_hash_dict import RedisHashDict, JSONRedisHashDict
+        original = RedisHashDict.__dict__["get"]
+        registry = instrumentation.enable()
+        rhd = JSONRedisHashDict("test_instrumentation")
+        rhd.delete_all()
+        rhd.update({"a": 1, "b": "bb"})
+        for i in xrange(10):
+            rhd.get("a")
+        self.assertEqual(rhd.get_many(["a", "b"]), {"a": 1, "b": "bb"})
+        self.assertRaises(KeyError, rhd.__getitem__, "missing")
+        self.assertEqual(sorted(rhd.iteritems()), [("a", 1), ("b", "bb")])
+        stats = registry.snapshot()
+        # update calls set_many- both its round trip and serialization are attributed to update
+        self.assertNotIn("JSONRedisHashDict.set_many", stats)
+        self.assertEqual(stats["JSONRedisHashDict.update"]["round_trips"], 1)
+        self.assertEqual(stats["JSONRedisHashDict.update"]["bytes_serialized"], len('1') + len('"bb"'))
+        self.assertEqual(stats["JSONRedisHashDict.get"]["calls"], 10)
+        self.assertEqual(stats["JSONRedisHashDict.get"]["round_trips"], 10)
+        self.assertEqual(stats["JSONRedisHashDict.get"]["bytes_deserialized"], 10)
+        self.assertEqual(sum(stats["JSONRedisHashDict.get"]["histogram_usec"].values()), 10)
+        self.assertEqual(stats["JSONRedisHashDict.get_many"]["round_trips"], 1)
+        self.assertEqual(stats["JSONRedisHashDict.__getitem__"]["errors"], 1)
+        self.assertEqual(stats["JSONRedisHashDict.iteritems"]["calls"], 1)
+        self.assertEqual(stats["JSONRedisHashDict.iteritems"]["bytes_deserialized"], len('1') + len('"bb"'))
+        self.assertTrue(stats["JSONRedisHashDict.get"]["p50_latency"] <= stats["JSONRedisHashDict.get"]["p99_latency"])
+
+        calls = []
+        instrumentation.enable(calls.append)
+        rhd.delete_all()
+        self.assertEqual([(call.name, call.round_trips) for call in calls], [("JSONRedisHashDict.delete_all", 1)])
+
+        instrumentation.disable()
+        self.assertIs(RedisHashDict.__dict__["get"], original)
+        rhd.get("a")
+        self.assertEqual(registry.snapshot()["JSONRedisHashDict.get"]["calls"], 10)
+
+    def test_module_copies(self):
+        "Classes of a module loaded under another name are instrumented too."
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "redis_ds"))
+        try:
+            import redis_hash_dict
+            from redis_ds.redis_hash_dict import RedisHashDict
+            self.assertIsNot(redis_hash_dict.RedisHashDict, RedisHashDict)
+            original = redis_hash_dict.RedisHashDict.__dict__["get"]
+            registry = instrumentation.enable()
+            self.assertIsNot(redis_hash_dict.RedisHashDict.__dict__["get"], original)
+            redis_hash_dict.JSONRedisHashDict("test_instrumentation").get("a")
+            self.assertEqual(registry.snapshot()["JSONRedisHashDict.get"]["calls"], 1)
+            instrumentation.disable()
+            self.assertIs(redis_hash_dict.RedisHashDict.__dict__["get"], original)
+        finally:
+            sys.path.pop(0)
+
+    def test_elastic_metrics(self):
+        from elasticsearch import Elasticsearch
+        from elastic_ds.doc_dict import ElasticDocDict
+        from elastic_ds.fake_elastic import FakeElasticConnection, FakeElasticServer
+        es = Elasticsearch(connection_class=FakeElasticConnection, server=FakeElasticServer())
+        d = ElasticDocDict("test_instrumentation", "TestInstrumentation", es=es)
+        registry = instrumentation.enable()
+        d["a"] = {"b": 1}
+        self.assertEqual(d["a"], {"b": 1})
+        stats = registry.snapshot(reset=True)
+        self.assertEqual(stats["ElasticDocDict.__getitem__"]["round_trips"], 1)
+        self.assertTrue(stats["ElasticDocDict.__getitem__"]["bytes_deserialized"] > 0)
+        self.assertTrue(stats["ElasticDocDict.__setitem__"]["bytes_serialized"] > 0)
+        self.assertEqual(registry.snapshot(), {})
+
+    def test_exporter(self):
+        registry = instrumentation.MetricsRegistry()
+        call = instrumentation.CallRecord("RedisHashDict.get")
+        call.latency = 0.001
+        registry(call)
+        path = tempfile.mktemp(suffix=".jsonl")
+        try:
+            with instrumentation.MetricsExporter({"structures": registry.snapshot, "extra": lambda: {"x": 1}},
+                                                 interval=0.05, path=path):
+                registry(call)
+                time.sleep(0.2)
+            with open(path) as lines:
+                lines = [json.loads(line) for line in lines]
+        finally:
+            os.remove(path)
+        self.assertTrue(len(lines) >= 2)
+        self.assertEqual(lines[-1]["structures"]["RedisHashDict.get"]["calls"], 2)
+        self.assertEqual(lines[-1]["extra"], {"x": 1})
+        self.assertEqual(lines[-1]["pid"], os.getpid())
+
+
+if __name__ == '__main__':
+    unittest.main()